@@ -2,22 +2,36 @@ import os.path
 from contextlib import suppress
 import os
 import gc
-import csv
+import struct
 
 import pandas as pd
 
 from chatto_transform.datastores.datastore_base import DataStore
 from chatto_transform.datastores import hdf_datastore #for storage target extensions
 from chatto_transform.schema.schema_base import *
-from chatto_transform.lib.chunks import CHUNK_SIZE
+from chatto_transform.lib.chunks import CHUNK_SIZE, CategoryTable
+from chatto_transform.lib.compression import DEFAULT_PROFILE, compression_options
 
+"""HDF table store that rows can be appended to, with its categorical columns stored as codes.
+
+Each categorical column's labels are kept in <hdf_file>_<column>_categories.bin, in the order their codes were
+given out, as length-prefixed utf-8 records after a random generation header that is new every time the file is
+rewritten. Appends only write the labels the file lacks, and the labels are read
+once into a hash table cached on the store, so later appends and loads only read what other stores added since.
+Category files written as csv by earlier versions are converted the first time they are read."""
+
+_label_length = struct.Struct('<I')
+_generation_size = 16
 
 class AppendableHdfDataStore(DataStore):
-    def __init__(self, schema, hdf_file, expected_rows=None):
+    def __init__(self, schema, hdf_file, expected_rows=None, compression=DEFAULT_PROFILE):
+        """compression is a profile name from lib.compression."""
         super().__init__(schema)
         self.hdf_file = hdf_file
         self.hdf_schema = hdf_rename_schema(self.schema)
         self.expected_rows = expected_rows
+        self.compression = compression
+        self._category_tables = {}
 
     def storage_target(self):
         return 'hdf_enc'
@@ -32,35 +46,99 @@ class AppendableHdfDataStore(DataStore):
         for col in self._categorical_cols():
             with suppress(FileNotFoundError, IsADirectoryError):
                 os.remove(self._get_category_file(col))
+            with suppress(FileNotFoundError, IsADirectoryError):
+                os.remove(self._get_legacy_category_file(col))
+        self._category_tables = {}
 
     def _get_category_file(self, col):
-        return self.hdf_file + '_' + col +'_categories.csv'
+        return self.hdf_file + '_' + col + '_categories.bin'
+
+    def _get_legacy_category_file(self, col):
+        return self.hdf_file + '_' + col + '_categories.csv'
 
     def _any_categories(self, col):
-        cat_file = self._get_category_file(col)
-        return os.path.exists(cat_file)
+        return len(self._category_table(col).labels) > 0
 
     def _load_categories(self, col):
-        cat_file = self._get_category_file(col)
-        cat_df = pd.read_csv(cat_file, header=None, names=['categories'], dtype=str)
-        if cat_df['categories'].dtype != 'object':
-            cat_df['categories'] = cat_df['categories'].astype(str)
-        return cat_df['categories']
+        return pd.Series(self._category_table(col).labels, dtype='object')
+
+    def _category_table(self, col):
+        """The CategoryTable of col's category file, cached on the store. Only the labels added to the file since
+        it was last read (e.g. by another store on the same file) are read. A file with a different generation in its
+        header has been rewritten (e.g. by another store's _store), and is read from the start."""
+        self._migrate_legacy_categories(col)
+        table, generation, offset = self._category_tables.get(col, (None, None, 0))
+        try:
+            with open(self._get_category_file(col), 'rb') as f:
+                header = f.read(_generation_size)
+                if table is None or header != generation:
+                    table, generation, offset = CategoryTable(), header, _generation_size
+                f.seek(offset)
+                labels, read = _unpack_labels(f.read())
+        except FileNotFoundError:
+            table, generation, offset = CategoryTable(), None, 0
+            labels, read = [], 0
+        for label in labels:
+            table.codes[label] = len(table.labels)
+            table.labels.append(label)
+        self._category_tables[col] = (table, generation, offset + read)
+        return table
 
     def _add_categories(self, col, categories, append=True):
-        cat_file = self._get_category_file(col)
-        cat_df = pd.DataFrame()
-        cat_df['categories'] = categories
-        
-        if self._any_categories(col):
-            mode = 'a'
-        else:
-            mode = 'w'
+        """Write the categories not yet in col's category file at its end, or in place of its labels if not append."""
+        if not append:
+            with suppress(FileNotFoundError):
+                os.remove(self._get_category_file(col))
+        table = self._category_table(col)
+        _, generation, offset = self._category_tables[col]
+        labels = [label for label in dict.fromkeys(str(label) for label in categories) if label not in table.codes]
 
-        cat_df.to_csv(cat_file, mode=mode, index=False, header=False)
+        cat_file = self._get_category_file(col)
+        if generation is None:
+            generation = _new_generation()
+            with open(cat_file, 'wb') as f:
+                f.write(generation)
+            offset = _generation_size
+        with open(cat_file, 'r+b') as f:
+            f.seek(offset) #drops a partly written label left by an interrupted append
+            f.write(_pack_labels(labels))
+            f.truncate()
+            offset = f.tell()
+        for label in labels:
+            table.codes[label] = len(table.labels)
+            table.labels.append(label)
+        self._category_tables[col] = (table, generation, offset)
+
+    def _migrate_legacy_categories(self, col):
+        """Convert a category file written as csv by earlier versions of the store."""
+        legacy_file = self._get_legacy_category_file(col)
+        if not os.path.exists(legacy_file) or os.path.exists(self._get_category_file(col)):
+            return
+        print('converting categories for', col)
+        cat_df = pd.read_csv(legacy_file, header=None, names=['categories'], dtype=str)
+        labels = [str(label) for label in cat_df['categories']]
+        tmp_file = self._get_category_file(col) + '.partial'
+        with open(tmp_file, 'wb') as f:
+            f.write(_new_generation())
+            f.write(_pack_labels(labels))
+        os.replace(tmp_file, self._get_category_file(col))
+        os.remove(legacy_file)
+
+    def _encode_categories(self, col, ser):
+        """Codes of the categorical ser in col's category file, first writing any of its categories the file lacks.
+        Costs O(categories of ser), besides looking up the codes of its rows."""
+        categories = [str(label) for label in ser.cat.categories]
+        table = self._category_table(col)
+        if any(label not in table.codes for label in categories):
+            print('updating categories for', col)
+            self._add_categories(col, categories)
+        return table.mapping(categories)[ser.cat.codes.values].astype('int64')
+
+    def _decode_categories(self, col, codes):
+        return pd.Categorical.from_codes(codes, categories=self._category_table(col).labels)
 
     def _get_store(self):
-        return pd.HDFStore(self.hdf_file, complevel=9, complib='blosc')
+        return pd.HDFStore(self.hdf_file, **compression_options(self.compression))
 
     def _get_data_columns(self):
         return self.schema.col_names()
@@ -71,16 +149,13 @@ class AppendableHdfDataStore(DataStore):
                 continue
             yield col.name
 
-    def _category_index_to_series(self, index):
-        ser = index.astype('object').to_series().reset_index(drop=True)
-        return ser
-
     def _store(self, df):
         df = self._rename_df_to_hdf(df)
-        col_categories = {}
         for col in self._categorical_cols():
-            col_categories[col] = df[col].cat.categories
-            df[col] = df[col].cat.codes.astype('int64')
+            with suppress(FileNotFoundError):
+                os.remove(self._get_legacy_category_file(col))
+            self._add_categories(col, [], append=False)
+            df[col] = self._encode_categories(col, df[col])
         df.reset_index(drop=True, inplace=True)
 
         store = self._get_store()
@@ -89,14 +164,8 @@ class AppendableHdfDataStore(DataStore):
             chunksize=CHUNK_SIZE)
         store.close()
 
-        for col_name, categories in col_categories.items():
-            if len(categories) > 0:
-                categories = self._category_index_to_series(categories)
-                self._add_categories(col_name, categories, append=False)
-    
     def append(self, inc_df):
-        inc_df = inc_df.copy()
-        self.schema.conform_df(inc_df)
+        inc_df = self.schema.conform_df(inc_df, copy_on_write=True)
         inc_df.reset_index(drop=True, inplace=True)
 
         if not self.exists():
@@ -104,25 +173,9 @@ class AppendableHdfDataStore(DataStore):
 
         inc_df = self._rename_df_to_hdf(inc_df)
 
+        # categories are written before the rows, so stored codes always have their labels
         for col in self._categorical_cols():
-            if not self._any_categories(col):
-                if len(inc_df[col].cat.categories) > 0:
-                    categories = self._category_index_to_series(inc_df[col].cat.categories)
-                    self._add_categories(col, categories, append=False)
-                inc_df[col] = inc_df[col].cat.codes.astype('int64')    
-
-            else:
-                old_categories = pd.Index(self._load_categories(col))
-                new_categories = inc_df[col].cat.categories
-                
-                diff = new_categories.difference(old_categories)
-
-                merged_categories = old_categories.append(diff)
-                inc_df[col] = inc_df[col].cat.set_categories(merged_categories).cat.codes.astype('int64')
-                if len(diff) > 0:
-                    print('updating categories for', col)
-                    categories = self._category_index_to_series(diff)
-                    self._add_categories(col, categories)
+            inc_df[col] = self._encode_categories(col, inc_df[col])
 
         print('storing numeric data')
         store = self._get_store()
@@ -143,12 +196,8 @@ class AppendableHdfDataStore(DataStore):
             store.close()
 
         for col in self._categorical_cols():
-            if self._any_categories(col):
-                categories = self._load_categories(col)
-            else:
-                categories = []
-            df[col] = pd.Categorical.from_codes(df[col], categories=categories, name=col)
-        
+            df[col] = self._decode_categories(col, df[col])
+
         df = self._rename_df_from_hdf(df)
         return df
 
@@ -162,6 +211,28 @@ class AppendableHdfDataStore(DataStore):
         df.columns = self.schema.col_names()
         return df
 
+def _new_generation():
+    """Random header of a newly written category file, which tells it apart from the files it replaces."""
+    return os.urandom(_generation_size)
+
+def _pack_labels(labels):
+    """Category file records: each label's utf-8 length as a little-endian uint32, then the label."""
+    encoded = [label.encode('utf-8') for label in labels]
+    return b''.join(_label_length.pack(len(b)) + b for b in encoded)
+
+def _unpack_labels(data):
+    """Labels of the complete records in data, and the number of bytes they take up."""
+    labels = []
+    pos = 0
+    while pos + _label_length.size <= len(data):
+        n, = _label_length.unpack_from(data, pos)
+        end = pos + _label_length.size + n
+        if end > len(data):
+            break
+        labels.append(data[pos + _label_length.size:end].decode('utf-8'))
+        pos = end
+    return labels, pos
+
 def hdf_name_to_pandas(col_name):
     return col_name.replace('__', '.')
 
@@ -6,11 +6,13 @@ class CachingDataStore(DataStore):
         self.load_ds = load_ds
         self.cache_ds = cache_ds
 
-    def _load(self):
+    def _load(self, **load_args):
+        """load_args (columns, where) are passed to load_ds, and to cache_ds on a cache hit, so a hit returns the
+        same rows and columns as a miss. cache_ds should be specific to them, as it stores what load_ds returned."""
         if self.cache_ds.exists():
-            return self.cache_ds.load()
+            return self.cache_ds.load(**load_args)
 
-        df = self.load_ds.load()
+        df = self.load_ds.load(**load_args)
         
         try:
             self.cache_ds.store(df)
@@ -19,8 +21,8 @@ class CachingDataStore(DataStore):
 
         return df
 
-    def update_cache(self):
-        df = self.load_ds.load()
+    def update_cache(self, **load_args):
+        df = self.load_ds.load(**load_args)
 
         try:
             self.cache_ds.store(df)
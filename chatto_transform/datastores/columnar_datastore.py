@@ -0,0 +1,330 @@
+from chatto_transform.datastores.datastore_base import DataStore
+from chatto_transform.schema.schema_base import *
+from chatto_transform.lib.big_dt_tools import big_dt_to_num, num_to_big_dt
+from chatto_transform.lib.chunks import from_chunks, CategoryTable
+from chatto_transform.lib.predicates import predicate_mask
+
+from collections import OrderedDict
+from contextlib import suppress
+import json
+import os
+import os.path
+import shutil
+
+import numpy as np
+import pandas
+
+"""DataStore that keeps a table as partitions of rows, with every column of every partition in its own .npy file.
+
+    directory/_manifest.json       columns, category labels, and every partition's row count and column stats
+    directory/part-00000/0.npy     first column of the first partition
+    ...
+
+Rows are split into partitions on ranges of partition_size values of partition_column (e.g. 10000 subject_ids per
+partition). Both default to the schema's 'partition_by' and 'partition_size' options, and partition_column falls back
+to the schema's index. Without them, every store or append makes a single partition. Loads return the rows
+partition by partition, in the order the partitions were written.
+
+Loads read only the requested columns, memory-mapped, and skip the partitions whose min/max column stats rule out
+the where predicates. Categorical columns are stored as codes into one append-only list of labels per column kept in
+the manifest, so partitions appended later share the codes of earlier ones. The manifest is replaced atomically after
+the partition files are written, so readers never see a partial partition. Only one process should write at a time."""
+
+# object columns can't be memory-mapped, they are pickled instead
+for col_type in [dt, delta, num, bool_, obj]:
+    col_type._storage_target_registry['columnar'] = col_type._storage_target_registry['pandas'].copy()
+
+@cat.register_check('columnar')
+def _(col):
+    return col.dtype == 'category'
+
+@cat.register_transform('columnar')
+def _(col):
+    return col.astype('category')
+
+@id_.register_check('columnar')
+def _(col):
+    return col.dtype == 'float64'
+
+@id_.register_transform('columnar')
+def _(col):
+    return col.astype('float64')
+
+@big_dt.register_check('columnar')
+def _(col):
+    return col.dtype == 'float64'
+
+@big_dt.register_transform('columnar')
+def _(col):
+    return big_dt_to_num(col)
+
+# the column types whose min and max are kept per partition, for pruning
+_stats_types = (id_, num, dt, bool_)
+
+class ColumnarDataStore(DataStore):
+    def __init__(self, schema, directory, partition_column=None, partition_size=None):
+        super().__init__(schema)
+        self.directory = directory
+        self.partition_column = partition_column or schema.options.get('partition_by', schema.options.get('index'))
+        self.partition_size = partition_size or schema.options.get('partition_size')
+
+    def storage_target(self):
+        return 'columnar'
+
+    def _manifest_file(self):
+        return os.path.join(self.directory, '_manifest.json')
+
+    def _partition_dir(self, name):
+        return os.path.join(self.directory, name)
+
+    def _column_file(self, partition_name, i):
+        return os.path.join(self._partition_dir(partition_name), '{}.npy'.format(i))
+
+    def _read_manifest(self):
+        with open(self._manifest_file()) as f:
+            return json.load(f)
+
+    def _write_manifest(self, manifest):
+        tmp_file = self._manifest_file() + '.partial'
+        with open(tmp_file, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_file, self._manifest_file())
+
+    def _empty_manifest(self):
+        return {
+            'columns': self.schema.col_names(),
+            'categories': {},
+            'partitions': []
+        }
+
+    def exists(self):
+        return os.path.isfile(self._manifest_file())
+
+    def delete(self):
+        with suppress(FileNotFoundError):
+            shutil.rmtree(self.directory)
+
+    def nrows(self):
+        return sum(part['rows'] for part in self._read_manifest()['partitions'])
+
+    ### writing
+
+    def _store(self, df):
+        self.delete()
+        self._append_chunks([df])
+
+    def _store_chunks(self, chunks):
+        self.delete()
+        self._append_chunks(chunks)
+
+    def append(self, df):
+        """Add the rows of df as new partitions, leaving the existing partitions untouched."""
+        with self._span('append') as span:
+            span.set_input(df)
+            df = self._conform_for_store(df)
+            self._append_chunks([df])
+            del df
+
+    def append_chunks(self, chunks):
+        with self._span('append_chunks') as span:
+            def conform_each(chunks):
+                for chunk in chunks:
+                    span.add_input(chunk)
+                    chunk = self._conform_for_store(chunk)
+                    yield chunk
+                    del chunk
+            self._append_chunks(conform_each(chunks))
+
+    def _append_chunks(self, chunks):
+        os.makedirs(self.directory, exist_ok=True)
+        manifest = self._read_manifest() if self.exists() else self._empty_manifest()
+        if set(manifest['columns']) != set(self.schema.col_names()):
+            sym_diff = set(manifest['columns']) ^ set(self.schema.col_names())
+            raise TypeError('store columns do not match schema. non-matching were: {}'.format(sym_diff))
+
+        category_tables = {}
+        for column in manifest['columns']:
+            table = category_tables[column] = CategoryTable()
+            for label in manifest['categories'].get(column, []):
+                table.codes[label] = len(table.labels)
+                table.labels.append(label)
+
+        for chunk in chunks:
+            for key, rows in self._partition_rows(chunk):
+                self._write_partition(manifest, category_tables, chunk, key, rows)
+            del chunk
+
+            for column, table in category_tables.items():
+                if table.labels:
+                    manifest['categories'][column] = list(table.labels)
+            # make each chunk's partitions visible as soon as they are written
+            self._write_manifest(manifest)
+
+        if not self.exists():
+            self._write_manifest(manifest)
+
+    def _partition_rows(self, df):
+        """Yield (partition key, row positions) for each partition of df. Row positions are None for all rows."""
+        if len(df) == 0:
+            return
+        if self.partition_column is None or self.partition_size is None:
+            yield None, None
+            return
+
+        values = df[self.partition_column].values
+        if values.dtype.kind not in 'iuf':
+            raise TypeError('partition column {} must be numeric. Got {}'.format(self.partition_column, values.dtype))
+        keys = np.floor(values / self.partition_size)
+        keys[np.isnan(keys)] = np.inf #missing values make up a partition of their own
+        order = np.argsort(keys, kind='mergesort')
+        sorted_keys = keys[order]
+        bounds = np.flatnonzero(np.diff(sorted_keys)) + 1
+        for start, stop in zip(np.r_[0, bounds], np.r_[bounds, len(order)]):
+            key = sorted_keys[start]
+            yield (int(key) if np.isfinite(key) else None), order[start:stop]
+
+    def _write_partition(self, manifest, category_tables, df, key, rows):
+        name = 'part-{:05d}'.format(len(manifest['partitions']))
+        os.makedirs(self._partition_dir(name), exist_ok=True)
+        cols = {col.name: col for col in self.schema.cols}
+
+        stats = {}
+        for i, column in enumerate(manifest['columns']):
+            col = df[column]
+            if hasattr(col, 'cat'):
+                values = category_tables[column].remap(col)
+            else:
+                values = col.values
+            if rows is not None:
+                values = values.take(rows)
+
+            if values.dtype == 'object':
+                np.save(self._column_file(name, i), values, allow_pickle=True)
+            else:
+                np.save(self._column_file(name, i), values)
+
+            if isinstance(cols[column], _stats_types):
+                stats[column] = _min_max(values)
+
+        manifest['partitions'].append({
+            'name': name,
+            'key': key,
+            'rows': len(df) if rows is None else len(rows),
+            'stats': stats
+        })
+
+    ### reading
+
+    def _load(self, columns=None, where=None):
+        """Load the named columns (by default all of them) of the rows matching the where predicates.
+        Partitions are pruned on their column stats, and the predicates are evaluated on the memory-mapped columns,
+        so only the matching rows of the requested columns are copied into memory."""
+        manifest = self._read_manifest()
+        schema = self.projected_schema(columns)
+        columns = schema.col_names()
+        where = list(where or [])
+
+        if not manifest['partitions']:
+            # nothing stored yet, so there are no partition files to take the dtypes from
+            return schema.conform_df(pandas.DataFrame(columns=columns))
+
+        partitions = [part for part in manifest['partitions'] if _may_match(part, where)]
+        if not partitions:
+            # keep the columns and dtypes of an empty result
+            return self._read_partition(manifest, manifest['partitions'][0], columns, empty=True)
+
+        chunks = (self._read_partition(manifest, part, columns, where) for part in partitions)
+        return from_chunks(chunks)
+
+    def _load_chunks(self):
+        manifest = self._read_manifest()
+        for part in manifest['partitions']:
+            yield self._read_partition(manifest, part, manifest['columns'])
+
+    def _read_column(self, manifest, part, column):
+        i = manifest['columns'].index(column)
+        f = self._column_file(part['name'], i)
+        try:
+            values = np.load(f, mmap_mode='r')
+        except ValueError: #pickled object column
+            values = np.load(f, allow_pickle=True)
+        if column in manifest['categories']:
+            return pandas.Categorical.from_codes(values, manifest['categories'][column])
+        return values
+
+    def _read_partition(self, manifest, part, columns, where=None, empty=False):
+        """Read the columns of the rows of a partition that match the where predicates, or none of its rows if empty."""
+        rows = slice(None)
+        if empty:
+            rows = slice(0, 0)
+        elif where:
+            pred_columns = {p[0] for p in where}
+            pred_df = pandas.DataFrame(OrderedDict(
+                (column, self._read_column(manifest, part, column)) for column in pred_columns))
+            mask = np.ones(part['rows'], dtype=bool)
+            for predicate in where:
+                mask &= np.asarray(predicate_mask(pred_df, predicate))
+            rows = np.flatnonzero(mask)
+            del pred_df
+
+        data = OrderedDict()
+        for column in columns:
+            values = self._read_column(manifest, part, column)
+            data[column] = values[rows]
+        # building the frame copies the mapped rows into writable blocks
+        df = pandas.DataFrame(data, columns=columns)
+
+        for col in self.schema.cols:
+            if isinstance(col, big_dt) and col.name in df.columns:
+                # converting big_dt column
+                df[col.name] = num_to_big_dt(df[col.name])
+        return df
+
+def _min_max(values):
+    """JSON-able [min, max] of the non-null values, or None if there are none. Datetimes are in ns since the epoch."""
+    if values.dtype.kind == 'M':
+        values = values.view('int64')
+        values = values[values != np.iinfo('int64').min]
+    elif values.dtype.kind == 'f':
+        values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return None
+    return [values.min().item(), values.max().item()]
+
+def _stat_value(value, stats):
+    if isinstance(stats[0], int) and not isinstance(value, (int, float, np.number)):
+        return pandas.Timestamp(value).value
+    return float(value)
+
+def _may_match(part, where):
+    """False if the partition's column stats show that no row can match every predicate."""
+    for predicate in where:
+        if not isinstance(predicate, tuple):
+            continue
+        col_name, op, value = predicate
+        if col_name not in part['stats']:
+            continue
+        stats = part['stats'][col_name]
+        if stats is None: #only nulls
+            if not (op == '==' and value is None):
+                return False
+            continue
+        if value is None:
+            continue
+        low, high = stats
+        try:
+            if op == 'in':
+                values = [_stat_value(v, stats) for v in value if v is not None]
+                if not any(low <= v <= high for v in values):
+                    return False
+                continue
+            value = _stat_value(value, stats)
+        except (TypeError, ValueError):
+            continue
+        if op == '==' and not low <= value <= high:
+            return False
+        if (op == '<' and low >= value) or (op == '<=' and low > value):
+            return False
+        if (op == '>' and high <= value) or (op == '>=' and high < value):
+            return False
+    return True
@@ -1,17 +1,26 @@
 from chatto_transform.datastores.datastore_base import DataStore
 from chatto_transform.schema.schema_base import *
 
+from chatto_transform.lib.chunks import from_chunks, to_chunks, CategoryTable
+from chatto_transform.lib.big_dt_tools import parse_fixed_datetimes, parse_big_dt
+
 import os.path
+import sys
+import queue
+import contextlib
+import threading
 import pandas
+import numpy as np
 import gzip
 import io
 
-for col_type in [cat, id_, dt, delta, num, bool_]:
+for col_type in [cat, id_, dt, delta, big_dt, num, bool_]:
     col_type._storage_target_registry['csv'] = col_type._storage_target_registry['pandas'].copy()
 
 @cat.register_check('csv')
 def _(col):
-    return col.dtype == 'object'
+    # to_csv writes the labels of categoricals, so they need not be turned into strings first
+    return col.dtype == 'object' or col.dtype == 'category'
 
 @cat.register_transform('csv')
 def _(col):
@@ -40,6 +49,10 @@ def _(self):
 def _(self):
     return (self.name, 'object')
 
+@big_dt.register_metadata('csv_dtype')
+def _(self):
+    return (self.name, 'object')
+
 @num.register_metadata('csv_dtype')
 def _(self):
     return (self.name, 'float64')
@@ -48,75 +61,183 @@ def _(self):
 def _(self):
     return (self.name, 'float64')
 
-CHUNK_SIZE = 5000000
+CHUNK_BYTES = 2**28
+SAMPLE_ROWS = 1000
+WRITE_ROWS = 65536 #rows rendered to csv at a time when storing
+
+# the datetime64[ns] range, in seconds
+_ns_min = pandas.Timestamp.min.value // 10**9 + 1
+_ns_max = pandas.Timestamp.max.value // 10**9
+
+def parse_datetimes(values):
+    """Parse an array of "%Y-%m-%d %H:%M:%S" strings into datetime64[ns] values, without going through a
+    Timestamp per value (see big_dt_tools.parse_fixed_datetimes). Nulls become NaT, and any value not in that exact
+    format, or outside the datetime64[ns] range, is left to pandas.to_datetime."""
+    values = np.asarray(values, dtype='object')
+    notnull = pandas.notnull(values)
+    result = np.empty(len(values), dtype='datetime64[ns]')
+    result[:] = np.datetime64('NaT')
+
+    parsed = parse_fixed_datetimes(values)
+    if parsed is None:
+        return _parse_datetimes_slow(values, notnull, result)
+    fixed, valid = parsed
+    seconds = fixed.view('int64')
+    valid &= (seconds >= _ns_min) & (seconds <= _ns_max)
+    result[valid] = fixed[valid].astype('datetime64[ns]')
+    return _parse_datetimes_slow(values, notnull & ~valid, result)
+
+def _parse_datetimes_slow(values, mask, result):
+    if mask.any():
+        parsed = pandas.to_datetime(pandas.Series(values[mask]), format="%Y-%m-%d %H:%M:%S", coerce=True)
+        result[mask] = parsed.values
+    return result
+
+def _frame_bytes(df):
+    """Memory held by df, counting the python objects in object columns."""
+    n_bytes = 0
+    for col in df.columns:
+        values = df[col].values
+        n_bytes += values.nbytes
+        if values.dtype == 'object':
+            n_bytes += sum(sys.getsizeof(v) for v in values)
+    return n_bytes
 
 class CsvDataStore(DataStore):
-    def __init__(self, schema, file, compress=False, with_header=True, na_values=None):
+    def __init__(self, schema, file, compress=False, with_header=True, na_values=None, encode_categoricals=True,
+                 chunk_bytes=CHUNK_BYTES, write_in_background=False):
+        """With encode_categoricals, categorical columns are turned into category codes as each chunk is parsed,
+        so only one chunk's worth of strings is held at a time. Chunks are sized to hold about chunk_bytes of parsed
+        data, estimated from the first SAMPLE_ROWS rows. Stores are written WRITE_ROWS rows at a time
+        (see _store_chunks)."""
         self.file = file
         self.compress = compress
         self.with_header = with_header
         self.na_values = na_values
+        self.encode_categoricals = encode_categoricals
+        self.chunk_bytes = chunk_bytes
+        self.write_in_background = write_in_background
         super().__init__(schema)
 
     def storage_target(self):
         return 'csv'
 
-    def _load(self):
+    def _read_csv(self, **kwargs):
         if self.compress:
-            compression = 'gzip'
-        else:
-            compression = None
-
-        dtype_dict = dict(col.metadata('csv_dtype') for col in self.schema.cols)
-
-        kwargs = {}
+            kwargs['compression'] = 'gzip'
         if not self.with_header:
             kwargs['header'] = None
             kwargs['names'] = self.schema.col_names()
         if self.na_values is not None:
             kwargs['na_values'] = self.na_values
+        dtype_dict = dict(col.metadata('csv_dtype') for col in self.schema.cols)
+        return pandas.read_csv(self.file, dtype=dtype_dict, **kwargs)
 
-        df = pandas.read_csv(self.file, compression=compression, dtype=dtype_dict, **kwargs)
-        for col in self.schema.cols:
-            if isinstance(col, dt):
-                df[col.name] = pandas.to_datetime(df[col.name], format="%Y-%m-%d %H:%M:%S", coerce=True)
-        return df
+    def _load(self):
+        return from_chunks(self._load_chunks())
 
     def _load_chunks(self):
-        if self.compress:
-            compression = 'gzip'
-        else:
-            compression = None
-
-        dtype_dict = dict(col.metadata('csv_dtype') for col in self.schema.cols)
-
-        kwargs = {}
-        if not self.with_header:
-            kwargs['header'] = None
-            kwargs['names'] = self.schema.col_names()
-        if self.na_values is not None:
-            kwargs['na_values'] = self.na_values
+        """Parse the file in chunks. With encode_categoricals, every chunk's categorical columns share the codes of
+        one dictionary per column, which grows as new labels are seen."""
+        reader = self._read_csv(iterator=True)
+        category_tables = {col.name: CategoryTable() for col in self.schema.cols if isinstance(col, cat)}
+
+        chunksize = SAMPLE_ROWS
+        first = True
+        while True:
+            try:
+                chunk = reader.get_chunk(chunksize)
+            except StopIteration:
+                break
+            if first:
+                if len(chunk) == SAMPLE_ROWS:
+                    chunksize = max(int(self.chunk_bytes * len(chunk) / max(_frame_bytes(chunk), 1)), SAMPLE_ROWS)
+                first = False
 
-        chunks = pandas.read_csv(self.file, compression=compression, dtype=dtype_dict, chunksize=CHUNK_SIZE, **kwargs)
-        for chunk in chunks:
             for col in self.schema.cols:
                 if isinstance(col, dt):
-                    chunk[col.name] = pandas.to_datetime(chunk[col.name], format="%Y-%m-%d %H:%M:%S", coerce=True)
+                    chunk[col.name] = parse_datetimes(chunk[col.name].values)
+                elif isinstance(col, big_dt):
+                    chunk[col.name] = parse_big_dt(chunk[col.name].values)
+                elif isinstance(col, cat) and self.encode_categoricals:
+                    table = category_tables[col.name]
+                    codes = table.encode(chunk[col.name].values)
+                    chunk[col.name] = pandas.Categorical.from_codes(codes, table.labels)
             yield chunk
+            del chunk
 
     def _store(self, df):
+        self._store_chunks(to_chunks(df, WRITE_ROWS) if len(df) else [df])
+
+    def _store_chunks(self, chunks):
+        """Render the chunks to csv one at a time, and write them through an incremental gzip compressor if
+        compress is set. With write_in_background, compressing and writing happen in a thread while the next chunk
+        is rendered."""
+        with self._open_for_write() as f:
+            if isinstance(f, io.TextIOBase):
+                write = f.write
+                writer = None
+            elif self.write_in_background:
+                writer = _BackgroundWriter(f)
+                write = lambda block: writer.write(block.encode('utf8'))
+            else:
+                write = lambda block: f.write(block.encode('utf8'))
+                writer = None
+            try:
+                header = self.with_header
+                for chunk in chunks:
+                    write(chunk.to_csv(None, index=False, header=header, date_format="%Y-%m-%d %H:%M:%S"))
+                    header = False
+                    del chunk
+            finally:
+                if writer is not None:
+                    writer.close()
+
+    @contextlib.contextmanager
+    def _open_for_write(self):
         if self.compress:
-            with io.StringIO() as f:
-                df.to_csv(f, index=False, date_format="%Y-%m-%d %H:%M:%S")
-                f.seek(0)
-                compressed = gzip.compress(f.read().encode('utf8'))
-                if isinstance(self.file, str):
-                    with open(self.file, 'wb') as out:
-                        out.write(compressed)
-                else:
-                    self.file.write(compressed)
+            if isinstance(self.file, str):
+                f = gzip.GzipFile(self.file, 'wb')
+            else:
+                f = gzip.GzipFile(fileobj=self.file, mode='wb')
+            with f:
+                yield f
+        elif isinstance(self.file, str):
+            with open(self.file, 'wb') as f:
+                yield f
         else:
-            df.to_csv(self.file, index=False, date_format="%Y-%m-%d %H:%M:%S")
+            yield self.file
 
     def exists(self):
-        return os.path.isfile(self.hdf_file)
+        return isinstance(self.file, str) and os.path.isfile(self.file)
+
+class _BackgroundWriter:
+    """Writes blocks of bytes to a file in a thread. At most two blocks wait to be written at a time."""
+    def __init__(self, f):
+        self.f = f
+        self.blocks = queue.Queue(maxsize=2)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            block = self.blocks.get()
+            if block is None:
+                return
+            if self.error is None: #after an error, keep taking blocks so the writer never waits forever
+                try:
+                    self.f.write(block)
+                except Exception as e:
+                    self.error = e
+
+    def write(self, block):
+        if self.error is not None:
+            raise self.error
+        self.blocks.put(block)
+
+    def close(self):
+        self.blocks.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
@@ -1,3 +1,6 @@
+from chatto_transform.lib import profiling
+from chatto_transform.schema.schema_base import PartialSchema
+
 class DataStore:
     """Base class - defines the DataStore abstraction.
     A DataStore is an adapter between a pandas DataFrame and a storage medium.
@@ -9,37 +12,87 @@ class DataStore:
     def storage_target(self):
         raise NotImplementedError()
 
-    def load(self):
-        result = self._load()
-        self.schema.conform_df(result)
+    def _span(self, operation):
+        return profiling.span(type(self).__name__ + '.' + operation, 'datastore',
+            schema=getattr(self.schema, 'name', None))
+
+    def _conform_for_store(self, df):
+        # conform a copy-on-write view so only the columns the storage target converts are copied
+        with profiling.span('conform', 'conform'):
+            return self.schema.conform_df(df, storage_target=self.storage_target(), copy_on_write=True)
+
+    def projected_schema(self, columns=None):
+        """The schema of the data loaded with load(columns=columns)."""
+        if columns is None:
+            return self.schema
+        return PartialSchema.projection(self.schema, columns)
+
+    def load(self, columns=None, where=None):
+        """Load the data. DataStores that support it can load only the named columns, and only the rows matching
+        the where predicates, which are (column name, op, value) tuples (see the DataStore's _load).
+        The result is conformed to projected_schema(columns)."""
+        load_args = {}
+        if columns is not None:
+            load_args['columns'] = columns
+        if where is not None:
+            load_args['where'] = where
+        with self._span('load') as span:
+            result = self._load(**load_args)
+            with profiling.span('conform', 'conform'):
+                self.projected_schema(columns).conform_df(result)
+            span.set_output(result)
         return result
 
     def load_chunks(self):
-        for chunk in self._load_chunks():
-            self.schema.conform_df(chunk)
+        chunks = iter(self._load_chunks())
+        while True:
+            # one span per chunk, so the time the consumer spends on a chunk is not counted
+            with self._span('load_chunks') as span:
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    span.discard()
+                    return
+                with profiling.span('conform', 'conform'):
+                    self.schema.conform_df(chunk)
+                span.set_output(chunk)
             yield chunk
             del chunk
 
     def store(self, df):
-        df = df.copy()
-        self.schema.conform_df(df, storage_target=self.storage_target())
-        self._store(df)
-        del df #delete our copy
+        with self._span('store') as span:
+            span.set_input(df)
+            df = self._conform_for_store(df)
+            self._store(df)
+            del df #delete our view
 
     def store_chunks(self, chunks):
-        def conform_each(chunks):
-            for chunk in chunks:
-                chunk = chunk.copy()
-                self.schema.conform_df(chunk, storage_target=self.storage_target())
-                yield chunk
-                del chunk
-        self._store_chunks(conform_each(chunks))
+        # the span also covers the time spent producing the chunks
+        with self._span('store_chunks') as span:
+            def conform_each(chunks):
+                for chunk in chunks:
+                    span.add_input(chunk)
+                    chunk = self._conform_for_store(chunk)
+                    yield chunk
+                    del chunk
+            self._store_chunks(conform_each(chunks))
 
     def update(self, df):
-        df = df.copy()
-        self.schema.conform_df(df, storage_target=self.storage_target())
-        self._update(df)
-        del df #delete our copy
+        with self._span('update') as span:
+            span.set_input(df)
+            df = self._conform_for_store(df)
+            self._update(df)
+            del df #delete our view
+
+    def update_chunks(self, chunks):
+        with self._span('update_chunks') as span:
+            def conform_each(chunks):
+                for chunk in chunks:
+                    span.add_input(chunk)
+                    chunk = self._conform_for_store(chunk)
+                    yield chunk
+                    del chunk
+            self._update_chunks(conform_each(chunks))
 
     def delete(self):
         raise NotImplementedError()
@@ -62,3 +115,6 @@ class DataStore:
 
     def _update(self, df):
         raise NotImplementedError()
+
+    def _update_chunks(self, chunks):
+        raise NotImplementedError()
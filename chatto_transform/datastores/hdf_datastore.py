@@ -1,7 +1,10 @@
 from chatto_transform.datastores.datastore_base import DataStore
 from chatto_transform.schema.schema_base import *
+from chatto_transform.lib.predicates import filter_df
+from chatto_transform.lib.big_dt_tools import big_dt_to_num, num_to_big_dt
+from chatto_transform.lib.compression import DEFAULT_PROFILE, compression_options, column_profile, is_per_column_type
 
-import datetime
+from collections import OrderedDict
 from contextlib import suppress
 from itertools import count
 import pandas
@@ -38,7 +41,7 @@ def _(col):
 
 @big_dt.register_transform('hdf')
 def _(col):
-    return col.map(datetime.datetime.timestamp, na_action='ignore')
+    return big_dt_to_num(col)
 
 
 for col_type in [id_, dt, delta, big_dt, num, bool_]:
@@ -53,10 +56,26 @@ def _(col):
     return col.astype('category')
 
 class HdfDataStore(DataStore):
-    def __init__(self, schema, hdf_file, fixed=True, encode_categoricals=True):
+    def __init__(self, schema, hdf_file, fixed=True, encode_categoricals=True, data_columns=None, column_groups=None,
+                 compression=DEFAULT_PROFILE):
+        """With fixed=False the data is stored in table format, which load(columns=..., where=...) can query:
+        predicates on data_columns (by default the schema's index) are answered by PyTables from the on-disk index,
+        and only the requested columns are returned. Other predicates are applied after reading.
+
+        column_groups (a list of lists of column names) stores the columns in a table per group, so a narrow
+        projection only decompresses the groups it needs. Columns in no group make up a last group, and the
+        data_columns must be in the first group. column_groups implies table format.
+
+        compression is a profile name from lib.compression, or a dict of column type to profile name. In table
+        format, a per column type setting stores the columns of each profile in a group of their own."""
         self.hdf_file = hdf_file
-        self.fixed = fixed
+        self.fixed = fixed and column_groups is None
         self.encode_categoricals = encode_categoricals
+        if data_columns is None:
+            data_columns = [schema.options['index']] if schema.options.get('index') in schema.col_names() else []
+        self.data_columns = data_columns
+        self.column_groups = column_groups
+        self.compression = compression
         super().__init__(schema)
 
     def storage_target(self):
@@ -65,23 +84,114 @@ class HdfDataStore(DataStore):
     def _chunk_filename(self, i):
         return self.hdf_file+'_chunk_' + str(i)
 
-    def _read_hdf(self, f):
-        store = pandas.HDFStore(f)
-        df = store[self.schema.name]
+    def _group_key(self, i):
+        return '{}_group{}'.format(self.schema.name, i)
+
+    def _grouped(self):
+        return self.column_groups is not None or (not self.fixed and is_per_column_type(self.compression))
+
+    def _groups(self, columns):
+        if self.column_groups is not None:
+            groups = [list(group) for group in self.column_groups]
+            grouped = set().union(*groups)
+            rest = [column for column in columns if column not in grouped]
+            if rest:
+                groups.append(rest)
+        else:
+            # a group per compression profile, starting with the data columns' profile
+            by_profile = OrderedDict()
+            data_columns = [column for column in columns if column in self.data_columns]
+            if data_columns:
+                by_profile[self._column_profile(data_columns[0])] = data_columns
+            for column in columns:
+                if column not in self.data_columns:
+                    by_profile.setdefault(self._column_profile(column), []).append(column)
+            groups = list(by_profile.values())
+        if not set(self.data_columns) & set(columns) <= set(groups[0]):
+            raise TypeError('data_columns {} must all be in the first column group'.format(self.data_columns))
+        return groups
+
+    def _column_profile(self, column):
+        cols = {col.name: col for col in self.schema.cols}
+        return column_profile(self.compression, cols.get(column))
+
+    def _read_hdf(self, f, columns=None, where=None):
+        """Read the named columns (by default all of them), and the rows matching the where predicates."""
+        store = pandas.HDFStore(f, mode='r')
+        try:
+            if '/' + self.schema.name in store.keys():
+                layout_key = self.schema.name
+            else:
+                layout_key = self._group_key(0)
+            metadata = getattr(store.get_storer(layout_key).attrs, 'metadata', None) or {}
+            groups = metadata.get('column_groups')
+            data_columns = metadata.get('data_columns', [])
+
+            terms, residual = self._split_predicates(where or [], data_columns)
+            read_columns = None
+            if columns is not None:
+                read_columns = list(columns) + [p[0] for p in residual if p[0] not in columns]
+
+            if groups is not None:
+                keys = [self._group_key(i) for i, group in enumerate(groups)
+                        if i == 0 or read_columns is None or set(group) & set(read_columns)]
+                df = store.select_as_multiple(keys, where=terms or None, selector=keys[0], columns=read_columns)
+            elif store.get_storer(layout_key).is_table:
+                df = store.select(layout_key, where=terms or None, columns=read_columns)
+            else:
+                # fixed format can only be read whole
+                df = store[layout_key]
+                residual = where or []
+
+            if 'category_keys' in metadata:
+                col_categories = _read_categories(store, {col: key for col, key in metadata['category_keys'].items()
+                    if col in df.columns})
+            else: #written by earlier versions, with the labels in the metadata
+                col_categories = metadata.get('column_categories', {})
+        finally:
+            store.close()
 
         if self.encode_categoricals:
-            col_categories = store.get_storer(self.schema.name).attrs.metadata['column_categories']
             for col, categories in col_categories.items():
-                df[col] = pandas.Categorical.from_codes(df[col], categories, name=col)
+                if col in df.columns:
+                    df[col] = pandas.Categorical.from_codes(df[col], categories, name=col)
         else:
             for col in self.schema.cols:
-                if isinstance(col, cat):
-                    df[col.name].replace('nan', np.nan)
-        store.close()
+                if isinstance(col, cat) and col.name in df.columns:
+                    df[col.name] = df[col.name].replace('nan', np.nan)
+
+        if residual:
+            df = filter_df(df, residual)
+        # column groups come back one group after another, so put the columns back in schema order
+        df = df[[col.name for col in self.schema.cols if col.name in df.columns and (columns is None or col.name in columns)]]
         return df
 
+    def _split_predicates(self, where, data_columns):
+        """Split where into PyTables query terms, for the predicates on (non-categorical) data columns,
+        and the predicates that have to be applied after reading.
+        In PyTables, NaN and NaT (stored as the smallest int64) can match a comparison where a NULL would not
+        (NaN != x, NaT < x), so != is never pushed down, and < and <= on dt columns are also applied after reading."""
+        cols = {col.name: col for col in self.schema.cols}
+        pushable = {col.name for col in self.schema.cols
+                    if isinstance(col, (id_, num, dt, bool_)) and col.name in data_columns and col.name.isidentifier()}
+        terms = []
+        residual = []
+        for predicate in where:
+            col_name, op, value = predicate
+            term = None
+            if col_name in pushable and value is not None:
+                if op == 'in' and value and None not in value:
+                    term = '{} = [{}]'.format(col_name, ', '.join(_term_value(v) for v in value))
+                elif op in ('==', '<', '<=', '>', '>='):
+                    term = '{} {} {}'.format(col_name, op, _term_value(value))
+            if term is not None:
+                terms.append(term)
+            if term is None or (op in ('<', '<=') and isinstance(cols[col_name], dt)):
+                residual.append(predicate)
+        return terms, residual
+
     def _store_hdf(self, f, df):
-        store = pandas.HDFStore(f, complevel=9, complib='blosc')
+        store = pandas.HDFStore(f, mode='w', **compression_options(column_profile(self.compression)))
 
         col_categories = {}
         if self.encode_categoricals:
@@ -89,50 +199,164 @@ class HdfDataStore(DataStore):
                 col_categories[col] = df[col].cat.categories
                 df[col] = df[col].cat.codes
 
-        hdf_format = 'fixed' if self.fixed else 'table'
-        store.put(self.schema.name, df, format=hdf_format, dropna=False)
+        data_columns = [column for column in self.data_columns if column in df.columns]
+        metadata = {'column_groups': None, 'data_columns': []}
+        if self._grouped():
+            groups = self._groups(df.columns)
+            keys = [self._group_key(i) for i in range(len(groups))]
+            for i, (key, group) in enumerate(zip(keys, groups)):
+                # data columns are only indexed in the first group, which selects the rows of the others
+                store.append(key, df[group], data_columns=data_columns if i == 0 else None, dropna=False,
+                    **compression_options(self._column_profile(group[0])))
+            metadata['column_groups'] = groups
+            metadata['data_columns'] = data_columns
+            layout_key = keys[0]
+        elif self.fixed:
+            store.put(self.schema.name, df, format='fixed', dropna=False)
+            layout_key = self.schema.name
+        else:
+            store.put(self.schema.name, df, format='table', data_columns=data_columns, dropna=False)
+            metadata['data_columns'] = data_columns
+            layout_key = self.schema.name
 
-        if self.encode_categoricals:
-            store.get_storer(self.schema.name).attrs.metadata = {'column_categories': col_categories}
+        metadata['category_keys'] = _store_categories(store, self.schema.name + '_categories', col_categories)
+        store.get_storer(layout_key).attrs.metadata = metadata
 
         store.close()
 
-    def _load(self):
-        df = self._read_hdf(self.hdf_file)
-        for col in self.schema.cols:
-            if isinstance(col, big_dt):
-                # converting big_dt column
-                df[col.name] = df[col.name].map(datetime.datetime.fromtimestamp, na_action='ignore')
+    def _load(self, columns=None, where=None):
+        """Load the data. In table format, only the named columns are read, and where predicates on the data columns
+        are answered by PyTables; the other predicates are applied to what was read."""
+        df = self._read_hdf(self.hdf_file, columns, where)
         if df is None:
             return None
+        for col in self.schema.cols:
+            if isinstance(col, big_dt) and col.name in df.columns:
+                # converting big_dt column
+                df[col.name] = num_to_big_dt(df[col.name])
+        if where:
+            df = df.reset_index(drop=True)
         return df
 
+    ### chunk containers
+
+    def _chunk_container_file(self):
+        return self.hdf_file + '_chunks'
+
+    def _partial_chunk_container_file(self):
+        return self._chunk_container_file() + '.partial'
+
+    def _store_chunks(self, chunks):
+        """Store the chunks in one container file, as the nodes chunk_0, chunk_1, ... Each chunk node's attrs hold its
+        row count and the keys of the nodes holding its category labels, and the chunk_index table holds every chunk's
+        row count. The container is written under a temporary name and renamed into place once the last chunk is in,
+        so a container that exists is always complete."""
+        partial_file = self._partial_chunk_container_file()
+        store = pandas.HDFStore(partial_file, mode='w', **compression_options(column_profile(self.compression)))
+        try:
+            hdf_format = 'fixed' if self.fixed else 'table'
+            rows = []
+            for i, chunk in enumerate(chunks):
+                col_categories = {}
+                if self.encode_categoricals:
+                    for col in chunk.select_dtypes(include=['category']):
+                        col_categories[col] = chunk[col].cat.categories
+                        chunk[col] = chunk[col].cat.codes
+                key = _chunk_key(i)
+                store.put(key, chunk, format=hdf_format, dropna=False)
+                store.get_storer(key).attrs.metadata = {
+                    'category_keys': _store_categories(store, 'chunk_categories/' + key, col_categories),
+                    'rows': len(chunk)
+                }
+                rows.append(len(chunk))
+                del chunk
+            store.put('chunk_index', pandas.DataFrame({'rows': np.array(rows, dtype='int64')}), format='table')
+        except BaseException:
+            store.close()
+            with suppress(FileNotFoundError):
+                os.remove(partial_file)
+            raise
+        store.close()
+        os.replace(partial_file, self._chunk_container_file())
+        self._remove_legacy_chunks()
+
+    def chunk_index(self):
+        """The container's list of chunks, each a dict of key and rows."""
+        store = pandas.HDFStore(self._chunk_container_file(), mode='r')
+        try:
+            rows = store['chunk_index']['rows']
+        finally:
+            store.close()
+        return [{'key': _chunk_key(i), 'rows': int(n)} for i, n in enumerate(rows)]
+
+    def chunk_count(self):
+        store = pandas.HDFStore(self._chunk_container_file(), mode='r')
+        try:
+            return store.get_storer('chunk_index').nrows
+        finally:
+            store.close()
+
+    def _read_chunk(self, store, i):
+        key = _chunk_key(i)
+        df = store[key]
+        metadata = store.get_storer(key).attrs.metadata
+        if len(df) != metadata['rows']:
+            raise ValueError('chunk {} of {} has {} rows, expected {}'.format(
+                key, self._chunk_container_file(), len(df), metadata['rows']))
+        if self.encode_categoricals:
+            for col, categories in _read_categories(store, metadata['category_keys']).items():
+                df[col] = pandas.Categorical.from_codes(df[col], categories)
+        for col in self.schema.cols:
+            if isinstance(col, big_dt) and col.name in df.columns:
+                # converting big_dt column
+                df[col.name] = num_to_big_dt(df[col.name])
+        return df
+
+    def load_chunk(self, i):
+        """Load chunk i of the container, without reading the others."""
+        return HdfChunkDataStore(self, i).load()
+
     def chunk_stores(self):
+        """A DataStore per chunk. They can be pickled and loaded in other processes, so the chunks can be read in
+        parallel (see ParallelTransform)."""
+        if not os.path.isfile(self._chunk_container_file()):
+            # chunks stored one file per chunk by earlier versions
+            for f in self._legacy_chunk_files():
+                yield type(self)(self.schema, f, self.fixed, self.encode_categoricals, self.data_columns,
+                    self.column_groups, self.compression)
+            return
+        for i in range(self.chunk_count()):
+            yield HdfChunkDataStore(self, i)
+
+    def _load_chunks(self):
+        if not os.path.isfile(self._chunk_container_file()):
+            for store in self.chunk_stores():
+                yield store._load()
+            return
+        store = pandas.HDFStore(self._chunk_container_file(), mode='r')
+        try:
+            for i in range(store.get_storer('chunk_index').nrows):
+                yield self._read_chunk(store, i)
+        finally:
+            store.close()
+
+    def _legacy_chunk_files(self):
         for i in count():
             f = self._chunk_filename(i)
-
             if not os.path.isfile(f):
                 break
+            yield f
 
-            yield type(self)(self.schema, f, self.fixed, self.encode_categoricals)
-
-    def _load_chunks(self):
-        for store in self.chunk_stores():
-            chunk = store._load()
-            yield chunk
+    def _remove_legacy_chunks(self):
+        for f in list(self._legacy_chunk_files()):
+            with suppress(FileNotFoundError, IsADirectoryError):
+                os.remove(f)
 
     def _store(self, df):
         if len(df) == 0:
             raise ValueError("Cannot store an empty dataframe in HDF5 format.")
         
         self._store_hdf(self.hdf_file, df)
-       
-    def _store_chunks(self, chunks):
-        hdf_format = 'fixed' if self.fixed else 'table'
-        
-        for i, chunk in enumerate(chunks):
-            f = self._chunk_filename(i)
-            self._store_hdf(f, chunk)
 
     def exists(self):
         return os.path.isfile(self.hdf_file)
@@ -142,12 +366,51 @@ class HdfDataStore(DataStore):
             os.remove(self.hdf_file)
 
     def delete_chunks(self):
-        for i in count():
-            f = self._chunk_filename(i)
+        for f in [self._chunk_container_file(), self._partial_chunk_container_file()]:
+            with suppress(FileNotFoundError, IsADirectoryError):
+                os.remove(f)
+        self._remove_legacy_chunks()
 
-            if not os.path.isfile(f):
-                break
+class HdfChunkDataStore(DataStore):
+    """One chunk of an HdfDataStore's chunk container, see HdfDataStore.chunk_stores."""
+    def __init__(self, container, i):
+        self.container = container
+        self.i = i
+        super().__init__(container.schema)
 
-            with suppress(FileNotFoundError, IsADirectoryError):
-                os.remove(f)            
+    def storage_target(self):
+        return self.container.storage_target()
 
+    def _load(self):
+        store = pandas.HDFStore(self.container._chunk_container_file(), mode='r')
+        try:
+            return self.container._read_chunk(store, self.i)
+        finally:
+            store.close()
+
+    def exists(self):
+        return os.path.isfile(self.container._chunk_container_file())
+
+def _chunk_key(i):
+    return 'chunk_{}'.format(i)
+
+def _store_categories(store, prefix, col_categories):
+    """Store each column's category labels as a node under prefix, and return the dict of column name to node key.
+    Labels are kept out of node attrs, which HDF5 limits to 64KB."""
+    keys = {}
+    for j, (col, categories) in enumerate(col_categories.items()):
+        key = '{}/c{}'.format(prefix, j)
+        store.put(key, pandas.Series(categories), format='fixed')
+        keys[col] = key
+    return keys
+
+def _read_categories(store, category_keys):
+    return {col: store[key].values for col, key in category_keys.items()}
+
+def _term_value(value):
+    """value as it is written in a PyTables query term."""
+    if isinstance(value, (bool, np.bool_)):
+        return repr(float(value))
+    if isinstance(value, (int, float, np.number)):
+        return repr(value.item() if isinstance(value, np.generic) else value)
+    return repr(str(value))
@@ -0,0 +1,135 @@
+from chatto_transform.datastores.datastore_base import DataStore
+from chatto_transform.datastores import hdf_datastore #for storage target extensions
+from chatto_transform.schema.schema_base import *
+from chatto_transform.lib.big_dt_tools import num_to_big_dt
+from chatto_transform.lib import profiling
+
+from collections import OrderedDict
+from contextlib import suppress
+import os
+import os.path
+import pickle
+import shutil
+
+import numpy as np
+import pandas
+
+"""DataStore that keeps every column in its own .npy file, so the columns can be memory-mapped back in.
+
+Reading a range of rows only touches the pages for those rows, and the pages are shared between every
+process that maps the same files. This makes it a cheap way to hand data to worker processes
+(see ParallelTransform). Put the directory under /dev/shm to keep the data in POSIX shared memory
+instead of the page cache of a disk-backed file.
+
+Loads are not zero-copy: the mapped rows are copied into the blocks of the returned DataFrame, since pandas
+consolidates columns into blocks, and conform_df and transforms need writable data. Only the requested rows are
+read, and only once."""
+
+for col_type in [cat, id_, dt, delta, big_dt, num, bool_]:
+    col_type._storage_target_registry['memmap'] = col_type._storage_target_registry['hdf_enc'].copy()
+
+class UnmappableColumnError(TypeError):
+    """Raised when storing a column that can't be written to a .npy file and memory-mapped."""
+
+class MemmapDataStore(DataStore):
+    def __init__(self, schema, directory):
+        self.directory = directory
+        super().__init__(schema)
+
+    def storage_target(self):
+        return 'memmap'
+
+    def _meta_file(self):
+        return os.path.join(self.directory, '_meta.pickle')
+
+    def _column_file(self, i):
+        return os.path.join(self.directory, '{}.npy'.format(i))
+
+    def _index_file(self):
+        return os.path.join(self.directory, '_index.npy')
+
+    def _read_meta(self):
+        with open(self._meta_file(), 'rb') as f:
+            return pickle.load(f)
+
+    def nrows(self):
+        return self._read_meta()['nrows']
+
+    def store(self, df, order=None):
+        """Store df. If order is given (an array of row positions), rows are written in that order.
+        The reordering is done one column at a time, so df is never copied as a whole."""
+        with self._span('store') as span:
+            span.set_input(df)
+            df = self._conform_for_store(df)
+            self._store(df, order)
+            del df
+
+    def _store(self, df, order=None):
+        os.makedirs(self.directory, exist_ok=True)
+
+        def ordered(values):
+            if order is None:
+                return values
+            return values.take(order)
+
+        columns = list(df.columns)
+        col_categories = {}
+        for i, column in enumerate(columns):
+            col = df[column]
+            if hasattr(col, 'cat'):
+                col_categories[column] = col.cat.categories
+                values = col.cat.codes.values
+            else:
+                values = col.values
+                if values.dtype == 'object':
+                    raise UnmappableColumnError('Cannot memory-map object column {}'.format(column))
+            np.save(self._column_file(i), ordered(values))
+
+        index = df.index.values
+        if index.dtype == 'object':
+            index = np.arange(len(df))
+        np.save(self._index_file(), ordered(index))
+
+        # the meta file is written last, so exists() is only true for a complete store
+        with open(self._meta_file(), 'wb') as f:
+            pickle.dump({
+                'columns': columns,
+                'column_categories': col_categories,
+                'nrows': len(df)
+            }, f)
+
+    def load_rows(self, start=None, stop=None):
+        with self._span('load_rows') as span:
+            result = self._load(start, stop)
+            with profiling.span('conform', 'conform'):
+                self.schema.conform_df(result)
+            span.set_output(result)
+        return result
+
+    def _load(self, start=None, stop=None):
+        meta = self._read_meta()
+        rows = slice(start, stop)
+
+        data = OrderedDict()
+        for i, column in enumerate(meta['columns']):
+            values = np.load(self._column_file(i), mmap_mode='r')[rows]
+            if column in meta['column_categories']:
+                values = pandas.Categorical.from_codes(values, meta['column_categories'][column])
+            data[column] = values
+        index = np.load(self._index_file(), mmap_mode='r')[rows]
+
+        # building the frame copies the mapped rows into writable blocks
+        df = pandas.DataFrame(data, index=index, columns=meta['columns'])
+
+        for col in self.schema.cols:
+            if isinstance(col, big_dt):
+                # converting big_dt column
+                df[col.name] = num_to_big_dt(df[col.name])
+        return df
+
+    def exists(self):
+        return os.path.isfile(self._meta_file())
+
+    def delete(self):
+        with suppress(FileNotFoundError):
+            shutil.rmtree(self.directory)
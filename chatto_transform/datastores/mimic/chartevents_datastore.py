@@ -22,12 +22,7 @@ class CharteventsDataStore(AppendableHdfDataStore):
         df = store.select('chartevents', where=where, autoclose=True)
 
         for col in self._categorical_cols():
-            if self._any_categories(col):
-                print('loading categories for', col)
-                categories = self._load_categories(col)
-            else:
-                categories = []
-            df[col] = pd.Categorical.from_codes(df[col], categories=categories, name=col)
-        
+            df[col] = self._decode_categories(col, df[col])
+
         df = self._rename_df_from_hdf(df)
         return df
\ No newline at end of file
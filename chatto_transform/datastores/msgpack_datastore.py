@@ -1,7 +1,7 @@
 from chatto_transform.datastores.datastore_base import DataStore
 from chatto_transform.schema.schema_base import *
+from chatto_transform.lib.big_dt_tools import big_dt_to_num, num_to_big_dt
 
-import datetime
 import pandas
 
 for col_type in [dt, delta, big_dt, num, bool_]:
@@ -31,7 +31,7 @@ def _(col):
 
 @big_dt.register_transform('msgpack')
 def _(col):
-    return col.map(datetime.datetime.timestamp, na_action='ignore')
+    return big_dt_to_num(col)
 
 class MsgpackDataStore(DataStore):
     def __init__(self, schema, buf):
@@ -46,7 +46,7 @@ class MsgpackDataStore(DataStore):
         for col in self.schema.cols:
             if isinstance(col, big_dt):
                 # converting big_dt column
-                df[col.name] = df[col.name].map(datetime.datetime.fromtimestamp, na_action='ignore')
+                df[col.name] = num_to_big_dt(df[col.name])
 
         return df
 
@@ -55,7 +55,7 @@ class MsgpackDataStore(DataStore):
             for col in self.schema.cols:
                 if isinstance(col, big_dt):
                     # converting big_dt column
-                    chunk[col.name] = chunk[col.name].map(datetime.datetime.fromtimestamp, na_action='ignore')
+                    chunk[col.name] = num_to_big_dt(chunk[col.name])
             yield chunk
 
     def _store(self, df):
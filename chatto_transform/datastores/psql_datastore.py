@@ -4,8 +4,14 @@ import os
 import stat
 
 from chatto_transform.datastores.datastore_base import DataStore
-
-from psycopg2.extras import Json as psycopg2_json
+from chatto_transform.lib import profiling
+from chatto_transform.lib.chunks import from_chunks
+
+from collections import OrderedDict
+import json
+import numpy as np
+import queue
+import threading
 import time
 import io
 
@@ -101,11 +107,21 @@ def _(self):
 
 ##################################################################################
 
+#categories used to be stored as one json value per table. load_table_categories moves them into table_category_labels
 table_categories_schema = Schema('table_categories', [
     cat('table_name'),
     json_data('categories')
 ])
 
+#one row per category label. codes are assigned in order and never change, so new labels are only ever appended.
+#labels are stored as json, so they come back with the type they were stored with.
+category_labels_schema = Schema('table_category_labels', [
+    cat('table_name'),
+    cat('column_name'),
+    id_('code'),
+    json_data('label')
+])
+
 def get_df_categories(df, schema):
     col_categories = {}
     for col in schema.cols:
@@ -113,36 +129,105 @@ def get_df_categories(df, schema):
             col_categories[col.name] = df[col.name].cat.categories.tolist()
     return col_categories
 
-def load_table_categories(name, engine):
-    if not engine.has_table('table_categories'):
-        create_table(engine, table_categories_schema)
-
-    query = """SELECT * from table_categories WHERE table_name = '{}'""".format(name)
-    result = engine.execute(query)
-    row = result.first()
-    if row is None:
-        return {}
-    return row[1]
-
+#database urls where table_category_labels is known to exist, so it is only created once per database
+_category_labels_databases = set()
+
+def create_category_labels_table(engine):
+    if str(engine.url) in _category_labels_databases:
+        return
+    engine.execute("""CREATE TABLE IF NOT EXISTS table_category_labels (
+        table_name TEXT NOT NULL,
+        column_name TEXT NOT NULL,
+        code INT NOT NULL,
+        label JSON,
+        PRIMARY KEY (table_name, column_name, code)
+    )""")
+    _category_labels_databases.add(str(engine.url))
+
+def _category_label_chunks(name, categories, n_known=None):
+    """DataFrames of the category_labels_schema rows for the labels of each column after the first n_known[col]."""
+    for col, labels in categories.items():
+        start = (n_known or {}).get(col, 0)
+        new_labels = labels[start:]
+        if not new_labels:
+            continue
+        yield pandas.DataFrame({
+            'table_name': name,
+            'column_name': col,
+            'code': np.arange(start, len(labels)),
+            'label': [json.dumps(label) for label in new_labels]
+        }, columns=category_labels_schema.col_names())
+
+#(database url, table name) of the tables whose legacy categories have been looked for, so it is only done once
+_migrated_tables = set()
+
+def _migrate_table_categories(name, engine):
+    """Move the categories of table name from the legacy json table_categories table into table_category_labels.
+    Returns the categories, or None if there were none to move. Only looks once per table and database."""
+    key = (str(engine.url), name)
+    if key in _migrated_tables:
+        return None
+    row = None
+    if engine.has_table('table_categories'):
+        row = engine.execute("""SELECT categories FROM table_categories WHERE table_name = %s""", name).first()
+    if row is not None:
+        print('moving categories of', name, 'out of table_categories')
+        store_table_categories(name, row[0], engine)
+        engine.execute("""DELETE FROM table_categories WHERE table_name = %s""", name)
+    _migrated_tables.add(key)
+    return row[0] if row is not None else None
+
+def load_table_categories(name, engine, columns=None):
+    """Load the categories of table name, as a dict of column name to list of labels (ordered by code).
+    If columns is given (e.g. the categorical columns of the table's schema), only the categories of those columns are
+    loaded, and every one of them is in the dict, with no labels if none are stored (e.g. a column of only NULLs)."""
+    create_category_labels_table(engine)
+
+    query = """SELECT column_name, label FROM table_category_labels WHERE table_name = %s"""
+    params = [name]
+    if columns is not None:
+        if not columns:
+            return {}
+        query += """ AND column_name IN %s"""
+        params.append(tuple(columns))
+    query += """ ORDER BY column_name, code"""
+
+    categories = {col: [] for col in columns or []}
+    for column_name, label in engine.execute(query, *params):
+        categories.setdefault(column_name, []).append(label)
+
+    if not any(categories.values()):
+        legacy_categories = _migrate_table_categories(name, engine)
+        if legacy_categories is not None:
+            categories.update((col, labels) for col, labels in legacy_categories.items() if columns is None or col in columns)
+    return categories
 
 def store_table_categories(name, categories, engine):
-    if not engine.has_table('table_categories'):
-        create_table(engine, table_categories_schema)
-    
-    update = """UPDATE table_categories SET categories = %s WHERE table_name = %s"""
-    result = engine.execute(update, psycopg2_json(categories), name)
-    if not result.rowcount:
-        insert = """INSERT INTO table_categories (table_name, categories) VALUES (%s, %s)"""
-        engine.execute(insert, name, psycopg2_json(categories))
+    """Replace the categories of table name."""
+    create_category_labels_table(engine)
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""DELETE FROM table_category_labels WHERE table_name = %s""", [name])
+            copy_chunks_to_table(cur, _category_label_chunks(name, categories), category_labels_schema)
+        conn.commit()
+    finally:
+        conn.close()
+
+def append_table_categories(name, categories, n_known, engine):
+    """Store the labels of table name that were appended to categories after the first n_known[col] of each column,
+    which are already stored."""
+    create_category_labels_table(engine)
+    fast_chunks_to_sql(_category_label_chunks(name, categories, n_known), engine, category_labels_schema)
 
 def merge_categories(cat1, cat2):
+    """Append the categories in cat2 that are not in cat1 to cat1's, in the order they appear in cat2.
+    Categories are never removed or reordered, so codes already written against cat1 stay valid."""
     merged = {}
     for col in (cat1.keys() | cat2.keys()):
         c1 = cat1.get(col, [])
-        c2 = cat2.get(col, [])
-        new = set(c2).difference(set(c1))
-
-        merged[col] = c1 + list(new)
+        known = set(c1)
+        merged[col] = c1 + [c for c in cat2.get(col, []) if c not in known]
     return merged
 
 def update_df_categories(df, categories):
@@ -152,73 +237,262 @@ def update_df_categories(df, categories):
     return df
 
 def hydrate_categories(df, categories):
-    df = df.copy()
+    """Replace the code columns of df with categoricals, in place. Missing codes (NULL or -1) become NaN.
+    Every column in categories is replaced, including those with no labels, whose values all become NaN."""
     for col in categories:
-        codes = df[col].astype('float64').fillna(-1).astype('int64')
-        df[col] = pandas.Categorical.from_codes(codes, categories=categories[col], name=col)
+        codes = df[col].values
+        if codes.dtype.kind == 'f':
+            present = ~np.isnan(codes)
+            int_codes = np.full(len(codes), -1, dtype='int64')
+            int_codes[present] = codes[present]
+            codes = int_codes
+        df[col] = pandas.Categorical.from_codes(codes, categories=categories[col])
     return df
 
-def fast_df_to_csv(df, f, schema):
-    start = time.time()
-    df = df.copy()
-    df.to_csv(f, index=False, date_format="%Y-%m-%d %H:%M:%S")
-    end = time.time()
-    print('took', end - start, 'seconds to convert to csv')
+_end_of_copy = object()
+
+def _queue_put(blocks, item, cancelled):
+    """Put item on the queue, waiting for space unless the other side has gone away. Returns False if it has."""
+    while not cancelled.is_set():
+        try:
+            blocks.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+##################################################################################
 
-def df_chunks(df, chunksize=65536):
-    steps = list(range(0, len(df), chunksize))
-    if steps[-1] != len(df):
-        steps.append(len(df))
+COPY_ROWS = 65536 #rows encoded to csv at a time when streaming a DataFrame into postgres
+
+def df_chunks(df, chunksize=COPY_ROWS):
+    steps = list(range(0, len(df), chunksize)) + [len(df)]
     for start, stop in zip(steps, steps[1:]):
         yield df.iloc[start:stop]
 
-def fast_df_to_sql(df, engine, psql_schema):
-    convert_id_columns_to_type(engine, psql_schema, 'NUMERIC')
+def _ids_as_ints(col):
+    """Float id column as integers, with None for missing values, so it is written to csv as 1 rather than 1.0"""
+    values = col.values
+    missing = np.isnan(values)
+    if not missing.any():
+        return pandas.Series(values.astype('int64'), index=col.index)
+    ints = np.empty(len(values), dtype='object') #filled with None
+    ints[~missing] = values[~missing].astype('int64')
+    return pandas.Series(ints, index=col.index)
+
+def _copy_csv_frame(df, psql_schema):
+    """df as it is written to the COPY csv: in table column order, with categoricals as their codes and ids as integers."""
+    data = OrderedDict()
+    for col in psql_schema.cols:
+        values = df[col.name]
+        if hasattr(values, 'cat'):
+            values = values.cat.codes
+        elif isinstance(col, id_) and values.dtype == 'float64':
+            values = _ids_as_ints(values)
+        data[col.name] = values
+    return pandas.DataFrame(data, columns=psql_schema.col_names())
+
+def fast_df_to_csv(df, f, psql_schema):
+    _copy_csv_frame(df, psql_schema).to_csv(f, index=False, header=False, date_format="%Y-%m-%d %H:%M:%S")
+
+class _CopyChunkReader:
+    """File-like source for cursor.copy_expert('COPY ... FROM STDIN') that reads the blocks of csv put on a queue
+    by the encoding thread."""
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.block = b''
+        self.pos = 0
+        self.done = False
+        self.error = None
+
+    def read(self, size=-1):
+        while self.pos >= len(self.block):
+            if self.done:
+                return b''
+            block = self.blocks.get()
+            if block is _end_of_copy:
+                self.done = True
+                return b''
+            if isinstance(block, Exception):
+                self.error = block
+                raise block
+            self.block = block
+            self.pos = 0
+        if size is None or size < 0:
+            size = len(self.block) - self.pos
+        data = self.block[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+def copy_chunks_to_table(cur, chunks, psql_schema):
+    """Stream the chunks into the existing table with COPY, using cursor cur. The chunks are encoded to csv
+    in a background thread, a few thousand rows at a time, while the blocks encoded before them are sent to the server.
+    Note that the chunks iterable is consumed in that thread."""
+    blocks = queue.Queue(maxsize=4)
+    cancelled = threading.Event()
+
+    def encode():
+        try:
+            for chunk in chunks:
+                for rows in df_chunks(chunk):
+                    with profiling.span('psql.encode_block', table=psql_schema.name) as span:
+                        span.set_input(rows)
+                        f = io.StringIO()
+                        fast_df_to_csv(rows, f, psql_schema)
+                        block = f.getvalue().encode('utf-8')
+                        del f
+                    if not _queue_put(blocks, block, cancelled):
+                        return
+                del chunk
+            _queue_put(blocks, _end_of_copy, cancelled)
+        except Exception as e:
+            _queue_put(blocks, e, cancelled)
+
+    encoder = threading.Thread(target=encode, daemon=True)
+    encoder.start()
+    reader = _CopyChunkReader(blocks)
+    try:
+        sql = "COPY {table_name} FROM STDIN WITH (FORMAT CSV)".format(table_name=psql_schema.name)
+        with profiling.span('psql.copy_from', table=psql_schema.name):
+            cur.copy_expert(sql, reader, size=2**20)
+    except Exception:
+        if reader.error is not None: #report what went wrong encoding the chunks, rather than the aborted COPY
+            raise reader.error
+        raise
+    finally:
+        cancelled.set()
+        encoder.join()
+
+def fast_chunks_to_sql(chunks, engine, psql_schema):
     conn = engine.raw_connection()
-    with conn.cursor() as cur:
-        with io.StringIO() as f:
-            print('converting df to csv')
-            fast_df_to_csv(df, f, psql_schema)
-            
-            print('copying csv into db')
-            f.seek(0)
-            sql = "COPY {table_name} FROM STDIN WITH (FORMAT CSV, HEADER TRUE)".format(
-                table_name=psql_schema.name)
-            cur.copy_expert(sql, f)
-    conn.commit()
-    convert_id_columns_to_type(engine, psql_schema, 'INT')
-
-def convert_id_columns_to_type(engine, psql_schema, new_type):
-    query = """ALTER TABLE {table} {alter_cols}"""
-    alter_cols = []
+    try:
+        with conn.cursor() as cur:
+            copy_chunks_to_table(cur, chunks, psql_schema)
+        conn.commit()
+    finally:
+        conn.close()
+
+def fast_df_to_sql(df, engine, psql_schema):
+    fast_chunks_to_sql([df], engine, psql_schema)
+
+##################################################################################
+
+COPY_BLOCK_SIZE = 2**26 #bytes of csv parsed at a time when streaming a table out of postgres
+
+class _CopyBlockWriter:
+    """File-like target for cursor.copy_expert('COPY ... TO STDOUT') that gathers the rows written to it into blocks
+    of about blocksize bytes, and puts the blocks on a queue. libpq hands out COPY data one whole row at a time,
+    so blocks always end on a row boundary, even when quoted values contain newlines."""
+    def __init__(self, blocks, cancelled, blocksize):
+        self.blocks = blocks
+        self.cancelled = cancelled
+        self.blocksize = blocksize
+        self.parts = []
+        self.size = 0
+
+    def put(self, item):
+        return _queue_put(self.blocks, item, self.cancelled)
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.parts.append(data)
+        self.size += len(data)
+        if self.size >= self.blocksize:
+            self.flush()
+
+    def flush(self):
+        if not self.parts:
+            return
+        block = b''.join(self.parts)
+        self.parts = []
+        self.size = 0
+        if not self.put(block):
+            raise IOError('COPY cancelled by reader')
+
+def _copy_csv_dtypes(psql_schema, encode_categoricals):
+    """read_csv dtypes of the COPY csv columns. id_ columns are left to parse as int64, or as float64 in blocks with
+    missing values (from_chunks promotes the other blocks to match), as the pandas id_ transform would."""
+    dtypes = {}
     for col in psql_schema.cols:
-        if isinstance(col, id_):
-            print('converting column', col.name, 'to', new_type)
-            alter_col_sql = 'ALTER COLUMN "{col}" TYPE {type}'.format(col=col.name, type=new_type)
-            alter_cols.append(alter_col_sql)
-    alter_cols_sql = ', '.join(alter_cols)
-    engine.execute(query.format(table=psql_schema.name, alter_cols=alter_cols_sql))
-
-def fast_sql_to_df(engine, psql_schema):
+        if isinstance(col, (num, bool_)):
+            dtypes[col.name] = 'float64'
+        elif isinstance(col, cat):
+            dtypes[col.name] = 'float64' if encode_categoricals else 'object'
+    return dtypes
+
+def _parse_copy_block(block, psql_schema, dtypes):
+    names = psql_schema.col_names()
+    if block:
+        df = pandas.read_csv(io.BytesIO(block), header=None, names=names, dtype=dtypes)
+    else:
+        empty_dtypes = {col.name: 'int64' for col in psql_schema.cols if isinstance(col, id_)}
+        empty_dtypes.update(dtypes)
+        df = pandas.DataFrame({name: pandas.Series([], dtype=empty_dtypes.get(name, 'object')) for name in names}, columns=names)
+    for col in psql_schema.cols:
+        if isinstance(col, dt):
+            df[col.name] = pandas.to_datetime(df[col.name], format="%Y-%m-%d %H:%M:%S", coerce=True)
+    return df
+
+def fast_sql_to_df_chunks(engine, psql_schema, encode_categoricals=True, blocksize=COPY_BLOCK_SIZE):
+    """Stream the table out of postgres as DataFrames parsed from blocks of about blocksize bytes of csv.
+    The COPY runs in a background thread, so the server keeps sending rows while the previous block is parsed,
+    and at most a few blocks of csv are held in memory at once. Chunks are indexed by their row position in the table."""
+    blocks = queue.Queue(maxsize=2)
+    cancelled = threading.Event()
+    writer = _CopyBlockWriter(blocks, cancelled, blocksize)
+    sql = "COPY {table_name} TO STDOUT WITH (FORMAT CSV)".format(table_name=psql_schema.name)
     conn = engine.raw_connection()
-    with conn.cursor() as cur:
-        with io.StringIO() as f:
-            start = time.time()
-            print('copying table to csv')
-            sql = "COPY {table_name} TO STDOUT WITH (FORMAT CSV, HEADER TRUE)".format(
-                table_name=psql_schema.name)
-            cur.copy_expert(sql, f)
-
-            print('reading csv into df')
-            f.seek(0)
-            df = pandas.read_csv(f)
-            print('converting date columns')
-            for col in psql_schema.cols:
-                if isinstance(col, dt):
-                    print('converting datetime column', col.name)
-                    df[col.name] = pandas.to_datetime(df[col.name], format="%Y-%m-%d %H:%M:%S", coerce=True)
-            end = time.time()
-            print('finished loading table in', end - start, 'seconds')
+
+    def copy():
+        try:
+            with conn.cursor() as cur:
+                cur.copy_expert(sql, writer)
+            writer.flush()
+            writer.put(_end_of_copy)
+        except Exception as e:
+            writer.put(e)
+
+    dtypes = _copy_csv_dtypes(psql_schema, encode_categoricals)
+    copy_thread = threading.Thread(target=copy, daemon=True)
+    copy_thread.start()
+    finished = False
+    try:
+        start_row = 0
+        while True:
+            block = blocks.get()
+            if block is _end_of_copy:
+                break
+            if isinstance(block, Exception):
+                raise block
+            with profiling.span('psql.parse_block', table=psql_schema.name) as span:
+                chunk = _parse_copy_block(block, psql_schema, dtypes)
+                span.set_output(chunk)
+            del block
+            chunk.index = pandas.Index(np.arange(start_row, start_row + len(chunk)))
+            start_row += len(chunk)
+            yield chunk
+            del chunk
+        finished = True
+        if start_row == 0:
+            yield _parse_copy_block(b'', psql_schema, dtypes)
+    finally:
+        cancelled.set()
+        copy_thread.join()
+        if finished:
+            conn.close()
+        else:
+            # the COPY was abandoned part way through, so the connection can't be reused
+            conn.invalidate()
+
+def fast_sql_to_df(engine, psql_schema, encode_categoricals=True):
+    start = time.time()
+    print('streaming table', psql_schema.name, 'out of postgres')
+    with profiling.span('psql.copy_to', table=psql_schema.name) as span:
+        df = from_chunks(fast_sql_to_df_chunks(engine, psql_schema, encode_categoricals))
+        span.set_output(df)
+    end = time.time()
+    print('finished loading table in', end - start, 'seconds')
     return df
 
 def create_table(engine, psql_schema, encode_categoricals=True):
@@ -242,6 +516,23 @@ def create_indexes(engine, psql_schema):
             s_col = pandas_name_to_psql(s)
             engine.execute('CREATE INDEX ON "{}" ("{}" DESC)'.format(psql_schema.name, s_col))
 
+def create_unique_index(engine, psql_schema, index_col):
+    """Create the unique index on index_col that INSERT ... ON CONFLICT needs, unless it already exists.
+    Returns False, without creating it, if the table already holds duplicate values of index_col."""
+    table = psql_schema.name
+    index_name = '{}_{}_key'.format(table, index_col)
+    exists = engine.execute("""SELECT 1 FROM pg_indexes WHERE tablename = %s AND indexname = %s""",
+        table, index_name).first()
+    if exists is not None:
+        return True
+    duplicate = engine.execute('SELECT 1 FROM "{table}" WHERE "{col}" IS NOT NULL GROUP BY "{col}" HAVING count(*) > 1 LIMIT 1'.format(
+        table=table, col=index_col)).first()
+    if duplicate is not None:
+        return False
+    engine.execute('CREATE UNIQUE INDEX IF NOT EXISTS "{index_name}" ON "{table}" ("{col}")'.format(
+        index_name=index_name, table=table, col=index_col))
+    return True
+
 def drop_table(engine, psql_schema):
     engine.execute('DROP TABLE "{}"'.format(psql_schema.name))
 
@@ -253,7 +544,24 @@ class PSqlDataStore(DataStore):
         super().__init__(schema)
         self.psql_schema = psql_rename_schema(self.schema)
 
+    def storage_target(self):
+        # encoded categoricals are kept as categoricals until they are written, when they are replaced by their codes
+        return 'pandas' if self.encode_categoricals else 'psql'
+
+    def _rename_df_to_psql(self, df):
+        """Rename df's columns to their psql names. Only reorders (and so copies) the columns when they are
+        not already in schema order, otherwise the column data is shared with df."""
+        if list(df.columns) != self.schema.col_names():
+            df = df[self.schema.col_names()]
+        else:
+            df = df.copy(deep=False)
+        df.columns = self.psql_schema.col_names()
+        return df
+
     def _load(self):
+        return from_chunks(self._load_chunks())
+
+    def _load_chunks(self):
         if self.load_where_conditions is not None:
             temp_name = 't_'+self.psql_schema.name
             temp_schema = Schema.rename(self.psql_schema, temp_name)
@@ -270,56 +578,152 @@ class PSqlDataStore(DataStore):
 
                 self.engine.execute(insert_query)
 
-                df = fast_sql_to_df(self.engine, temp_schema)
+                yield from self._table_chunks(temp_schema)
             finally:
                 drop_table(self.engine, temp_schema)
-        else:    
-            df = fast_sql_to_df(self.engine, self.psql_schema)
+        else:
+            yield from self._table_chunks(self.psql_schema)
+
+    def _cat_cols(self):
+        return [col.name for col in self.psql_schema.cols if isinstance(col, cat)]
 
+    def _table_chunks(self, psql_schema):
         if self.encode_categoricals:
-            categories = load_table_categories(self.psql_schema.name, self.engine)
-            df = hydrate_categories(df, categories)
+            cat_cols = [col.name for col in psql_schema.cols if isinstance(col, cat)]
+            categories = load_table_categories(self.psql_schema.name, self.engine, columns=cat_cols)
 
-        df = df[self.psql_schema.col_names()]
-        df.columns = self.schema.col_names()
-        return df
+        for chunk in fast_sql_to_df_chunks(self.engine, psql_schema, self.encode_categoricals):
+            if self.encode_categoricals:
+                chunk = hydrate_categories(chunk, categories)
+            chunk.columns = self.schema.col_names()
+            yield chunk
+            del chunk
 
     def _store(self, df):
         """Store df to table in the db. If the table already exists it is replaced."""
+        self._store_chunks([df])
+
+    def _store_chunks(self, chunks):
+        """Store the chunks to table in the db, streaming each one to the server as it is encoded.
+        If the table already exists it is replaced."""
         start = time.time()
-        df = df.copy()
-        
+
         if self.engine.has_table(self.psql_schema.name):
             drop_table(self.engine, self.psql_schema)
-        
-        df = df[self.schema.col_names()]
-        df.columns = self.psql_schema.col_names()
 
+        create_table(self.engine, self.psql_schema, encode_categoricals=self.encode_categoricals)
+
+        categories = {}
+        fast_chunks_to_sql(self._prepare_chunks(chunks, categories), self.engine, self.psql_schema)
         if self.encode_categoricals:
-            categories = get_df_categories(df, self.psql_schema)
             store_table_categories(self.psql_schema.name, categories, self.engine)
-
-        create_table(self.engine, self.psql_schema, encode_categoricals=self.encode_categoricals)
-        fast_df_to_sql(df, self.engine, self.psql_schema)
         create_indexes(self.engine, self.psql_schema)
         end = time.time()
-        print('took', end - start, 'seconds to store df in postgres and create indexes on it')
-            
-    def _update(self, new_df):
-        start = time.time()
-        new_df = new_df[self.schema.col_names()]
-        new_df.columns = self.psql_schema.col_names()
+        print('took', end - start, 'seconds to store data in postgres and create indexes on it')
+
+    def _prepare_chunks(self, chunks, categories):
+        """Rename the chunks' columns to their psql names. With encode_categoricals, any new categories in the chunks
+        are appended to categories (in place), and the chunks are recoded against it."""
+        for chunk in chunks:
+            chunk = self._rename_df_to_psql(chunk)
+            if self.encode_categoricals:
+                chunk_categories = get_df_categories(chunk, self.psql_schema)
+                categories.update(merge_categories(categories, chunk_categories))
+                if any(chunk_categories[col] != categories[col] for col in chunk_categories):
+                    chunk = update_df_categories(chunk, categories)
+            yield chunk
+            del chunk
 
+    def _update(self, new_df):
+        self._update_chunks([new_df])
+
+    def _update_chunks(self, chunks):
+        """Insert the rows in the chunks into the table, replacing the existing rows that have the same value in the
+        schema's index column. If an index value is repeated in the chunks, the last row with it wins.
+        On PostgreSQL 9.5 and later this is a single INSERT ... ON CONFLICT pass, otherwise, or if the table already
+        holds duplicate index values (so the unique index ON CONFLICT needs can't be created), each chunk is applied
+        with an UPDATE followed by an INSERT of the new rows."""
         if not self.engine.has_table(self.psql_schema.name):
-            self._store(new_df, index, sort)
+            self._store_chunks(chunks)
             return
 
+        conn = self.engine.raw_connection()
+        try:
+            server_version = conn.server_version
+        finally:
+            conn.close()
+
+        index = self.psql_schema.options['index']
+        if server_version >= 90500 and create_unique_index(self.engine, self.psql_schema, index):
+            self._upsert_chunks(chunks)
+        else:
+            if server_version >= 90500:
+                print('table', self.psql_schema.name, 'has duplicate values of', index, '- updating without upsert')
+            for chunk in chunks:
+                self._update_legacy(self._rename_df_to_psql(chunk))
+
+    def _upsert_chunks(self, chunks):
+        start = time.time()
+        table = self.psql_schema.name
+        index = self.psql_schema.options['index']
+        temp_schema = Schema.rename(self.psql_schema, 't_'+table)
+
+        categories = {}
+        if self.encode_categoricals:
+            categories = load_table_categories(table, self.engine, columns=self._cat_cols())
+        n_categories = {col: len(labels) for col, labels in categories.items()}
+
+        conn = self.engine.raw_connection()
+        try:
+            with conn.cursor() as cur:
+                print('streaming new rows into psql temp table')
+                cur.execute('CREATE TEMP TABLE "{temp}" (LIKE "{table}") ON COMMIT DROP'.format(
+                    temp=temp_schema.name, table=table))
+                copy_chunks_to_table(cur, self._prepare_chunks(chunks, categories), temp_schema)
+                temp_tab_loaded = time.time()
+
+                if any(len(labels) != n_categories.get(col, 0) for col, labels in categories.items()):
+                    # categories are only appended to, so it is safe to store them before the rows that use them
+                    append_table_categories(table, categories, n_categories, self.engine)
+
+                print('upserting rows from temp into existing table')
+                set_exprs = ['"{col}" = EXCLUDED."{col}"'.format(col=col)
+                    for col in self.psql_schema.col_names() if col != index]
+                if set_exprs:
+                    on_conflict = 'DO UPDATE SET ' + ', '.join(set_exprs)
+                else:
+                    on_conflict = 'DO NOTHING'
+                # ON CONFLICT can't touch a row twice, so only the last copied row of each index value is upserted.
+                # ctid follows the order rows were copied in, as nothing else writes to the temp table
+                upsert = """INSERT INTO "{table}"
+                    SELECT * FROM (SELECT DISTINCT ON ("{index}") * FROM "{temp}" WHERE "{index}" IS NOT NULL
+                        ORDER BY "{index}", ctid DESC) AS latest
+                    UNION ALL SELECT * FROM "{temp}" WHERE "{index}" IS NULL
+                    ON CONFLICT ("{index}") {on_conflict}""".format(
+                    table=table,
+                    temp=temp_schema.name,
+                    index=index,
+                    on_conflict=on_conflict)
+                cur.execute(upsert)
+                upserted = cur.rowcount
+            conn.commit()
+        finally:
+            conn.close()
+        tab_upserted = time.time()
+
+        print('took', temp_tab_loaded - start, 'seconds to create and load temp table')
+        print('took', tab_upserted - temp_tab_loaded, 'seconds to upsert', upserted, 'rows into table')
+
+    def _update_legacy(self, new_df):
+        start = time.time()
+
         if self.encode_categoricals:
-            old_categories = load_table_categories(self.psql_schema.name, self.engine)
+            old_categories = load_table_categories(self.psql_schema.name, self.engine, columns=self._cat_cols())
             new_categories = get_df_categories(new_df, self.psql_schema)
             merged_categories = merge_categories(old_categories, new_categories)
             new_df = update_df_categories(new_df, merged_categories)
-            store_table_categories(self.psql_schema.name, merged_categories, self.engine)
+            n_known = {col: len(labels) for col, labels in old_categories.items()}
+            append_table_categories(self.psql_schema.name, merged_categories, n_known, self.engine)
         
         temp_name = 't_'+self.psql_schema.name
         temp_schema = Schema.rename(self.psql_schema, temp_name)
@@ -3,8 +3,12 @@ from chatto_transform.schema.schema_base import *
 from chatto_transform.datastores.datastore_base import DataStore
 from chatto_transform.datastores.csv_datastore import CsvDataStore
 from chatto_transform.datastores.odo_datastore import OdoDataStore
+from chatto_transform.lib.chunks import from_chunks
+from chatto_transform.lib import profiling
 
-from functools import lru_cache, partial
+from functools import partial
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from sqlalchemy import Table, MetaData, select
 from sqlalchemy.orm import sessionmaker
@@ -12,26 +16,46 @@ from sqlalchemy.ext.automap import automap_base
 
 from sqlalchemy import create_engine
 from sqlalchemy.ext.compiler import compiles
-from sqlalchemy.sql.expression import Select, and_
+from sqlalchemy.sql.expression import Select, TextClause, and_, or_
+from sqlalchemy.sql.compiler import Compiled
+from sqlalchemy import func
 from sqlalchemy import sql
 
+import gzip
 import io
+import operator
+import threading
 import tempfile
 import time
 import os
 import datetime
 import odo
 
-metadatas = {}
+MAX_ENGINES = 8 #number of engines whose metadata and tables are kept
 
-def get_engine_metadata(engine):
-    if engine in metadatas:
-        return metadatas[engine]
-    else:
+#engine -> (metadata, {schema: table}), least recently used first
+_engine_caches = OrderedDict()
+_engine_caches_lock = threading.RLock()
+
+def _engine_cache(engine):
+    with _engine_caches_lock:
+        if engine in _engine_caches:
+            _engine_caches.move_to_end(engine)
+            return _engine_caches[engine]
         metadata = MetaData()
         metadata.bind = engine
-        metadatas[engine] = metadata
-        return metadata
+        _engine_caches[engine] = (metadata, {})
+        while len(_engine_caches) > MAX_ENGINES:
+            _engine_caches.popitem(last=False)
+        return _engine_caches[engine]
+
+def get_engine_metadata(engine):
+    return _engine_cache(engine)[0]
+
+def forget_engine(engine):
+    """Drop the metadata and tables kept for engine, e.g. when it is disposed."""
+    with _engine_caches_lock:
+        _engine_caches.pop(engine, None)
 
 def get_reflected_metadata(engine, schema_name=None):
     metadata = MetaData()
@@ -92,17 +116,23 @@ def _(self):
 
 ########################################################################
 
-@lru_cache()
 def schema_as_table(schema, engine):
-    if schema.options.get('temporary', False):
-        prefixes = ['TEMPORARY']
-    else:
-        prefixes = []
+    """The Table for schema in engine's metadata. Tables are kept until the engine is forgotten (see forget_engine)."""
+    with _engine_caches_lock:
+        metadata, tables = _engine_cache(engine)
+        if schema in tables:
+            return tables[schema]
+
+        if schema.options.get('temporary', False):
+            prefixes = ['TEMPORARY']
+        else:
+            prefixes = []
 
-    db_schema = schema.options.get('db_schema', None)
-    metadata = get_engine_metadata(engine)
+        db_schema = schema.options.get('db_schema', None)
 
-    return Table(schema.name, metadata, *[col.metadata('sqlalchemy') for col in schema.cols], schema=db_schema, prefixes=prefixes)
+        table = Table(schema.name, metadata, *[col.metadata('sqlalchemy') for col in schema.cols], schema=db_schema, prefixes=prefixes)
+        tables[schema] = table
+        return table
 
 sa_type_2_col_type = {
     sql.sqltypes.Integer: num,
@@ -188,14 +218,28 @@ def fast_mysql_to_df(table, schema):
     #         df[col.name] = df[col.name].map(parse_func, na_action='ignore')
     return df
 
+def copy_source(table, cur):
+    """The table name, or for a query the parenthesised query, to COPY from.
+    Compiled queries (see SAQueryDataStore) and text are rendered as they are. COPY can't take bind parameters, so
+    other queries are compiled with them, and psycopg2 renders their values in with the cursor's mogrify, which
+    handles the values (e.g. datetimes in dt predicates) that sqlalchemy's literal_binds can't."""
+    if isinstance(table, Table):
+        return str(table)
+    if isinstance(table, (Compiled, TextClause)):
+        return '({})'.format(table)
+    compiled = table.compile(bind=table.bind)
+    sql = str(compiled)
+    if compiled.params:
+        from psycopg2.extensions import encodings
+        sql = cur.mogrify(sql, compiled.params).decode(encodings[cur.connection.encoding])
+    return '({})'.format(sql)
+
 def fast_postgresql_to_df(table, schema):
     engine = table.bind
     conn = engine.raw_connection()
     with conn.cursor() as cur:
         with io.StringIO() as f:
-            table_name = str(table)
-            if not isinstance(table, Table):
-                table_name = '({})'.format(table_name)
+            table_name = copy_source(table, cur)
             sql = "COPY {table_name} TO STDOUT WITH (FORMAT CSV, HEADER TRUE)".format(
                 table_name=table_name)
             cur.copy_expert(sql, f)
@@ -205,63 +249,128 @@ def fast_postgresql_to_df(table, schema):
             csv_loader = CsvDataStore(schema, f, with_header=True)
             df = csv_loader.load()
             #df = pandas.read_csv(f)
-            for col in schema.cols:
-                if isinstance(col, dt):
-                    # converting datetime column
-                    df[col.name] = pandas.to_datetime(df[col.name], format="%Y-%m-%d %H:%M:%S", coerce=True)
-                if isinstance(col, big_dt):
-                    # converting big_dt column
-                    strptime = datetime.datetime.strptime
-                    parse_func = (lambda x: strptime(x, "%Y-%m-%d %H:%M:%S"))
-                    df[col.name] = df[col.name].map(parse_func, na_action='ignore')
+            # dt and big_dt columns are parsed by the CsvDataStore
     return df
 
-def fast_postgresql_to_csv(table, file_path):
+def fast_postgresql_to_csv(table, file_path, compress=False):
+    """COPY the rows of table straight into a csv file, gzipped if compress is set."""
     engine = table.bind
     conn = engine.raw_connection()
+    if compress:
+        open_file = lambda: gzip.open(file_path, 'wt', encoding='utf-8')
+    else:
+        open_file = lambda: open(file_path, 'w', encoding='utf-8')
     with conn.cursor() as cur:
-        with open(file_path, 'w', encoding='utf-8') as f:
-            table_name = str(table)
-            if not isinstance(table, Table):
-                table_name = '({})'.format(table_name)
+        with open_file() as f:
+            table_name = copy_source(table, cur)
             sql = "COPY {table_name} TO STDOUT WITH (FORMAT CSV, HEADER TRUE)".format(
                 table_name=table_name)
             cur.copy_expert(sql, f)
 
+def partition_bounds(low, high, partitions):
+    """Split the integer range [low, high] into at most `partitions` contiguous [start, stop) ranges."""
+    step = max(-(-(high - low + 1) // partitions), 1)
+    return [(start, min(start + step, high + 1)) for start in range(low, high + 1, step)]
+
+def fast_partitioned_postgresql_to_df(query, key, schema, partitions):
+    """Load the rows of query in partitions, split on ranges of the integer column key.
+    Each partition is COPYed out and parsed in its own thread, over its own connection from the engine's pool,
+    so partitions should be no more than the pool size plus its overflow. Rows where key is NULL go in the first partition.
+    The partitions are combined with from_chunks, which unifies their categories."""
+    engine = query.bind
+    low, high = engine.execute(query.with_only_columns([func.min(key), func.max(key)])).first()
+    if low is None: #no rows, or nothing to split on
+        return fast_postgresql_to_df(query, schema)
+
+    bounds = partition_bounds(int(low), int(high), partitions)
+
+    def load_partition(i):
+        start, stop = bounds[i]
+        in_range = and_(key >= start, key < stop)
+        if i == 0:
+            in_range = or_(in_range, key.is_(None))
+        with profiling.span('sa.load_partition', table=schema.name, start=start, stop=stop) as span:
+            df = fast_postgresql_to_df(query.where(in_range), schema)
+            span.set_output(df)
+        return df
+
+    print('loading', len(bounds), 'partitions of', schema.name, 'on', key.name, 'concurrently')
+    with ThreadPoolExecutor(max_workers=len(bounds)) as executor:
+        partition_dfs = list(executor.map(load_partition, range(len(bounds))))
+    return from_chunks(partition_dfs)
+
 def fast_df_to_sql(df, table, schema):
     ods = OdoDataStore(schema, table, storage_target_type='sqlalchemy')
     ods.store(df)
 
+predicate_ops = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda col, values: col.in_(list(values)),
+    'not in': lambda col, values: ~col.in_(list(values))
+}
+
+def predicate_clause(columns, predicate):
+    """Turn a (column name, op, value) predicate into a clause on columns (e.g. table.c), where op is one of
+    predicate_ops. Comparing with None tests for NULL. sqlalchemy clauses are passed through unchanged."""
+    if not isinstance(predicate, tuple):
+        return predicate
+    col_name, op, value = predicate
+    if op not in predicate_ops:
+        raise TypeError('unknown predicate op {}. Must be one of {}'.format(op, list(predicate_ops)))
+    return predicate_ops[op](columns[col_name], value)
+
 class SATableDataStore(DataStore):
-    def __init__(self, schema, engine, where_clauses=None):
+    def __init__(self, schema, engine, where_clauses=None, partitions=1, partition_column=None):
+        """With partitions > 1, postgres tables are loaded in that many partitions at once (see
+        fast_partitioned_postgresql_to_df), split on partition_column, or by default the schema's index column."""
         super().__init__(schema)
         self.engine = engine 
         self.table = schema_as_table(self.schema, self.engine)
         self.where_clauses = where_clauses
+        self.partitions = partitions
+        self.partition_column = partition_column or self.schema.options.get('index')
 
     def storage_target(self):
         return 'sqlalchemy'
 
-    def _load(self):
-        query = self.table
-        if self.where_clauses is not None:
-            query = query.select()
-            for where_clause in self.where_clauses:
-                query = query.where(where_clause)
-
-        df = fast_sql_to_df(query, self.schema)
+    def _query(self, columns=None, where=None):
+        """Select the columns (by default all of them) of the rows matching where_clauses and the where predicates."""
+        where_clauses = list(self.where_clauses or [])
+        where_clauses.extend(predicate_clause(self.table.c, predicate) for predicate in (where or []))
+        if columns is None and not where_clauses:
+            return self.table
+
+        schema = self.projected_schema(columns)
+        query = select([self.table.c[col_name] for col_name in schema.col_names()])
+        for where_clause in where_clauses:
+            query = query.where(where_clause)
+        return query
+
+    def _load(self, columns=None, where=None):
+        """Load the table. Only the named columns are selected, and only the rows matching the where predicates,
+        which are pushed into the query (see predicate_clause)."""
+        query = self._query(columns, where)
+        schema = self.projected_schema(columns)
+
+        if self.partitions > 1 and self.partition_column is not None and self.engine.dialect.name == 'postgresql':
+            if isinstance(query, Table):
+                query = query.select()
+            return fast_partitioned_postgresql_to_df(query, self.table.c[self.partition_column], schema, self.partitions)
+
+        df = fast_sql_to_df(query, schema)
         return df
 
-    def to_csv(self, file_path):
+    def to_csv(self, file_path, columns=None, where=None, compress=False):
         if self.engine.dialect.name != 'postgresql':
             raise NotImplementedError('converting directly to csv not supported for non-postgres databases')
-        query = self.table
-        if self.where_clauses is not None:
-            query = query.select()
-            for where_clause in self.where_clauses:
-                query = query.where(where_clause)
+        query = self._query(columns, where)
 
-        fast_postgresql_to_csv(query, file_path)
+        fast_postgresql_to_csv(query, file_path, compress)
 
     def _store(self, df):
         if self.where_clauses is not None:
@@ -340,7 +449,8 @@ class SAJoinDataStore(DataStore):
     def storage_target(self):
         return 'sqlalchemy'
 
-    def _load(self):
+    def _load(self, columns=None, where=None):
+        """Load the join. columns and where refer to the prefixed column names ('prefix.column')."""
         root = self.root_table
         if self.root_conditions is not None:
             root = root.select().where(and_(*self.root_conditions)).alias()
@@ -377,16 +487,22 @@ class SAJoinDataStore(DataStore):
         #try:
         #    temp_table.create(self.engine)
 
+        labelled_cols = {labelled.name: labelled.element for labelled in select_clause}
+        if columns is not None:
+            select_clause = [labelled_cols[col_name].label(col_name) for col_name in self.projected_schema(columns).col_names()]
+
         query = select(select_clause).select_from(join_clause)
         if self.where_clauses is not None:
             query = query.where(and_(*self.where_clauses))
+        for predicate in (where or []):
+            query = query.where(predicate_clause(labelled_cols, predicate))
 
         #    insert = temp_table.insert().from_select(temp_schema.col_names(), query)
 
         start = time.time()
         
         print('loading rows from join')
-        df = fast_sql_to_df(query, self.schema)
+        df = fast_sql_to_df(query, self.projected_schema(columns))
         loaded = time.time()
         #finally:
         #    temp_table.drop(self.engine)
@@ -1,7 +1,143 @@
 import datetime
 
+import dateutil.parser
+import numpy as np
+import pandas
+
+"""Vectorised conversions for big_dt columns.
+
+big_dt columns hold datetime.datetime objects, since their dates (e.g. MIMIC's shifted dates) can fall outside the
+range of datetime64[ns]. Stores keep them as float64 seconds since the epoch. The conversions go through NumPy's
+datetime64[us], which covers any year a datetime.datetime can hold, so no Python code runs per value.
+As with datetime.timestamp and datetime.fromtimestamp, which stores used before, the datetimes are naive local times.
+The local time offset is looked up once per distinct day, and values near a change of offset (e.g. daylight saving)
+are converted with datetime.timestamp and datetime.fromtimestamp themselves."""
+
+_dt_digits = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]
+_dt_separators = {4: b'-', 7: b'-', 10: b' ', 13: b':', 16: b':'}
+
+def _offset_at(t):
+    """Offset of local time from UTC, in seconds, at t seconds since the epoch."""
+    return (datetime.datetime.fromtimestamp(t) - datetime.datetime.utcfromtimestamp(t)).total_seconds()
+
+def _local_offsets(seconds):
+    """Local time offsets for an array of seconds (nan for nulls), and a mask of the values whose day is within a day
+    of a change of offset, whose offset can't be told from their day alone."""
+    offsets = np.zeros(len(seconds))
+    near_change = np.zeros(len(seconds), dtype=bool)
+    present = ~np.isnan(seconds)
+    if not present.any():
+        return offsets, near_change
+    days, inverse = np.unique(np.floor(seconds[present] / 86400), return_inverse=True)
+    # offsets at the start of the day before each day, and at the end of the day after it
+    before = np.array([_offset_at((day - 1) * 86400) for day in days])
+    after = np.array([_offset_at((day + 2) * 86400 - 1) for day in days])
+    offsets[present] = before[inverse]
+    near_change[present] = (before != after)[inverse]
+    return offsets, near_change
+
+def datetimes_to_seconds(values):
+    """Seconds since the epoch of an array of naive local datetimes (or nulls), as float64 with nan for nulls.
+    Gives the same values as datetime.timestamp."""
+    values = np.asarray(values)
+    if values.dtype.kind == 'M':
+        us = values.astype('datetime64[us]')
+        missing = np.isnat(us) if hasattr(np, 'isnat') else us.view('int64') == np.iinfo('int64').min
+    else:
+        missing = pandas.isnull(values)
+        us = np.where(missing, None, values).astype('datetime64[us]')
+    seconds = us.view('int64') / 10**6
+    seconds[missing] = np.nan
+
+    offsets, near_change = _local_offsets(seconds)
+    seconds -= offsets
+    for i in np.flatnonzero(near_change):
+        # the datetime itself if there is one, as its fold tells apart the repeated hour when clocks go back
+        value = values[i] if isinstance(values[i], datetime.datetime) else us[i].item()
+        seconds[i] = datetime.datetime.timestamp(value)
+    return seconds
+
+def seconds_to_datetimes(seconds):
+    """Object array of naive local datetime.datetime for an array of seconds since the epoch, with nan for nan.
+    Gives the same values as datetime.fromtimestamp."""
+    seconds = np.asarray(seconds, dtype='float64')
+    missing = np.isnan(seconds)
+    offsets, near_change = _local_offsets(seconds)
+    local = np.where(missing, 0, seconds + offsets)
+    us = np.round(local * 10**6).astype('int64').view('datetime64[us]')
+    result = us.astype('object')
+    for i in np.flatnonzero(near_change):
+        result[i] = datetime.datetime.fromtimestamp(seconds[i])
+    result[missing] = np.nan
+    return result
+
+def parse_fixed_datetimes(values):
+    """Parse an array of "%Y-%m-%d %H:%M:%S" strings with integer arithmetic on their digits.
+    The strings are viewed as rows of bytes, so no Python code runs per value. Returns (datetime64[s] array, mask of
+    the values that were in that exact format), or None if values can't be viewed as bytes (e.g. non-ascii strings)."""
+    values = np.asarray(values, dtype='object')
+    notnull = pandas.notnull(values)
+    try:
+        # 20 bytes, so a value longer than 19 characters shows up as a non-zero last byte
+        raw = np.where(notnull, values, '').astype('S20')
+    except (UnicodeEncodeError, TypeError, ValueError):
+        return None
+
+    buf = raw.view(np.uint8).reshape(len(values), 20)
+    digits = buf[:, _dt_digits].astype(np.int64) - ord('0')
+    valid = notnull & (buf[:, 19] == 0) & ((digits >= 0) & (digits <= 9)).all(axis=1)
+    for i, sep in _dt_separators.items():
+        valid &= buf[:, i] == ord(sep)
+
+    year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+    month = digits[:, 4] * 10 + digits[:, 5]
+    day = digits[:, 6] * 10 + digits[:, 7]
+    hour = digits[:, 8] * 10 + digits[:, 9]
+    minute = digits[:, 10] * 10 + digits[:, 11]
+    second = digits[:, 12] * 10 + digits[:, 13]
+    valid &= (year >= 1) & (month >= 1) & (month <= 12) & (day >= 1) & (day <= 31)
+    valid &= (hour < 24) & (minute < 60) & (second < 60)
+
+    result = np.empty(len(values), dtype='datetime64[s]')
+    result[:] = np.datetime64('NaT')
+    months = (year[valid] - 1970) * 12 + month[valid] - 1
+    days = months.astype('datetime64[M]').astype('datetime64[D]') + (day[valid] - 1)
+    seconds = hour[valid] * 3600 + minute[valid] * 60 + second[valid]
+    result[valid] = days.astype('datetime64[s]') + seconds.astype('timedelta64[s]')
+
+    # days past the end of the month (e.g. Feb 30th) roll over into the next month
+    in_month = days.astype('datetime64[M]') == months.astype('datetime64[M]')
+    rolled_over = np.flatnonzero(valid)[~in_month]
+    result[rolled_over] = np.datetime64('NaT')
+    valid[rolled_over] = False
+    return result, valid
+
+def parse_big_dt(values):
+    """Object array of datetime.datetime (nan for nulls) from an array of datetime64s, datetimes or date strings.
+    "%Y-%m-%d %H:%M:%S" strings are parsed by parse_fixed_datetimes, and anything else by dateutil."""
+    values = np.asarray(values)
+    if values.dtype.kind == 'M':
+        return seconds_to_datetimes(datetimes_to_seconds(values))
+
+    values = values.astype('object')
+    result = np.empty(len(values), dtype='object')
+    result[:] = np.nan
+    remaining = pandas.notnull(values)
+
+    parsed = parse_fixed_datetimes(values)
+    if parsed is not None:
+        fixed, valid = parsed
+        result[valid] = fixed[valid].astype('object')
+        remaining &= ~valid
+
+    for i in np.flatnonzero(remaining):
+        value = values[i]
+        result[i] = value if isinstance(value, datetime.datetime) else dateutil.parser.parse(value)
+    return result
+
 def big_dt_to_num(big_dt_col):
-    return big_dt_col.map(datetime.datetime.timestamp, na_action='ignore')
+    return pandas.Series(datetimes_to_seconds(big_dt_col.values), index=big_dt_col.index, name=big_dt_col.name)
 
 def num_to_big_dt(num_col):
-    return num_col.map(datetime.datetime.fromtimestamp, na_action='ignore')
\ No newline at end of file
+    # dtype='object', or pandas would turn the datetimes into datetime64s when they are all in its range
+    return pandas.Series(seconds_to_datetimes(num_col.values), index=num_col.index, name=num_col.name, dtype='object')
@@ -1,6 +1,5 @@
 import pandas as pd
-from collections import defaultdict
-from functools import reduce
+import numpy as np
 
 CHUNK_SIZE = 262144
 
@@ -13,54 +12,196 @@ def to_chunks(df, chunksize=CHUNK_SIZE):
         yield chunk
 
 def from_chunks(chunks):
-    dtype_chunks = defaultdict(list)
-    column_category_chunks = defaultdict(list)
+    """Concatenate an iterable of DataFrames into one DataFrame, with a fresh integer index.
+
+    Chunks are consumed one at a time and each column is written straight into a growable NumPy buffer,
+    so peak memory stays close to the size of the result. Column dtypes are kept, and only promoted when a
+    later chunk needs it (e.g. an int column becomes float64 when a chunk has nans). Categorical columns are
+    stored as codes, remapped chunk by chunk through a category hash table."""
+    columns = None
+    buffers = {}
+    length = 0
     for chunk in chunks:
-        chunk_numbers = chunk.select_dtypes(include=['float', 'int', 'bool'])
-        chunk[chunk_numbers.columns] = chunk_numbers.astype('float64')
-        for dtype in map(str, chunk.dtypes.unique()):
-            dtype_chunk = chunk.select_dtypes(include=[dtype])
-            if dtype == 'category':
-                for col in dtype_chunk.columns:
-                    column_category_chunks[col].append(dtype_chunk[col].cat.categories)
-            dtype_chunks[dtype].append(dtype_chunk)
-
-    combined_dtypes = {}
-    combined_column_categories = {}
-    for dtype, d_chunks in dtype_chunks.items():
-        if dtype == 'category':
-            for column, category_chunks in column_category_chunks.items():
-                combined_categories = reduce(pd.Index.union, category_chunks)
-                combined_column_categories[column] = combined_categories
-                for cat_chunk in d_chunks:
-                    cat_chunk[column] = cat_chunk[column].cat.set_categories(combined_categories).cat.codes
-        combined_dtype = pd.concat(d_chunks, copy=False, ignore_index=True)
-        combined_dtypes[dtype] = combined_dtype
-
-    df = pd.concat(combined_dtypes.values(), axis=1, copy=False)
-
-    for column, combined_categories in combined_column_categories.items():
-        df[column] = pd.Categorical.from_codes(df[column], combined_categories, name=column)
+        if columns is None:
+            columns = list(chunk.columns)
+            buffers = {column: _ColumnBuffer() for column in columns}
+        elif set(chunk.columns) != set(columns):
+            sym_diff = set(chunk.columns) ^ set(columns)
+            raise TypeError('chunk columns do not match. non-matching were: {}'.format(sym_diff))
+
+        for column in columns:
+            buffers[column].write(chunk[column], length)
+        length += len(chunk)
 
+    if columns is None:
+        return pd.DataFrame()
+
+    df = pd.DataFrame(index=np.arange(length))
+    for column in columns:
+        # pop each buffer as it goes in, so only one column is ever held twice
+        df[column] = buffers.pop(column).finish(length)
     return df
 
-def to_group_chunks(df, column, chunksize=CHUNK_SIZE, group_rows_hint=None):
-    groups = pd.Series(df[column].unique())
-
-    if group_rows_hint is None:
-        group_rows_hint = len(df) // len(groups) * 100 
-
-    group_stack = []
-    for g_ids in to_chunks(groups, chunksize=chunksize // group_rows_hint or 1):
-        group_stack.extend(g_ids)
-        chunk_mask = df[column].isin(group_stack)
-        chunk_len = chunk_mask.sum()
-        if chunk_len >= chunksize:
-            yield df[chunk_mask]
-            group_stack = []
-    if group_stack:
-        chunk_mask = df[column].isin(group_stack)
-        yield df[chunk_mask]
+class _ColumnBuffer:
+    """Growable buffer holding one column of from_chunks' result."""
+    def __init__(self):
+        self.values = None
+        self.categories = None
+
+    def write(self, col, start):
+        if start == 0:
+            # the first chunk with rows decides whether this is a categorical column
+            self.categories = CategoryTable() if hasattr(col, 'cat') else None
+            self.values = None
+
+        if self.categories is not None:
+            if not hasattr(col, 'cat'):
+                col = col.astype('category')
+            values = self.categories.remap(col)
+        else:
+            values = np.asarray(col)
+        
+        if self.values is None:
+            self.values = np.empty(len(values), dtype=values.dtype)
+        elif values.dtype != self.values.dtype:
+            self._promote(values.dtype, start)
+            values = _cast(values, self.values.dtype)
+
+        stop = start + len(values)
+        if stop > len(self.values):
+            grown = np.empty(max(stop, 2 * len(self.values)), dtype=self.values.dtype)
+            grown[:start] = self.values[:start]
+            self.values = grown
+        self.values[start:stop] = values
+
+    def _promote(self, dtype, length):
+        try:
+            new_dtype = np.result_type(self.values.dtype, dtype)
+        except TypeError: #e.g. datetimes mixed with numbers
+            new_dtype = np.dtype('object')
+        if new_dtype != self.values.dtype:
+            self.values = _cast(self.values[:length], new_dtype)
+
+    def finish(self, length):
+        values = self.values
+        if values is None:
+            values = np.empty(0, dtype='object')
+        elif len(values) > length:
+            values = values[:length].copy()
+        self.values = None
+
+        if self.categories is not None:
+            return self.categories.categorical(values)
+        return values
+
+def _cast(values, dtype):
+    if dtype == 'object' and values.dtype.kind in 'mM':
+        # numpy turns datetime64[ns] into plain ints when casting to object, pandas gives timestamps
+        return pd.Series(values).astype('object').values
+    return values.astype(dtype)
+
+class CategoryTable:
+    """Hash table from category label to code, which grows as chunks with new categories are remapped onto it."""
+    def __init__(self):
+        self.codes = {}
+        self.labels = []
+
+    def mapping(self, labels):
+        """Return an array from positions in labels to the table's codes, adding any labels not seen before.
+        Its last entry is -1, so indexing it with code -1 keeps missing values missing."""
+        mapping = np.empty(len(labels) + 1, dtype='int32')
+        for i, label in enumerate(labels):
+            code = self.codes.get(label)
+            if code is None:
+                code = self.codes[label] = len(self.labels)
+                self.labels.append(label)
+            mapping[i] = code
+        mapping[-1] = -1 #missing values have code -1, which picks this last entry
+        return mapping
+
+    def remap(self, col):
+        """Return col's category codes translated into the table's codes, adding any categories not seen before."""
+        return self.mapping(col.cat.categories)[col.cat.codes.values]
+
+    def encode(self, values):
+        """Return the table's codes for an array of labels, adding any labels not seen before. Nulls get code -1."""
+        codes, uniques = pd.factorize(values, sort=False)
+        return self.mapping(uniques)[codes]
+
+    def categorical(self, codes):
+        """Build a Categorical from codes, with the categories sorted as a union of the chunks' categories would be."""
+        labels = pd.Index(self.labels)
+        try:
+            order = labels.argsort()
+        except TypeError: #unorderable labels, keep them in the order they were seen
+            return pd.Categorical.from_codes(codes, labels)
+        ranks = np.empty(len(order) + 1, dtype='int32')
+        ranks[order] = np.arange(len(order))
+        ranks[-1] = -1
+        return pd.Categorical.from_codes(ranks[codes], labels.take(order))
+
+def to_group_chunks(df, column, chunksize=CHUNK_SIZE, chunk_sizes=None):
+    """Split df into chunks of roughly chunksize rows, keeping all rows of a group of `column` in the same chunk.
+    If chunk_sizes is a list, the length of every chunk is appended to it (see chunk_size_histogram)."""
+    order, bounds = group_chunk_bounds(df, column, chunksize)
+    for start, stop in bounds:
+        if order is None:
+            chunk = df.iloc[start:stop]
+        else:
+            chunk = df.take(order[start:stop])
+        if chunk_sizes is not None:
+            chunk_sizes.append(len(chunk))
+        yield chunk
+
+def group_chunk_bounds(df, column, chunksize=CHUNK_SIZE):
+    """Compute chunk boundaries for to_group_chunks in linear time.
+
+    Returns (order, bounds), where order is as returned by group_boundaries and bounds is a list of (start, stop)
+    row ranges into df (or into the row positions in order, if it is not None). Each range ends on a group
+    boundary, as soon as it holds at least chunksize rows."""
+    order, group_ends = group_boundaries(df, column)
+    return order, chunk_bounds(group_ends, chunksize)
+
+def group_boundaries(df, column):
+    """Factorize the group column of df once, and find where each group's rows end.
+
+    If df is already grouped contiguously, returns (None, group_ends), where group_ends holds the row each group
+    ends at. Otherwise the rows are stably sorted by group (groups stay in order of first appearance) and returns
+    (order, group_ends), where order holds the sorted row positions and group_ends index into it."""
+    codes, uniques = pd.factorize(df[column], sort=False)
+    n_groups = len(uniques)
+    if (codes == -1).any(): #nulls make up a group of their own
+        codes = np.where(codes == -1, n_groups, codes)
+        n_groups += 1
+
+    if (np.diff(codes) >= 0).all():
+        order = None
+    else:
+        order = np.argsort(codes, kind='mergesort')
+
+    group_ends = np.cumsum(np.bincount(codes, minlength=n_groups))
+    return order, group_ends
+
+def chunk_bounds(group_ends, chunksize=CHUNK_SIZE):
+    """Cut rows into (start, stop) ranges of at least chunksize rows that end on the given group_ends."""
+    bounds = []
+    start = 0
+    n_rows = group_ends[-1] if len(group_ends) else 0
+    while start < n_rows:
+        g = min(np.searchsorted(group_ends, start + chunksize, side='left'), len(group_ends) - 1)
+        stop = group_ends[g]
+        bounds.append((start, stop))
+        start = stop
+    return bounds
+
+def chunk_size_histogram(chunk_sizes, bins=10):
+    """Summarise chunk lengths, e.g. as collected by to_group_chunks, to help tune CHUNK_SIZE."""
+    counts, edges = np.histogram(chunk_sizes, bins=bins)
+    return pd.DataFrame({
+        'min_rows': edges[:-1].astype('int64'),
+        'max_rows': edges[1:].astype('int64'),
+        'chunks': counts
+    }, columns=['min_rows', 'max_rows', 'chunks'])
 
 def left_join(left_df, right_df, on=None, left_on=None, right_on=None):
     """Wrapper around `pandas.merge`, but converts categoricals to and from codes to speed up the merge
@@ -0,0 +1,119 @@
+import os
+import time
+
+import numpy as np
+import pandas
+
+from chatto_transform.schema.schema_base import *
+
+"""Named compression settings for the HDF-backed stores.
+
+    scratch  intermediates written once and read once, e.g. ParallelTransform's temp chunks. Fastest to write.
+    cache    local caches that are read many times, e.g. the session query cache.
+    archive  data kept for good. Smallest files, slowest to write. The default, as it matches what HdfDataStore
+             always used (blosc at level 9).
+
+A store takes either a profile name, or a dict of column type (e.g. cat) to profile name with a 'default' entry,
+to compress some column types differently from the rest (see HdfDataStore). Use benchmark() or
+scripts/benchmark_compression.py to compare codecs and levels on MIMIC-shaped data."""
+
+COMPRESSION_PROFILES = {
+    'scratch': {'complib': 'blosc', 'complevel': 1},
+    'cache': {'complib': 'blosc', 'complevel': 5},
+    'archive': {'complib': 'blosc', 'complevel': 9}
+}
+
+DEFAULT_PROFILE = 'archive'
+
+def compression_options(profile):
+    """The HDFStore complib and complevel keyword arguments of a profile name, or of a {'complib', 'complevel'} dict."""
+    if isinstance(profile, dict):
+        return {'complib': profile['complib'], 'complevel': profile['complevel']}
+    if profile not in COMPRESSION_PROFILES:
+        raise TypeError('unknown compression profile {}. Must be one of {}'.format(profile, list(COMPRESSION_PROFILES)))
+    return COMPRESSION_PROFILES[profile].copy()
+
+def column_profile(compression, col=None):
+    """The profile for column col of a store with the given compression setting, or the store's default profile
+    if col is None."""
+    if not isinstance(compression, dict) or 'complib' in compression:
+        return compression
+    return compression.get(type(col), compression.get('default', DEFAULT_PROFILE))
+
+def is_per_column_type(compression):
+    return isinstance(compression, dict) and 'complib' not in compression
+
+###############################################################################
+# benchmarking
+
+def sample_df(schema, nrows, seed=0):
+    """Random data shaped like schema: ids counting up, a few hundred distinct labels per categorical column,
+    timestamps an hour or so apart, and some missing values, as in the MIMIC tables."""
+    rng = np.random.RandomState(seed)
+    data = {}
+    for col in schema.cols:
+        missing = rng.rand(nrows) < 0.05
+        if isinstance(col, id_):
+            values = np.arange(nrows, dtype='float64')
+        elif isinstance(col, num):
+            values = np.round(rng.lognormal(3, 1, nrows), 1)
+            values[missing] = np.nan
+        elif isinstance(col, bool_):
+            values = (rng.rand(nrows) < 0.1).astype('float64')
+            values[missing] = np.nan
+        elif isinstance(col, cat):
+            labels = np.array(['{}_{}'.format(col.name, i) for i in range(300)], dtype='object')
+            codes = np.minimum(rng.zipf(1.5, nrows) - 1, len(labels) - 1)
+            codes[missing] = -1
+            values = pandas.Categorical.from_codes(codes, labels)
+        elif isinstance(col, dt):
+            seconds = np.cumsum(rng.randint(0, 7200, nrows)).astype('int64')
+            values = (np.datetime64('2100-01-01', 's') + seconds.astype('timedelta64[s]')).astype('datetime64[ns]')
+            values[missing] = np.datetime64('NaT')
+        elif isinstance(col, delta):
+            values = (rng.randint(0, 10**6, nrows) * 10**9).astype('timedelta64[ns]')
+        else:
+            raise TypeError('cannot make sample data for column {}'.format(col))
+        data[col.name] = values
+    return pandas.DataFrame(data, columns=schema.col_names())
+
+def benchmark(schema, df, settings, tmp_dir, repeat=1, fixed=True):
+    """Store and load df with HdfDataStore under each compression setting (profile names, or
+    {'complib', 'complevel'} dicts). Returns a DataFrame of size and write and read throughput per setting,
+    throughput being in MB of in-memory data per second."""
+    from chatto_transform.datastores.hdf_datastore import HdfDataStore
+
+    data_mb = df.memory_usage(index=True).sum() / 10**6
+    records = []
+    for setting in settings:
+        f = os.path.join(tmp_dir, 'benchmark_compression.hdf')
+        store = HdfDataStore(schema, f, fixed=fixed, compression=setting)
+        write_seconds = read_seconds = 0
+        try:
+            for _ in range(repeat):
+                start = time.time()
+                store.store(df)
+                write_seconds += time.time() - start
+
+                start = time.time()
+                store.load()
+                read_seconds += time.time() - start
+            size_mb = os.path.getsize(f) / 10**6
+        finally:
+            store.delete()
+
+        if is_per_column_type(setting):
+            options = {'complib': None, 'complevel': None}
+        else:
+            options = compression_options(setting)
+        records.append({
+            'setting': str(setting),
+            'complib': options['complib'],
+            'complevel': options['complevel'],
+            'size_mb': size_mb,
+            'ratio': data_mb / max(size_mb, 1e-9),
+            'write_mb_per_s': data_mb * repeat / max(write_seconds, 1e-9),
+            'read_mb_per_s': data_mb * repeat / max(read_seconds, 1e-9)
+        })
+    return pandas.DataFrame.from_records(records, columns=['setting', 'complib', 'complevel', 'size_mb', 'ratio',
+        'write_mb_per_s', 'read_mb_per_s'])
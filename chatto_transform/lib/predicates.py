@@ -0,0 +1,46 @@
+import pandas as pd
+
+"""Evaluate (column name, op, value) predicates, as passed to DataStore.load(where=...), on DataFrames.
+Each op has the same meaning as in the SQL built by sqlalchemy_datastore.predicate_clause."""
+
+def predicate_mask(df, predicate):
+    """Boolean mask of the rows of df matching a (column name, op, value) predicate, with the same semantics as the
+    SQL predicate built by sqlalchemy_datastore.predicate_clause: comparing with None tests for NULL, and NULLs
+    never match any other comparison."""
+    col_name, op, value = predicate
+    col = df[col_name]
+    if col.dtype.name == 'category':
+        col = col.astype(object)
+    notnull = col.notnull()
+    if op == 'in':
+        return col.isin(list(value)) & notnull
+    if op == 'not in':
+        return ~col.isin(list(value)) & notnull
+    if value is None:
+        if op == '==':
+            return ~notnull
+        if op == '!=':
+            return notnull
+        raise TypeError('cannot compare with None using {}'.format(op))
+    if op == '==':
+        return (col == value) & notnull
+    if op == '!=':
+        return (col != value) & notnull
+    if op == '<':
+        return (col < value) & notnull
+    if op == '<=':
+        return (col <= value) & notnull
+    if op == '>':
+        return (col > value) & notnull
+    if op == '>=':
+        return (col >= value) & notnull
+    raise TypeError('unknown predicate op {}'.format(op))
+
+def filter_df(df, where):
+    """The rows of df matching every (column name, op, value) predicate in where, reindexed from 0."""
+    if not where:
+        return df
+    mask = pd.Series(True, index=df.index)
+    for predicate in where:
+        mask &= predicate_mask(df, predicate)
+    return df[mask].reset_index(drop=True)
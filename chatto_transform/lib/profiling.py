@@ -0,0 +1,252 @@
+import contextlib
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+"""Structured instrumentation for DataStores, Transforms and the stages inside them.
+
+DataStore load/load_chunks/store/store_chunks/update and Transform load/transform calls are each recorded as a span,
+holding the wall time, rows and bytes in and out, memory use, and time spent conforming to the schema.
+Spans are only recorded while a hook is registered, otherwise span() costs next to nothing. For example:
+
+    with profiling.profile() as profiler:
+        df = SomeTransform().load_transform()
+    profiler.to_dataframe()
+    profiler.to_chrome_trace('trace.json') # open in chrome://tracing
+
+A span's peak_rss is the largest resident set size sampled while it was open, every SAMPLE_SECONDS by a background
+thread, so spikes shorter than that can be missed. It is not the process high-water mark, which peak_rss() returns.
+
+Any object with an on_span(span) method can be registered with add_hook, e.g. to log spans as they finish.
+Spans recorded in worker processes (see ParallelTransform) are not sent back to the parent process."""
+
+SAMPLE_SECONDS = 0.01
+
+_hooks = []
+_local = threading.local()
+
+def add_hook(hook):
+    _hooks.append(hook)
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+def current_rss():
+    """Current resident set size of this process in bytes. Falls back to the peak size where /proc is not available."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return peak_rss()
+
+def peak_rss():
+    """High-water mark of the resident set size of this process in bytes, over the whole life of the process."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+def data_size(data):
+    """Return (rows, bytes) of a DataFrame, or of a dict of DataFrames as passed to MultiSchema transforms."""
+    if data is None:
+        return 0, 0
+    if isinstance(data, dict):
+        sizes = [data_size(df) for df in data.values()]
+        return sum(rows for rows, _ in sizes), sum(n_bytes for _, n_bytes in sizes)
+    return len(data), int(data.memory_usage(index=True).sum())
+
+class Span:
+    def __init__(self, name, category, attrs, parent):
+        self.name = name
+        self.category = category
+        self.attrs = attrs
+        self.parent = parent
+        self.pid = os.getpid()
+        self.tid = threading.get_ident()
+        self.rows_in = self.bytes_in = None
+        self.rows_out = self.bytes_out = None
+        self.conform_seconds = 0.0
+        self.discarded = False
+        self.start_rss = current_rss()
+        self.end_rss = None
+        self.peak_rss = self.start_rss
+        self.start = time.time()
+        self.end = None
+
+    @property
+    def seconds(self):
+        return self.end - self.start
+
+    def set_input(self, data):
+        self.rows_in, self.bytes_in = data_size(data)
+
+    def set_output(self, data):
+        self.rows_out, self.bytes_out = data_size(data)
+
+    def add_input(self, data):
+        rows, n_bytes = data_size(data)
+        self.rows_in = (self.rows_in or 0) + rows
+        self.bytes_in = (self.bytes_in or 0) + n_bytes
+
+    def set_attrs(self, **attrs):
+        """Add attrs to the span, for values that are only known once some of its block has run."""
+        self.attrs.update(attrs)
+
+    def discard(self):
+        self.discarded = True
+
+    def as_dict(self):
+        d = {
+            'name': self.name,
+            'category': self.category,
+            'parent': self.parent.name if self.parent is not None else None,
+            'pid': self.pid,
+            'tid': self.tid,
+            'start': self.start,
+            'seconds': self.seconds,
+            'conform_seconds': self.conform_seconds,
+            'rows_in': self.rows_in,
+            'bytes_in': self.bytes_in,
+            'rows_out': self.rows_out,
+            'bytes_out': self.bytes_out,
+            'rss_delta': self.end_rss - self.start_rss,
+            'peak_rss': self.peak_rss
+        }
+        d.update(self.attrs)
+        return d
+
+class _NullSpan:
+    """Stands in for a Span when no hooks are registered."""
+    def set_input(self, data):
+        pass
+
+    def set_output(self, data):
+        pass
+
+    def add_input(self, data):
+        pass
+
+    def set_attrs(self, **attrs):
+        pass
+
+    def discard(self):
+        pass
+
+_null_span = _NullSpan()
+
+_open_spans = set()
+_sampler_lock = threading.Lock()
+_sampler = None
+
+def _sample_rss():
+    """Raise the peak_rss of every open span to the current resident set size, until no spans are open."""
+    global _sampler
+    while True:
+        with _sampler_lock:
+            if not _open_spans:
+                _sampler = None
+                return
+            spans = list(_open_spans)
+        rss = current_rss()
+        for s in spans:
+            if rss > s.peak_rss:
+                s.peak_rss = rss
+        time.sleep(SAMPLE_SECONDS)
+
+def _start_sampling(s):
+    global _sampler
+    with _sampler_lock:
+        _open_spans.add(s)
+        if _sampler is None or not _sampler.is_alive():
+            _sampler = threading.Thread(target=_sample_rss, name='profiling-rss-sampler', daemon=True)
+            _sampler.start()
+
+def _stop_sampling(s):
+    with _sampler_lock:
+        _open_spans.discard(s)
+
+def _span_stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+@contextlib.contextmanager
+def span(name, category='stage', **attrs):
+    """Record the code in the with block as a span. Spans in the 'conform' category add their time to the
+    conform_seconds of the enclosing span."""
+    if not _hooks:
+        yield _null_span
+        return
+
+    stack = _span_stack()
+    s = Span(name, category, attrs, stack[-1] if stack else None)
+    stack.append(s)
+    _start_sampling(s)
+    try:
+        yield s
+    finally:
+        _stop_sampling(s)
+        stack.pop()
+        s.end = time.time()
+        s.end_rss = current_rss()
+        s.peak_rss = max(s.peak_rss, s.end_rss)
+        if s.category == 'conform' and s.parent is not None:
+            s.parent.conform_seconds += s.seconds
+        if not s.discarded:
+            for hook in list(_hooks):
+                hook.on_span(s)
+
+class Profiler:
+    """Hook that collects every span, and exports them as a DataFrame or a Chrome trace."""
+    columns = ['name', 'category', 'parent', 'pid', 'tid', 'start', 'seconds', 'conform_seconds',
+               'rows_in', 'bytes_in', 'rows_out', 'bytes_out', 'rss_delta', 'peak_rss']
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def on_span(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def to_dataframe(self):
+        import pandas
+        records = [s.as_dict() for s in self.spans]
+        extra_columns = sorted(set().union(*(s.attrs for s in self.spans)) - set(self.columns))
+        return pandas.DataFrame.from_records(records, columns=self.columns + extra_columns)
+
+    def to_chrome_trace(self, file=None):
+        """Return the spans in Chrome's trace event format, and write them as JSON to file if given."""
+        events = []
+        for s in self.spans:
+            args = s.as_dict()
+            for k in ['name', 'category', 'pid', 'tid', 'start', 'seconds']:
+                del args[k]
+            events.append({
+                'name': s.name,
+                'cat': s.category,
+                'ph': 'X',
+                'ts': s.start * 10**6,
+                'dur': s.seconds * 10**6,
+                'pid': s.pid,
+                'tid': s.tid,
+                'args': args
+            })
+        trace = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+        if file is not None:
+            with open(file, 'w') as f:
+                json.dump(trace, f, default=str)
+        return trace
+
+@contextlib.contextmanager
+def profile():
+    """Collect all spans recorded in the with block in a Profiler."""
+    profiler = Profiler()
+    add_hook(profiler)
+    try:
+        yield profiler
+    finally:
+        remove_hook(profiler)
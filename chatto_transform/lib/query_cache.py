@@ -0,0 +1,213 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import os.path
+import threading
+import time
+
+from chatto_transform.datastores.hdf_datastore import HdfDataStore
+from chatto_transform.schema.schema_base import PartialSchema
+
+"""Content-addressed cache of table query results.
+
+A query is a table schema, a raw SQL condition string, a projection (list of column names) and a list of
+(column name, op, value) predicates, as passed to DataStore.load. The query is normalised and hashed, and its result
+is stored in the cache directory as <hash>.hdf. index.json records every entry's query, size and last use, along
+with the cache's hit and miss counts.
+
+A query that is not cached can still be answered by a cached superset query: one on the same table and condition,
+whose predicates are a subset of the query's and whose columns include the query's columns and the columns of
+the remaining predicates. Entries are stored in HDF table format, so only the columns and rows the narrower query
+needs are read from the superset entry (see HdfDataStore._load).
+
+When the entries take up more than max_bytes, the least recently used ones are evicted.
+Several processes can share a cache directory: the index is only read and written under an exclusive lock on
+index.lock, and every file is written to a temporary file first and moved into place with os.replace."""
+
+def _normalise_value(value):
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sorted((_normalise_value(v) for v in value), key=repr)
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return str(value)
+
+def normalise_predicate(predicate):
+    """JSON form of a (column name, op, value) predicate, or None if the predicate is not a tuple
+    (e.g. a sqlalchemy clause), and so cannot be cached."""
+    if not isinstance(predicate, tuple):
+        return None
+    col_name, op, value = predicate
+    return [col_name, op, _normalise_value(value)]
+
+def normalise_query(schema, condition=None, columns=None, where=None):
+    """The normalised form of a query, as stored in the index, or None if it cannot be cached."""
+    predicates = []
+    for predicate in where or []:
+        normalised = normalise_predicate(predicate)
+        if normalised is None:
+            return None
+        predicates.append(normalised)
+    predicates = sorted({json.dumps(p, sort_keys=True) for p in predicates})
+    return {
+        'table': schema.name,
+        'schema': [[col.name, type(col).__name__] for col in schema.cols],
+        'condition': ' '.join(condition.split()) if condition is not None else None,
+        'columns': sorted(columns) if columns is not None else None,
+        'where': predicates
+    }
+
+def query_key(query):
+    return hashlib.sha1(json.dumps(query, sort_keys=True).encode('utf-8')).hexdigest()
+
+class QueryCache:
+    def __init__(self, cache_dir, max_bytes=20 * 2**30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index_file = os.path.join(cache_dir, 'index.json')
+        self.lock_file = os.path.join(cache_dir, 'index.lock')
+        self._thread_lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _locked_index(self):
+        """Yield the index, holding the lock on it. Changes to the index are written back when the block exits."""
+        with self._thread_lock, open(self.lock_file, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                index = self._read_index()
+                yield index
+                self._write_index(index)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_index(self):
+        try:
+            with open(self.index_file) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {'entries': {}, 'hits': 0, 'superset_hits': 0, 'misses': 0}
+
+    def _write_index(self, index):
+        tmp_file = self._partial_file(self.index_file)
+        with open(tmp_file, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_file, self.index_file)
+
+    def _partial_file(self, path):
+        return '{}.{}.{}.partial'.format(path, os.getpid(), threading.get_ident())
+
+    def _entry_file(self, key):
+        return os.path.join(self.cache_dir, key + '.hdf')
+
+    def _entry_store(self, schema, columns, key):
+        schema = PartialSchema.projection(schema, columns) if columns is not None else schema
+        return HdfDataStore(schema, self._entry_file(key), fixed=False, compression='cache')
+
+    def _find_superset(self, entries, query):
+        """Key of the smallest cached entry that can answer query, or None."""
+        wanted_cols = set(query['columns']) if query['columns'] is not None else {c for c, _ in query['schema']}
+        where = set(query['where'])
+        candidates = []
+        for key, entry in entries.items():
+            cached = entry['query']
+            if (cached['table'], cached['schema'], cached['condition']) != (query['table'], query['schema'], query['condition']):
+                continue
+            if not set(cached['where']) <= where:
+                continue
+            extra_cols = {json.loads(p)[0] for p in where - set(cached['where'])}
+            if cached['columns'] is not None and not (wanted_cols | extra_cols) <= set(cached['columns']):
+                continue
+            candidates.append((entry['bytes'], key))
+        if not candidates:
+            return None
+        return min(candidates)[1]
+
+    def get(self, schema, condition=None, columns=None, where=None):
+        """The cached result of the query, or None on a miss."""
+        query = normalise_query(schema, condition, columns, where)
+        if query is None:
+            return None
+        key = query_key(query)
+
+        with self._locked_index() as index:
+            entries = index['entries']
+            if key in entries:
+                found = key
+                index['hits'] += 1
+            else:
+                found = self._find_superset(entries, query)
+                if found is None:
+                    index['misses'] += 1
+                    return None
+                index['superset_hits'] += 1
+            entries[found]['last_used'] = time.time()
+            cached = entries[found]['query']
+
+        # the entry is in table format, so a superset entry only reads the columns and rows the query needs
+        extra_where = [p for p in where or [] if json.dumps(normalise_predicate(p), sort_keys=True) not in cached['where']]
+        store = self._entry_store(schema, cached['columns'], found)
+        try:
+            return store.load(columns=columns, where=extra_where or None)
+        except (OSError, KeyError):
+            # evicted by another process since we read the index
+            return None
+
+    def put(self, schema, condition, columns, where, df):
+        """Cache df as the result of the query, then evict the least recently used entries while the cache is
+        larger than max_bytes. Empty results and queries that cannot be normalised are not cached."""
+        query = normalise_query(schema, condition, columns, where)
+        if query is None or df is None or len(df) == 0:
+            return
+        key = query_key(query)
+
+        # write the entry before taking the lock, so other processes are not held up
+        entry_file = self._entry_file(key)
+        tmp_file = self._partial_file(entry_file)
+        store = self._entry_store(schema, columns, key)
+        store.hdf_file = tmp_file
+        try:
+            store.store(df)
+        except ValueError:
+            return
+
+        with self._locked_index() as index:
+            os.replace(tmp_file, entry_file)
+            now = time.time()
+            index['entries'][key] = {
+                'query': query,
+                'bytes': os.path.getsize(entry_file),
+                'created': now,
+                'last_used': now
+            }
+            self._evict(index)
+
+    def _evict(self, index):
+        entries = index['entries']
+        total = sum(entry['bytes'] for entry in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]['last_used']):
+            if total <= self.max_bytes:
+                break
+            total -= entries[key]['bytes']
+            del entries[key]
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._entry_file(key))
+
+    def stats(self):
+        """Hit and miss counts, and the number and total size of the entries."""
+        with self._locked_index() as index:
+            return {
+                'hits': index['hits'],
+                'superset_hits': index['superset_hits'],
+                'misses': index['misses'],
+                'entries': len(index['entries']),
+                'bytes': sum(entry['bytes'] for entry in index['entries'].values())
+            }
+
+    def clear(self):
+        with self._locked_index() as index:
+            for key in index['entries']:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self._entry_file(key))
+            index['entries'] = {}
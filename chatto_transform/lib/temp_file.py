@@ -1,17 +1,22 @@
-from tempfile import mkstemp
+from tempfile import mkstemp, mkdtemp
 import os
 import os.path
 import contextlib
 
 from chatto_transform.config import config
 
-def make_temporary_file(tmp_dir=None):
+def _get_tmp_dir(tmp_dir=None):
     if tmp_dir is None:
         tmp_dir = os.path.join(config.data_dir, 'tmp')
     if not os.path.exists(tmp_dir):
         os.makedirs(tmp_dir)
+    return tmp_dir
+
+def make_temporary_file(tmp_dir=None):
+    return mkstemp(dir=_get_tmp_dir(tmp_dir))[1]
 
-    return mkstemp(dir=tmp_dir)[1]
+def make_temporary_dir(tmp_dir=None):
+    return mkdtemp(dir=_get_tmp_dir(tmp_dir))
 
 
 @contextlib.contextmanager
@@ -19,4 +24,4 @@ def deleting(tmp_path):
     try:
         yield
     finally:
-        os.remove(tmp_path)
\ No newline at end of file
+        os.remove(tmp_path)
@@ -5,7 +5,12 @@ import numpy
 import copy
 from collections import defaultdict
 
-pandas.options.mode.use_inf_as_null = True
+from chatto_transform.lib.big_dt_tools import parse_big_dt
+
+try:
+    pandas.options.mode.use_inf_as_null = True
+except AttributeError: #removed in pandas 2.1, which never treats inf as null
+    pass
 
 class Schema:
     """Schema class. Implements a basic DSL for defining the types and columns of a given dataframe.
@@ -31,6 +36,7 @@ class Schema:
                 raise TypeError('index option must be a string column name. Got ', options['index'])
 
         self.options = options
+        self._conform_plans = {}
 
     @classmethod
     def union(cls, schemas, with_prefix=False, drop=None, add=None, rename=None, schema_name=None, options=None):
@@ -115,14 +121,21 @@ class Schema:
             cols = self.cols
         return [col.name if isinstance(col, Column) else col for col in cols]
 
-    def conform_df(self, df, storage_target='pandas', skip_sort=False, add_prefix=False):
-        if set(df.columns) != set(self.col_names()):
-            sym_diff = set(df.columns) ^ set(self.col_names())
-            raise TypeError('df columns do not match schema. non-matching were: {}'.format(sym_diff))
+    def conform_df(self, df, storage_target='pandas', skip_sort=False, add_prefix=False, copy_on_write=False):
+        """Conform df to the schema for the given storage target, and return the conformed df.
+        By default df is modified in place. With copy_on_write=True df is left untouched: a shallow view of it is
+        returned instead, in which columns that already pass their check are shared with df and only the columns
+        that have to be converted are materialised."""
+        self._check_df_columns(df)
 
-        for col in self.cols:
-            if isinstance(col, Column):
-                col.conform(df, storage_target=storage_target)
+        if copy_on_write:
+            df = df.copy(deep=False)
+
+        transform_cols, validate_cols = self._conform_plan(df, storage_target)
+        for col in transform_cols:
+            col.replace(df, col.transform(df[col.name], storage_target), copy_on_write=copy_on_write)
+        for col in validate_cols:
+            col.validate(df[col.name], storage_target)
 
         if not skip_sort and self.options.get('order_by', False):
             order_by_cols = self.options['order_by']
@@ -136,6 +149,35 @@ class Schema:
         if add_prefix:
             self.add_prefix(df)
 
+        return df
+
+    def _check_df_columns(self, df):
+        if set(df.columns) != set(self.col_names()):
+            sym_diff = set(df.columns) ^ set(self.col_names())
+            raise TypeError('df columns do not match schema. non-matching were: {}'.format(sym_diff))
+
+    def _plan_cols(self, df):
+        return [col for col in self.cols if isinstance(col, Column)]
+
+    def _conform_plan(self, df, storage_target):
+        """Return the columns of df that have to be transformed for storage_target, and the columns that
+        only need their data validated.
+        Column checks only look at dtypes, so a plan is compiled once per (storage_target, dtypes) signature
+        and cached on the schema. Conforming later chunks with the same dtypes is then a dict lookup."""
+        signature = (storage_target, tuple(zip(df.columns, map(str, df.dtypes))))
+        plan = self._conform_plans.get(signature)
+        if plan is None:
+            transform_cols = []
+            validate_cols = []
+            for col in self._plan_cols(df):
+                if not col.check_dtype(df[col.name], storage_target):
+                    transform_cols.append(col)
+                elif col.has_validator(storage_target):
+                    validate_cols.append(col)
+            plan = (transform_cols, validate_cols)
+            self._conform_plans[signature] = plan
+        return plan
+
     def add_prefix(self, df):
         df.columns = [self.name+'.'+col if col in self.col_names() else col for col in df.columns]
 
@@ -164,29 +206,19 @@ class PartialSchema(Schema):
             cols = []
         super().__init__(name, cols, options)
 
-    def conform_df(self, df, storage_target='pandas', skip_sort=False, add_prefix=False):
+    def conform_df(self, df, storage_target='pandas', skip_sort=False, add_prefix=False, copy_on_write=False):
         if df is None:
             return
 
+        return super().conform_df(df, storage_target, skip_sort, add_prefix, copy_on_write)
+
+    def _check_df_columns(self, df):
         if not set(df.columns) >= set(self.col_names()):
             missing = set(self.col_names()) - set(df.columns) 
             raise TypeError('some columns missing form partial schema: {}'.format(missing))
 
-        for col in self._inferred_cols(df, self.cols):
-            if isinstance(col, Column):
-                col.conform(df, storage_target=storage_target)
-
-        if not skip_sort and self.options.get('order_by', False):
-            order_by_cols = self.options['order_by']
-            sort_index = pandas.MultiIndex.from_arrays([df[col] for col in order_by_cols])
-            if not sort_index.is_monotonic: #check if it is sorted already
-                df.reset_index(inplace=True) #save the current index in column 'index'
-                df.index = sort_index
-                df.sort_index(inplace=True)
-                df.set_index('index', drop=True, inplace=True)
-
-        if add_prefix:
-            self.add_prefix(df)
+    def _plan_cols(self, df):
+        return self._inferred_cols(df, self.cols)
 
     @classmethod
     def _inferred_cols(cls, df, skip_cols=None):
@@ -217,13 +249,28 @@ class PartialSchema(Schema):
     def from_schema(cls, schema):
         return cls(schema.name, schema.cols, schema.options)
 
+    @classmethod
+    def projection(cls, schema, columns):
+        """Partial schema of the named columns of schema, in schema order.
+        The index and order_by options are dropped if they refer to columns that are not kept."""
+        unknown = set(columns) - set(schema.col_names())
+        if unknown:
+            raise TypeError('columns not in schema {}: {}'.format(schema.name, unknown))
+        options = schema.options.copy()
+        if options.get('index') not in columns:
+            options.pop('index', None)
+        if not set(options.get('order_by', [])) <= set(columns):
+            options.pop('order_by', None)
+        cols = [copy.copy(col) for col in schema.cols if col.name in columns]
+        return cls(schema.name, cols, options)
+
 class MultiSchema:
     def __init__(self, schema_dict):
         if not isinstance(schema_dict, dict) or len(schema_dict) == 0:
             raise TypeError('schema_dict must be a dict')
         self.schema_dict = schema_dict.copy()
 
-    def conform_df(self, data, storage_target='pandas', skip_sort=False, add_prefix=False):
+    def conform_df(self, data, storage_target='pandas', skip_sort=False, add_prefix=False, copy_on_write=False):
         if not isinstance(data, dict):
             raise TypeError('MultiSchema conform_df() expects a dictionary of name:df. Got {}'.format(data))
 
@@ -231,8 +278,13 @@ class MultiSchema:
             sym_diff = data.keys() ^ self.schema_dict.keys()
             raise TypeError('data dictionary keys do not match multischema. non-matching were: {}'.format(sym_diff))
 
+        conformed = {}
         for key, df in data.items():
-            self[key].conform_df(df, storage_target, skip_sort, add_prefix)
+            conformed[key] = self[key].conform_df(df, storage_target, skip_sort, add_prefix, copy_on_write)
+
+        if copy_on_write:
+            return conformed
+        return data
 
     def copy(self):
         return copy.deepcopy(self)
@@ -262,16 +314,43 @@ class Column(metaclass=ColumnMeta):
 
     def check(self, col, storage_target='pandas'):
         #print('checking column', self.name, 'for type', self.__class__.__name__)
+        if not self.check_dtype(col, storage_target):
+            return False
+        self.validate(col, storage_target)
+        return True
+
+    def check_dtype(self, col, storage_target='pandas'):
+        """Run only the storage target's check handler. Check handlers must depend on the column's dtype alone,
+        so Schema.conform_df can cache their results per dtype signature."""
         return self._get_storage_target(storage_target, 'check')(col)
+
+    def validate(self, col, storage_target='pandas'):
+        """Run the storage target's validate handler, if it has one. Validate handlers look at the column's data
+        and raise TypeError on bad values, so they run on every conform."""
+        if self.has_validator(storage_target):
+            self._get_storage_target(storage_target, 'validate')(col)
+
+    def has_validator(self, storage_target):
+        return 'validate' in self._storage_target_registry.get(storage_target, {})
         
     def transform(self, col, storage_target='pandas'):
         #print('transforming column', self.name, 'for type', self.__class__.__name__)
         return self._get_storage_target(storage_target, 'transform')(col)
         
-    def conform(self, df, storage_target='pandas'):
+    def conform(self, df, storage_target='pandas', copy_on_write=False):
         col = df[self.name]
         if not self.check(col, storage_target):
-            df[self.name] = self.transform(col, storage_target)
+            self.replace(df, self.transform(col, storage_target), copy_on_write=copy_on_write)
+
+    def replace(self, df, conformed, copy_on_write=False):
+        if copy_on_write:
+            # swap the column out of df's blocks rather than writing into them,
+            # since those blocks may be shared with the caller's frame
+            loc = df.columns.get_loc(self.name)
+            del df[self.name]
+            df.insert(loc, self.name, conformed)
+        else:
+            df[self.name] = conformed
 
     def __eq__(self, other_col):
         return type(self) == type(other_col) and self.name == other_col.name
@@ -297,9 +376,13 @@ class Column(metaclass=ColumnMeta):
     def register_metadata(cls, *target_names):
         return cls._register_decorator(target_names, 'metadata')
 
+    @classmethod
+    def register_validate(cls, *target_names):
+        return cls._register_decorator(target_names, 'validate')
+
     @classmethod
     def _register_decorator(cls, target_names, handler_name):
-        if handler_name not in ('check', 'transform', 'metadata'):
+        if handler_name not in ('check', 'transform', 'metadata', 'validate'):
             raise NameError('Cannot register a storage target named {}'.format(handler_name))
 
         def _decorator(handler):
@@ -388,7 +471,7 @@ def _(col):
 
 @big_dt.register_transform('pandas')
 def col_to_big_dt(col):
-    return col.map(dateutil.parser.parse, na_action='ignore')
+    return pandas.Series(parse_big_dt(col.values), index=col.index, name=col.name, dtype='object')
 
 ###############################################################################
 
@@ -411,11 +494,13 @@ class bool_(Column):
 
 @bool_.register_check('pandas')
 def _(col):
-    if col.dtype != 'float64':
-        return False
-    if not set(col.dropna().unique()) <= {1.0, 0.0}:
+    return col.dtype == 'float64'
+
+@bool_.register_validate('pandas')
+def _(col):
+    values = col.values
+    if not ((values == 1.0) | (values == 0.0) | numpy.isnan(values)).all():
         raise TypeError("bool_ column has value other than nan, 1 or 0.")
-    return True
 
 @bool_.register_transform('pandas')
 def _(col):
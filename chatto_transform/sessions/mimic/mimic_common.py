@@ -1,12 +1,11 @@
 from chatto_transform.sessions.mimic import mimic_login, mimic_widgets
 
 from chatto_transform.datastores.sqlalchemy_datastore import SATableDataStore, SAQueryDataStore
-from chatto_transform.datastores.appendable_datastore import AppendableHdfDataStore
 from chatto_transform.datastores.hdf_datastore import HdfDataStore
 from chatto_transform.datastores.csv_datastore import CsvDataStore
-from chatto_transform.datastores.caching_datastore import CachingDataStore
 
 from chatto_transform.schema.schema_base import PartialSchema
+from chatto_transform.lib.query_cache import QueryCache
 
 from sqlalchemy import create_engine
 from sqlalchemy.sql import text
@@ -23,10 +22,11 @@ import ipywidgets as widgets
 import unicodedata
 import re
 import os.path
-import shelve
 import contextlib
 import traceback
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import warnings
 warnings.filterwarnings('ignore')
@@ -63,55 +63,114 @@ def _get_sql_loader(sql):
 
 ### Data loading
 
-def load_table(schema, condition=None):
-    loader = _get_table_loader(schema, condition)
-    
+_query_cache = None
+_query_cache_lock = threading.Lock()
+
+def get_query_cache():
+    """The session's QueryCache in the local storage dir, or None if there is no local storage dir.
+    Its size limit can be set with query_cache_bytes in mimic_config."""
+    global _query_cache
     local_storage_dir = mimic_login.get_local_storage_dir()
-    if local_storage_dir:
-        query_f_name = schema.name
-        if condition is not None:
-            db_file = mimic_login.get_db_file()
-            with shelve.open(db_file) as db:
-                qs_k = 'queries_'+schema.name
-                if qs_k not in db:
-                    db[qs_k] = ()
-                condition = slugify(condition)
-                if condition not in db[qs_k]:
-                    db[qs_k] += (condition,)
-                q_idx = db[qs_k].index(condition)
-                query_f_name += '_query_' + str(q_idx)
-        query_f_name +='.hdf'
-        query_f_name = os.path.join(local_storage_dir, query_f_name)
-        cache = AppendableHdfDataStore(schema, query_f_name)
-        loader = CachingDataStore(schema, loader, cache)
-    
+    if not local_storage_dir:
+        return None
+    with _query_cache_lock:
+        cache_dir = os.path.join(local_storage_dir, 'query_cache')
+        if _query_cache is None or _query_cache.cache_dir != cache_dir:
+            max_bytes = getattr(mimic_login.get_config(), 'query_cache_bytes', 20 * 2**30)
+            _query_cache = QueryCache(cache_dir, max_bytes)
+        return _query_cache
+
+def query_cache_stats():
+    cache = get_query_cache()
+    if cache is None:
+        return None
+    return cache.stats()
+
+def clear_query_cache():
+    cache = get_query_cache()
+    if cache is not None:
+        cache.clear()
+
+def load_table(schema, condition=None, columns=None, where=None):
+    """Load the table of schema. condition is a raw SQL condition string. columns selects only the named columns,
+    and where is a list of (column name, op, value) predicates (see sqlalchemy_datastore.predicate_clause),
+    both of which are pushed into the query. Results are cached in the session's query cache."""
+    cache = get_query_cache()
+    if cache is not None:
+        df = cache.get(schema, condition, columns, where)
+        if df is not None:
+            return df
+
+    loader = _get_table_loader(schema, condition)
+    df = None
     with sql_exception():
-        return loader.load()
+        df = loader.load(columns=columns, where=where)
+
+    if cache is not None and df is not None:
+        cache.put(schema, condition, columns, where, df)
+    return df
+
+def load_tables(multi_schema, conditions=None, columns=None, where=None):
+    """Load every table of multi_schema at once, each in its own thread over its own connection from the session's pool,
+    so loading takes about as long as the slowest table. conditions, columns and where are dicts of table name to the
+    load_table argument for that table. Returns the dict of table name to DataFrame, as load_table would for each table.
+    Only the queries run concurrently: tables are read from and written to the query cache one at a time."""
+    def table_args(name):
+        return [(args or {}).get(name) for args in (conditions, columns, where)]
+
+    cache = get_query_cache()
+    tables = {}
+    to_fetch = []
+    for name, schema in multi_schema.schema_dict.items():
+        tables[name] = cache.get(schema, *table_args(name)) if cache is not None else None
+        if tables[name] is None:
+            to_fetch.append(name)
+
+    def fetch(name):
+        condition, table_columns, table_where = table_args(name)
+        loader = _get_table_loader(multi_schema[name], condition)
+        return loader.load(columns=table_columns, where=table_where)
+
+    with ThreadPoolExecutor(max_workers=max(len(to_fetch), 1)) as executor:
+        futures = {name: executor.submit(fetch, name) for name in to_fetch}
+        for name, future in futures.items():
+            with sql_exception():
+                tables[name] = future.result()
+
+    if cache is not None:
+        for name in to_fetch:
+            if tables[name] is not None:
+                cache.put(multi_schema[name], *table_args(name), df=tables[name])
+    return tables
 
 def load_sql(sql):
     loader = _get_sql_loader(sql)
     with sql_exception():
         return loader.load()
 
-def store_csv(schema, condition=None):
-    file_name = schema.name
-    if not os.path.splitext(file_name)[1] == '.csv':
-        file_name = file_name + '.csv'
+def _csv_file_path(file_name, compress=False):
+    ext = '.csv.gz' if compress else '.csv'
+    if not file_name.endswith(ext):
+        file_name = file_name + ext
     local_storage_dir = mimic_login.get_local_storage_dir()
-    file_path = os.path.join(local_storage_dir, file_name)
+    return os.path.join(local_storage_dir, file_name)
+
+def store_csv(schema, condition=None, compress=False):
+    """Export the table to a csv file in the local storage dir. The rows are streamed from the database to the file,
+    through gzip if compress is set."""
+    file_path = _csv_file_path(schema.name, compress)
     
     loader = _get_table_loader(schema, condition)
-    loader.to_csv(file_path)
+    loader.to_csv(file_path, compress=compress)
     return FileLink(os.path.relpath(file_path), result_html_prefix='Right-click and save: ')
 
-def df_to_csv(file_name, df):
-    if not os.path.splitext(file_name)[1] == '.csv':
-        file_name = os.path.join(file_name, '.csv')
-    sp = os.path.splitext(file_name)[0]
-    local_storage_dir = mimic_login.get_local_storage_dir()
-    file_path = os.path.join(local_storage_dir, file_name)
+def df_to_csv(file_name, df, compress=False):
+    """Export df to a csv file in the local storage dir. It is written a chunk at a time, through gzip if compress is set,
+    so the export needs little memory beyond df itself."""
+    file_path = _csv_file_path(file_name, compress)
+    sp = os.path.basename(file_path).split('.')[0]
     
-    store = CsvDataStore(PartialSchema(sp), file_path)
+    store = CsvDataStore(PartialSchema(sp), file_path, compress=compress, write_in_background=compress)
     store.store(df)
     return FileLink(os.path.relpath(file_path), result_html_prefix='Right-click and save: ')
 
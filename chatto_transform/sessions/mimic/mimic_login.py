@@ -1,8 +1,11 @@
 import shelve
 import os.path
+import threading
 
 from sqlalchemy import create_engine
 
+from chatto_transform.datastores import sqlalchemy_datastore
+
 class MimicLoginException(Exception):
     pass
 
@@ -13,10 +16,30 @@ def get_config():
     except ImportError:
         raise MimicLoginException('config/mimic_config.py not found. You will be unable to log into the database until you create this file.')
 
-    
+
+_engine = None
+_engine_lock = threading.Lock()
+
 def get_engine():
-    mimic_config = get_config()
-    return create_engine(mimic_config.mimic_psql_config)
+    """The session's engine. It is created on first use, and its connection pool is shared by every load until close().
+    The pool size can be set with pool_size and max_overflow in mimic_config."""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            mimic_config = get_config()
+            _engine = create_engine(mimic_config.mimic_psql_config,
+                pool_size=getattr(mimic_config, 'pool_size', 5),
+                max_overflow=getattr(mimic_config, 'max_overflow', 10))
+        return _engine
+
+def close():
+    """Close the session's pooled connections. The next get_engine() creates a new engine."""
+    global _engine
+    with _engine_lock:
+        if _engine is not None:
+            sqlalchemy_datastore.forget_engine(_engine)
+            _engine.dispose()
+            _engine = None
 
 def get_local_storage_dir():
     mimic_config = get_config()
@@ -143,6 +143,8 @@ class VasoIOEventsMetavision(Transform):
         return ioevents
 
 class ExpandDateRange(Transform):
+    group_vectorised = True
+
     def input_schema(self):
         return cvs.date_range
 
@@ -351,16 +353,19 @@ class DaysUntilDeath(Transform):
             icu_cond = 'ICUSTAY_ID IN ( {} )'.format(', '.join(map(str, self.icustay_ids)))
             icu_conds.append(icu_cond)
 
-        if 'admissions' not in incr_data:
-            adm_cond = ' and '.join(adm_conds) or None
-            incr_data['admissions'] = mimic_common.load_table(admissions_schema, adm_cond)
-        
-        if 'icustayevents' not in incr_data:
-            icu_cond = ' and '.join(icu_conds) or None
-            incr_data['icustayevents'] = mimic_common.load_table(icustayevents_schema, icu_cond)
-        
-        if 'patients' not in incr_data:
-            incr_data['patients'] = mimic_common.load_table(patients_schema, pat_cond)
+        schemas = {
+            'admissions': admissions_schema,
+            'icustayevents': icustayevents_schema,
+            'patients': patients_schema
+        }
+        conditions = {
+            'admissions': ' and '.join(adm_conds) or None,
+            'icustayevents': ' and '.join(icu_conds) or None,
+            'patients': pat_cond
+        }
+        missing = {name: schema for name, schema in schemas.items() if name not in incr_data}
+        if missing:
+            incr_data.update(mimic_common.load_tables(MultiSchema(missing), conditions))
 
         return incr_data
 
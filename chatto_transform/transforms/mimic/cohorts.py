@@ -12,6 +12,8 @@ import numpy as np
 import re
 
 class LabItemFilter(Transform):
+    input_columns = {'labevents': ['hadm_id', 'itemid', 'charttime']}
+
     @classmethod
     def valid_labitems(cls):
         labitems = mimic_common.load_table(mimic_schema.d_labitems_schema)
@@ -27,8 +29,11 @@ class LabItemFilter(Transform):
             incr_data = {}
 
         if 'labevents' not in incr_data:
-            cond = 'itemid IN ( {} )'.format(', '.join(map(str, self.lab_item_ids)))
-            incr_data['labevents'] = mimic_common.load_table(mimic_schema.labevents_schema, cond)
+            where = None
+            if self.lab_item_ids is not None:
+                where = [('itemid', 'in', self.lab_item_ids)]
+            incr_data['labevents'] = mimic_common.load_table(mimic_schema.labevents_schema,
+                columns=self.needed_columns('labevents'), where=where)
 
         if 'icustayevents' not in incr_data:
             incr_data['icustayevents'] = mimic_common.load_table(mimic_schema.icustayevents_schema)
@@ -37,7 +42,7 @@ class LabItemFilter(Transform):
 
     def input_schema(self):
         return MultiSchema({
-            'labevents': mimic_schema.labevents_schema,
+            'labevents': self.needed_schema(mimic_schema.labevents_schema, 'labevents'),
             'icustayevents': mimic_schema.icustayevents_schema
         })
 
@@ -56,6 +61,8 @@ class LabItemFilter(Transform):
         return icustayevents[icustayevents['icustay_id'].isin(icustay_ids)]
 
 class IOItemsFilter(Transform):
+    input_columns = {'ioevents': ['icustay_id', 'itemid']}
+
     @classmethod
     def valid_meditems(cls):
         meditems = mimic_common.load_table(mimic_schema.d_items_schema, "linksto = 'ioevents'")
@@ -71,8 +78,11 @@ class IOItemsFilter(Transform):
             incr_data = {}
 
         if 'ioevents' not in incr_data:
-            cond = 'itemid IN ( {} )'.format(', '.join(map(str, self.ioevent_item_ids)))
-            incr_data['ioevents'] = mimic_common.load_table(mimic_schema.ioevents_schema, cond)
+            where = None
+            if self.ioevent_item_ids is not None:
+                where = [('itemid', 'in', self.ioevent_item_ids)]
+            incr_data['ioevents'] = mimic_common.load_table(mimic_schema.ioevents_schema,
+                columns=self.needed_columns('ioevents'), where=where)
 
         if 'icustayevents' not in incr_data:
             incr_data['icustayevents'] = mimic_common.load_table(mimic_schema.icustayevents_schema)
@@ -81,7 +91,7 @@ class IOItemsFilter(Transform):
 
     def input_schema(self):
         return MultiSchema({
-            'ioevents': mimic_schema.ioevents_schema,
+            'ioevents': self.needed_schema(mimic_schema.ioevents_schema, 'ioevents'),
             'icustayevents': mimic_schema.icustayevents_schema
         })
 
@@ -140,6 +150,11 @@ class Icd9Matcher(Transform):
         return df
 
 class Icd9Filter(Transform):
+    input_columns = {
+        'diagnoses_icd': ['hadm_id', 'icd9_code'],
+        'procedures_icd': ['hadm_id', 'icd9_code']
+    }
+
     def __init__(self, icd9_codes=None):
         if icd9_codes is not None:
             self.icd9_codes = list(icd9_codes)
@@ -147,8 +162,8 @@ class Icd9Filter(Transform):
     def input_schema(self):
         ms = mimic_schema
         return MultiSchema({
-            'diagnoses_icd': ms.diagnoses_icd_schema,
-            'procedures_icd': ms.procedures_icd_schema,
+            'diagnoses_icd': self.needed_schema(ms.diagnoses_icd_schema, 'diagnoses_icd'),
+            'procedures_icd': self.needed_schema(ms.procedures_icd_schema, 'procedures_icd'),
             'icustayevents': ms.icustayevents_schema
         })
 
@@ -156,16 +171,18 @@ class Icd9Filter(Transform):
         if incr_data is None:
             incr_data = {}
 
-        if 'diagnoses_icd' not in incr_data:
-            cond = 'icd9_code IN ( {} )'.format(', '.join(map(repr, self.icd9_codes)))
-            incr_data['diagnoses_icd'] = mimic_common.load_table(mimic_schema.diagnoses_icd_schema, cond)
-
-        if 'procedures_icd' not in incr_data:
-            cond = 'icd9_code IN ( {} )'.format(', '.join(map(repr, self.icd9_codes)))
-            incr_data['procedures_icd'] = mimic_common.load_table(mimic_schema.procedures_icd_schema, cond)
-
-        if 'icustayevents' not in incr_data:
-            incr_data['icustayevents'] = mimic_common.load_table(mimic_schema.icustayevents_schema)
+        ms = mimic_schema
+        schemas = {
+            'diagnoses_icd': ms.diagnoses_icd_schema,
+            'procedures_icd': ms.procedures_icd_schema,
+            'icustayevents': ms.icustayevents_schema
+        }
+        missing = {name: schema for name, schema in schemas.items() if name not in incr_data}
+        if missing:
+            icd9_where = [('icd9_code', 'in', self.icd9_codes)]
+            incr_data.update(mimic_common.load_tables(MultiSchema(missing),
+                columns={name: self.needed_columns(name) for name in missing},
+                where={'diagnoses_icd': icd9_where, 'procedures_icd': icd9_where}))
 
         return incr_data
 
@@ -288,16 +305,16 @@ class IcuStayDetail(Transform):
         if incr_data is None:
             incr_data = {}
 
-        lt = mimic_common.load_table
         ms = mimic_schema
-        if 'icustayevents' not in incr_data:
-            incr_data['icustayevents'] = lt(ms.icustayevents_schema)
-        if 'admissions' not in incr_data:
-            incr_data['admissions'] = lt(ms.admissions_schema)
-        if 'patients' not in incr_data:
-            incr_data['patients'] = lt(ms.patients_schema)
-        if 'services' not in incr_data:
-            incr_data['services'] = lt(ms.services_schema)
+        schemas = {
+            'icustayevents': ms.icustayevents_schema,
+            'admissions': ms.admissions_schema,
+            'patients': ms.patients_schema,
+            'services': ms.services_schema
+        }
+        missing = {name: schema for name, schema in schemas.items() if name not in incr_data}
+        if missing:
+            incr_data.update(mimic_common.load_tables(MultiSchema(missing)))
 
         return incr_data
 
@@ -379,6 +396,8 @@ class IcustayDetailFilter(Transform):
 
 
 class WidgetFilter(Transform):
+    group_vectorised = True
+
     def __init__(self, filters):
         self.filters = dict(**filters)
 
@@ -1,10 +1,11 @@
 from chatto_transform.transforms.transform_base import Transform
 from chatto_transform.schema.schema_base import *
 
-from chatto_transform.lib.mimic.session import load_table
+from chatto_transform.sessions.mimic import mimic_common
 
 from chatto_transform.schema.mimic.mimic_schema import \
     chartevents_schema, labevents_schema, ioevents_schema, icustayevents_schema
+from chatto_transform.schema.mimic.cohorts_schema import icustay_detail_schema
 from chatto_transform.schema.mimic.patient_history_schema import \
     patient_history_schema, patient_history_relative_time_schema
 
@@ -86,6 +87,8 @@ class ChartTransform(Transform):
         return df
 
 class LabTransform(Transform):
+    group_vectorised = True
+
     lab_mappings = {
         'HCT': [50383],
         'WBC': [50316, 50468],
@@ -131,6 +134,8 @@ class LabTransform(Transform):
         return df
 
 class DemographicTransform(Transform):
+    group_vectorised = True
+
     def input_schema(self):
         return PartialSchema.from_schema(icustay_detail_schema)
 
@@ -163,6 +168,8 @@ class DemographicTransform(Transform):
         return stacked_df
 
 class UrineTransform(Transform):
+    group_vectorised = True
+
     urine_itemids = [651, 715, 55, 56, 57, 61, 65, 69, 85, 94, 96, 288, 405, 428, 473, 2042, 2068, 2111, 2119, 2130, 1922, 2810, 2859, 3053, 3462, 3519, 3175, 2366, 2463, 2507, 2510, 2592, 2676, 3966, 3987, 4132, 4253, 5927]
 
     def input_schema(self):
@@ -191,20 +198,17 @@ class PatientHistoryTransform(Transform):
     def _load(self):
         if self.subject_ids is not None:
             condition = 'subject_id IN ( {} )'.format(', '.join(map(str, self.subject_ids)))
+            first_icustay_condition = condition + ' AND subject_icustay_seq = 1'
         else:
             condition = None
-        
-        icustay_detail = load_table(icustay_detail_schema, condition + ' AND subject_icustay_seq = 1')
-        chartevents = load_table(chartevents_schema, condition)
-        labevents = load_table(labevents_schema, condition)
-        ioevents = load_table(ioevents_schema, condition)
-        
-        return {
-            'chartevents': chartevents,
-            'labevents': labevents,
-            'ioevents': ioevents,
-            'icustay_detail': icustay_detail
-        }
+            first_icustay_condition = 'subject_icustay_seq = 1'
+
+        return mimic_common.load_tables(self.input_schema(), {
+            'chartevents': condition,
+            'labevents': condition,
+            'ioevents': condition,
+            'icustay_detail': first_icustay_condition
+        })
 
     def input_schema(self):
         return MultiSchema({
@@ -1,5 +1,6 @@
 from itertools import chain
 import os
+import shutil
 import time
 from multiprocessing import cpu_count
 import sys
@@ -11,19 +12,32 @@ import numpy as np
 import joblib
 
 from chatto_transform.transforms.transform_base import Transform
-from chatto_transform.lib.chunks import from_chunks, to_chunks, to_group_chunks, CHUNK_SIZE
+from chatto_transform.lib.chunks import from_chunks, to_chunks, to_group_chunks, group_boundaries, chunk_bounds, CHUNK_SIZE
 from chatto_transform.lib import temp_file
+from chatto_transform.lib import profiling
 from chatto_transform.datastores.hdf_datastore import HdfDataStore
+from chatto_transform.datastores.memmap_datastore import MemmapDataStore, UnmappableColumnError
+from chatto_transform.transforms.parallel.scheduler import AdaptiveScheduler, measure_job
 
 """Library for executing transforms in parallel.
 
-Splits data into as many groups as there are cpus, and runs a transform on all groups simultaneously.
+Splits data into chunks (keeping groups together), and runs a transform on the chunks in as many jobs as there are cpus.
 
-HDFStore is used as an intermediate storage target, to pass data between jobs."""
+With the default 'memmap' backend the data is written once as memory-mapped column files, and each job reads its
+chunk as a row range of those files, and writes its result the same way. Chunks are handed out by an
+AdaptiveScheduler as workers free up, sized from the time and memory used by earlier chunks (see scheduler.py),
+unless adaptive=False, in which case the data is cut into fixed chunks of chunksize rows.
+With the 'hdf' backend, HDFStore is used as an intermediate storage target instead. This compresses the data on disk,
+so it is useful as a fallback when the data does not fit comfortably in memory or the page cache. The chunks of each
+large group are kept in one container file (see HdfDataStore._store_chunks), and each job reads its chunk from it.
+
+The ParallelTransform.run_jobs and ParallelTransform.store_chunks profiling spans carry the length of every chunk in
+their chunk_sizes attr (see lib.chunks.chunk_size_histogram), and adaptive runs the scheduler's per-job stats in jobs."""
 
 
 class ParallelTransform(Transform):
-    def __init__(self, transform, group_index=None, chunksize=None, n_jobs=-1):
+    def __init__(self, transform, group_index=None, chunksize=None, n_jobs=-1, backend='memmap', tmp_dir=None,
+                 adaptive=True, memory_budget=None, target_seconds=30):
         self.transform_obj = transform
         self.group_index = group_index
         if n_jobs == -1:
@@ -32,6 +46,13 @@ class ParallelTransform(Transform):
         if chunksize is None:
             chunksize = CHUNK_SIZE
         self.chunksize = chunksize
+        if backend not in ('memmap', 'hdf'):
+            raise TypeError("backend must be 'memmap' or 'hdf'. Got {}".format(backend))
+        self.backend = backend
+        self.tmp_dir = tmp_dir
+        self.adaptive = adaptive
+        self.memory_budget = memory_budget
+        self.target_seconds = target_seconds
 
     def output_schema(self):
         return self.transform_obj.output_schema()
@@ -39,13 +60,128 @@ class ParallelTransform(Transform):
     def input_schema(self):
         return self.transform_obj.input_schema()
 
+    def _choose_backend(self):
+        """The backend to run with. memmap falls back to hdf when a column type of the input or output schema
+        can't be memory-mapped, which is checked up front so that jobs don't fail on their results."""
+        schemas = [self.input_schema(), self.output_schema()]
+        if self.backend == 'memmap' and all(_can_store(schema, 'memmap') for schema in schemas):
+            return 'memmap'
+        if not all(_can_store(schema, 'hdf_enc') for schema in schemas):
+            raise TypeError('cannot run {} in parallel: some column type of its input or output schema cannot be '
+                'stored by the {} backend'.format(type(self.transform_obj).__name__, self.backend))
+        if self.backend == 'memmap':
+            print('falling back to the hdf backend: some column type of the input or output schema cannot be memory-mapped')
+        return 'hdf'
+
     def _transform(self, data):
+        if self._choose_backend() == 'memmap':
+            order, group_ends = self._group_boundaries(data)
+            input_store = MemmapDataStore(self.input_schema(), temp_file.make_temporary_dir(self.tmp_dir))
+            try:
+                print('writing data of size', data.memory_usage(index=True).sum(), 'bytes to memory-mapped files')
+                input_store.store(data, order=order)
+            except UnmappableColumnError as e:
+                input_store.delete()
+                print('falling back to the hdf backend:', e)
+            else:
+                try:
+                    if self.adaptive:
+                        return self._transform_adaptive(input_store, len(data), group_ends)
+                    if group_ends is None:
+                        steps = list(range(0, len(data), self.chunksize)) + [len(data)]
+                        bounds = list(zip(steps, steps[1:]))
+                    else:
+                        bounds = chunk_bounds(group_ends, self.chunksize)
+                    return self._transform_memmap(input_store, bounds)
+                finally:
+                    input_store.delete()
+        return self._transform_hdf(data)
+
+    def _group_boundaries(self, data):
+        if self.group_index is None:
+            return None, None
+        return group_boundaries(data, self.group_index)
+
+    def _transform_adaptive(self, input_store, nrows, group_ends):
+        start = time.time()
+        results_dir = temp_file.make_temporary_dir(self.tmp_dir)
+        try:
+            scheduler = AdaptiveScheduler(nrows, group_ends, n_jobs=self.n_jobs, initial_chunksize=self.chunksize,
+                memory_budget=self.memory_budget, target_seconds=self.target_seconds)
+            print('running transforms on', nrows, 'rows in', self.n_jobs, 'worker processes')
+            with profiling.span('ParallelTransform.run_jobs') as span:
+                ranges = scheduler.run(self.adaptive_transform_job, input_store, results_dir)
+                span.set_attrs(chunk_sizes=[stop - start for start, stop in ranges], jobs=scheduler.stats)
+
+            print('loading and merging the results')
+            result_stores = (self._result_store(results_dir, start_row) for start_row, _ in ranges)
+            with profiling.span('ParallelTransform.merge') as span:
+                results = from_chunks(r_store.load() for r_store in result_stores)
+                span.set_output(results)
+            print('finished merge')
+        finally:
+            shutil.rmtree(results_dir, ignore_errors=True)
+
+        end = time.time()
+        print('took', end - start, 'seconds to transform all data in parallel')
+        return results
+
+    def _result_store(self, results_dir, start):
+        return MemmapDataStore(self.output_schema(), os.path.join(results_dir, str(start)))
+
+    def adaptive_transform_job(self, input_store, results_dir, start, stop):
+        with measure_job(stop - start) as stats:
+            data = input_store.load_rows(start, stop)
+            result = self.transform_chunk(data)
+            stats['data_bytes'] = data.memory_usage(index=True).sum() + result.memory_usage(index=True).sum()
+            del data
+            self._result_store(results_dir, start).store(result)
+        return stats
+
+    def _transform_memmap(self, input_store, bounds):
+        start = time.time()
+        result_stores = []
+        try:
+            transform_jobs = []
+            for start_row, stop_row in bounds:
+                result_store = MemmapDataStore(self.output_schema(), temp_file.make_temporary_dir(self.tmp_dir))
+                result_stores.append(result_store)
+                transform_jobs.append(joblib.delayed(self.memmap_transform_job)(input_store, start_row, stop_row, result_store))
+
+            print('running transforms in', len(transform_jobs), 'parallel jobs')
+            with profiling.span('ParallelTransform.run_jobs') as span:
+                span.set_attrs(chunk_sizes=[int(stop - start) for start, stop in bounds])
+                joblib.Parallel(n_jobs=self.n_jobs)(transform_jobs)
+
+            print('loading and merging the results')
+            with profiling.span('ParallelTransform.merge') as span:
+                results = from_chunks(r_store.load() for r_store in result_stores)
+                span.set_output(results)
+            print('finished merge')
+        finally:
+            for r_store in result_stores:
+                r_store.delete()
+
+        end = time.time()
+        print('took', end - start, 'seconds to transform all data in parallel')
+        return results
+
+    def memmap_transform_job(self, input_store, start, stop, result_store):
+        data = input_store.load_rows(start, stop)
+        result = self.transform_chunk(data)
+        del data
+        result_store.store(result)
+
+    def _transform_hdf(self, data):
         start = time.time()
         print('transforming data of size', data.memory_usage(index=True).sum(), 'bytes')
         
         store_chunks_jobs = []
         transform_jobs = []
         hdf_stores = []
+        # results are written under one directory, so the results of the jobs that finished are removed
+        # even when another job fails
+        results_dir = temp_file.make_temporary_dir(self.tmp_dir)
         try:
             print('splitting data into large groups')
             group_iter = self._group_iter(data, len(data) // self.n_jobs or self.chunksize)
@@ -53,19 +189,22 @@ class ParallelTransform(Transform):
             for group_data in group_iter:
                 if group_data.empty:
                     continue
-                f = temp_file.make_temporary_file()
-                hdf_store = HdfDataStore(self.input_schema(), f)
+                f = temp_file.make_temporary_file(self.tmp_dir)
+                hdf_store = HdfDataStore(self.input_schema(), f, compression='scratch')
                 hdf_stores.append(hdf_store)
                 hdf_store.store(group_data)
 
                 store_chunks_jobs.append(joblib.delayed(self.store_chunks_job)(hdf_store))
                 #transform_jobs.append(joblib.delayed(self.transform_job)(hdf_store))
             print('breaking data into chunks in parallel')
-            joblib.Parallel(n_jobs=self.n_jobs)(store_chunks_jobs)
+            with profiling.span('ParallelTransform.store_chunks') as span:
+                chunk_sizes = joblib.Parallel(n_jobs=self.n_jobs)(store_chunks_jobs)
+                span.set_attrs(chunk_sizes=list(chain.from_iterable(chunk_sizes)))
 
             chunk_stores = chain.from_iterable(store.chunk_stores() for store in hdf_stores)
 
-            transform_jobs = [joblib.delayed(self.transform_job)(chunk_store) for chunk_store in chunk_stores]
+            transform_jobs = [joblib.delayed(self.transform_job)(chunk_store, os.path.join(results_dir, '{}.hdf'.format(i)))
+                for i, chunk_store in enumerate(chunk_stores)]
 
             print('running transforms in', len(transform_jobs), 'parallel jobs')
             result_hdf_stores = joblib.Parallel(n_jobs=self.n_jobs)(transform_jobs)
@@ -77,28 +216,32 @@ class ParallelTransform(Transform):
             for hdf_store in hdf_stores:
                 hdf_store.delete_chunks()
                 hdf_store.delete()
+            shutil.rmtree(results_dir, ignore_errors=True)
 
         end = time.time()
         print('took', end - start, 'seconds to transform all data in parallel')
         return results
 
-    def _group_iter(self, data, chunksize):
+    def _group_iter(self, data, chunksize, chunk_sizes=None):
         if self.group_index is not None:
-            group_iter = to_group_chunks(data, self.group_index, chunksize)
+            group_iter = to_group_chunks(data, self.group_index, chunksize, chunk_sizes=chunk_sizes)
         else:
             group_iter = to_chunks(data, chunksize)
         return group_iter
 
 
     def store_chunks_job(self, hdf_store):
+        """Split the data of hdf_store into chunks stored alongside it. Returns the length of every chunk."""
         data = hdf_store.load()
-        chunks = self._group_iter(data, self.chunksize)
+        chunk_sizes = []
+        chunks = self._group_iter(data, self.chunksize, chunk_sizes)
         def gc_chunks():
             for chunk in chunks:
                 yield chunk
                 del chunk
                 gc.collect()
         hdf_store.store_chunks(gc_chunks())
+        return chunk_sizes
         
     # def transform_job(self, hdf_store):
         
@@ -117,7 +260,7 @@ class ParallelTransform(Transform):
     #         del chunk
     #         gc.collect()
 
-    def transform_job(self, chunk_store):
+    def transform_job(self, chunk_store, result_file):
         gc.collect()
         start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 10**6 #sys.getallocatedblocks()
 
@@ -131,7 +274,8 @@ class ParallelTransform(Transform):
 
         finished_transform = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 10**6 #sys.getallocatedblocks()
 
-        t_hdf_store = HdfDataStore(self.output_schema(), chunk_store.hdf_file)
+        # the chunk is one of many in its container, so the result goes in a file of its own
+        t_hdf_store = HdfDataStore(self.output_schema(), result_file, compression='scratch')
         t_hdf_store.store(result)
         gc.collect()
 
@@ -144,16 +288,10 @@ class ParallelTransform(Transform):
             
     def transform_chunk(self, data):
         print('transforming chunk of length', len(data), 'mem usage', data.memory_usage(index=True).sum() / 10**6, 'mb')
-        transformed_groups = []
-        if self.group_index is None:
+        if self.group_index is None or self.transform_obj.group_vectorised:
             return self.transform_obj.transform(data)
         
-        for group_id, group_data in data.groupby(self.group_index, as_index=False, sort=False):
-            if group_data.empty: #pandas bug where empty groups are returned when grouped by a category
-                continue
-            transformed_group = self.transform_obj.transform(group_data)
-            transformed_groups.append(transformed_group)
-
-        transformed_data = pandas.concat(transformed_groups)
-        return transformed_data
+        return self.transform_obj.transform_groups(data, self.group_index)
 
+def _can_store(schema, storage_target):
+    return all(storage_target in type(col)._storage_target_registry for col in schema.cols)
@@ -0,0 +1,116 @@
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import contextlib
+import time
+
+import numpy as np
+
+from chatto_transform.lib.chunks import CHUNK_SIZE
+from chatto_transform.lib.profiling import current_rss, peak_rss
+
+"""Dynamic scheduling of row ranges over worker processes.
+
+Rather than splitting the data into a fixed set of chunks up front, the AdaptiveScheduler cuts the next chunk
+whenever a worker frees up. Chunk sizes are derived from the time and memory per row measured on the chunks
+that have already finished."""
+
+@contextlib.contextmanager
+def measure_job(rows):
+    """Measure a job running over `rows` rows. Yields the stats dict that the scheduler expects back from a job.
+    The job may set 'data_bytes' to the size of the data it held, which is used as a lower bound on its memory use."""
+    stats = {'rows': rows, 'data_bytes': 0}
+    start_rss = current_rss()
+    start_peak = peak_rss()
+    start = time.time()
+    yield stats
+    stats['seconds'] = time.time() - start
+    end_peak = peak_rss()
+    if end_peak > start_peak:
+        # this job set a new peak, so we know exactly how far above its starting point it went
+        peak_bytes = end_peak - start_rss
+    else:
+        peak_bytes = current_rss() - start_rss
+    stats['peak_bytes'] = max(peak_bytes, stats['data_bytes'], 0)
+
+
+class AdaptiveScheduler:
+    """Runs a job over row ranges of nrows rows in n_jobs worker processes, handing out the next range as soon as a
+    worker frees up.
+
+    The first n_jobs chunks have initial_chunksize rows. After that, chunks are sized so that each takes about
+    target_seconds at the rows/second measured so far, and, if memory_budget (bytes) is set, so that n_jobs chunks
+    fit in the budget at the bytes/row measured so far. No chunk is started while it would take the chunks in flight
+    over the budget. Towards the end of the data chunks shrink (guided self-scheduling), so skewed data does not
+    leave most workers idle while the last few large chunks finish.
+
+    If group_ends is given (see lib.chunks.group_boundaries), every range ends on a group boundary."""
+    def __init__(self, nrows, group_ends=None, n_jobs=1, initial_chunksize=CHUNK_SIZE, memory_budget=None,
+                 target_seconds=30, min_chunksize=1024):
+        self.nrows = nrows
+        self.group_ends = group_ends
+        self.n_jobs = n_jobs
+        self.initial_chunksize = initial_chunksize
+        self.memory_budget = memory_budget
+        self.target_seconds = target_seconds
+        self.min_chunksize = min_chunksize
+        self.stats = []
+
+    def rows_per_second(self):
+        rows = sum(s['rows'] for s in self.stats)
+        seconds = sum(s['seconds'] for s in self.stats)
+        return rows / max(seconds, 1e-3)
+
+    def bytes_per_row(self):
+        rows = sum(s['rows'] for s in self.stats)
+        peak_bytes = sum(s['peak_bytes'] for s in self.stats)
+        return max(peak_bytes / max(rows, 1), 1)
+
+    def _chunk_rows(self, start):
+        if not self.stats:
+            rows = self.initial_chunksize
+        else:
+            rows = self.target_seconds * self.rows_per_second()
+            if self.memory_budget is not None:
+                rows = min(rows, self.memory_budget / self.n_jobs / self.bytes_per_row())
+        remaining = self.nrows - start
+        rows = min(rows, -(-remaining // self.n_jobs))
+        return int(max(rows, self.min_chunksize))
+
+    def _next_stop(self, start, rows):
+        stop = start + rows
+        if self.group_ends is not None:
+            g = min(np.searchsorted(self.group_ends, stop, side='left'), len(self.group_ends) - 1)
+            stop = self.group_ends[g]
+        return int(min(stop, self.nrows))
+
+    def _estimated_bytes(self, rows):
+        if not self.stats:
+            return 0
+        return rows * self.bytes_per_row()
+
+    def run(self, job, *args):
+        """Call job(*args, start, stop) in the worker processes until all rows are covered.
+        job must return the stats dict from measure_job. Returns the (start, stop) ranges that were run, in row order.
+        The stats of every job, with its start and stop row, are kept in self.stats in the order the jobs finished."""
+        ranges = []
+        in_flight = {}
+        start = 0
+        with ProcessPoolExecutor(max_workers=self.n_jobs) as executor:
+            while start < self.nrows or in_flight:
+                while start < self.nrows and len(in_flight) < self.n_jobs:
+                    stop = self._next_stop(start, self._chunk_rows(start))
+                    estimate = self._estimated_bytes(stop - start)
+                    in_flight_bytes = sum(e for _, _, e in in_flight.values())
+                    if in_flight and self.memory_budget is not None and in_flight_bytes + estimate > self.memory_budget:
+                        break
+                    future = executor.submit(job, *args, start, stop)
+                    in_flight[future] = (start, stop, estimate)
+                    ranges.append((start, stop))
+                    start = stop
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    f_start, f_stop, _ = in_flight.pop(future)
+                    stats = future.result()
+                    stats['start'], stats['stop'] = f_start, f_stop
+                    self.stats.append(stats)
+        return ranges
@@ -1,34 +1,89 @@
 from chatto_transform.schema.schema_base import *
+from chatto_transform.lib.chunks import from_chunks
+from chatto_transform.lib import profiling
 
 class Transform:
     """Base class for the Transform abstraction.
     A Transform captures the procedures for loading and transforming data from one form to another."""
 
+    #set to True if _transform gives the same result on data holding many groups as it would on each group separately,
+    #e.g. because it works row by row. ParallelTransform then calls it once per chunk instead of once per group.
+    group_vectorised = False
+
+    #columns of the input that _transform uses: a list of column names, or for a MultiSchema input a dict of table name
+    #to list of column names. Tables that aren't in the dict are used whole. _load should only fetch these columns,
+    #e.g. with mimic_common.load_table(schema, columns=self.needed_columns(name)).
+    input_columns = None
+
+    def _span(self, operation):
+        return profiling.span(type(self).__name__ + '.' + operation, 'transform')
+
     def load(self, incremental_data=None):
         args = []
         if incremental_data is not None:
             args.append(incremental_data)
-        result = self._load(*args)
-        self.input_schema().conform_df(result)
+        with self._span('load') as span:
+            result = self._load(*args)
+            with profiling.span('conform', 'conform'):
+                self.input_schema().conform_df(result)
+            span.set_output(result)
         return result
 
     def _load(self, incremental_data=None):
         raise NotImplementedError()
 
     def transform(self, data):
-        data = data.copy()
-        if isinstance(data, dict):
-            for k, df in data.items():
-                data[k] = df.copy()
-        self.input_schema().conform_df(data)
-        result = self._transform(data)
-        del data
-        self.output_schema().conform_df(result)
+        with self._span('transform') as span:
+            span.set_input(data)
+            data = data.copy()
+            if isinstance(data, dict):
+                for k, df in data.items():
+                    data[k] = df.copy()
+            with profiling.span('conform', 'conform'):
+                self.input_schema().conform_df(data)
+            result = self._transform(data)
+            del data
+            with profiling.span('conform', 'conform'):
+                self.output_schema().conform_df(result)
+            span.set_output(result)
         return result
 
     def _transform(self, data):
         raise NotImplementedError()
 
+    def transform_groups(self, data, group_index):
+        """Transform each group of data (grouped by the group_index column) separately, and combine the results.
+        Unlike calling transform() per group, the input and output schemas are conformed once for all the groups.
+        The result has a fresh integer index."""
+        with self._span('transform_groups') as span:
+            span.set_input(data)
+            with profiling.span('conform', 'conform'):
+                data = self.input_schema().conform_df(data, copy_on_write=True)
+            results = []
+            for group_id, group_data in data.groupby(group_index, sort=False):
+                if group_data.empty: #pandas bug where empty groups are returned when grouped by a category
+                    continue
+                results.append(self._transform(group_data))
+            del data
+            result = from_chunks(results)
+            with profiling.span('conform', 'conform'):
+                self.output_schema().conform_df(result)
+            span.set_output(result)
+        return result
+
+    def needed_columns(self, name=None):
+        """The columns _transform uses of the input (or input table name), or None if it uses all of them."""
+        if self.input_columns is None or name is None or not isinstance(self.input_columns, dict):
+            return self.input_columns
+        return self.input_columns.get(name)
+
+    def needed_schema(self, schema, name=None):
+        """schema projected to the needed_columns of the input (or input table name)."""
+        columns = self.needed_columns(name)
+        if columns is None:
+            return schema
+        return PartialSchema.projection(schema, columns)
+
     def input_schema(self):
         return PartialSchema()
 
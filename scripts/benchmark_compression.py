@@ -0,0 +1,47 @@
+from chatto_transform.schema.mimic import mimic_schema
+from chatto_transform.lib.compression import COMPRESSION_PROFILES, sample_df, benchmark
+from chatto_transform.lib import temp_file
+import argparse
+import shutil
+
+import pandas
+pandas.options.display.width = 200
+
+parser = argparse.ArgumentParser(description='Compare HDF compression codecs and levels on MIMIC-shaped data.')
+parser.add_argument('--schemas', nargs='+', default=['chartevents', 'labevents'],
+	help='names of tables in schema/mimic/mimic_schema.py')
+parser.add_argument('--rows', type=int, default=10**6)
+parser.add_argument('--codecs', nargs='*', default=[],
+	help='extra codec:level settings to try besides the profiles, e.g. zlib:1 lzo:1 bzip2:9')
+parser.add_argument('--table_format', action='store_true', help='store in table format rather than fixed')
+parser.add_argument('--repeat', type=int, default=1)
+parser.add_argument('--from_db', action='store_true',
+	help='benchmark the first --rows rows of each table from the database, rather than random data')
+
+def codec_setting(codec):
+	complib, complevel = codec.split(':')
+	return {'complib': complib, 'complevel': int(complevel)}
+
+def load_rows(schema, rows):
+	from chatto_transform.sessions.mimic import mimic_login
+	from chatto_transform.datastores.sqlalchemy_datastore import schema_as_table, fast_sql_to_df
+	from sqlalchemy import select
+	table = schema_as_table(schema, mimic_login.get_engine())
+	return fast_sql_to_df(select([table]).limit(rows), schema)
+
+if __name__ == '__main__':
+	args = parser.parse_args()
+	settings = sorted(COMPRESSION_PROFILES) + [codec_setting(codec) for codec in args.codecs]
+
+	tmp_dir = temp_file.make_temporary_dir()
+	try:
+		for name in args.schemas:
+			schema = getattr(mimic_schema, name + '_schema')
+			if args.from_db:
+				df = load_rows(schema, args.rows)
+			else:
+				df = sample_df(schema, args.rows)
+			print(name, len(df), 'rows,', df.memory_usage(index=True).sum() / 10**6, 'mb in memory')
+			print(benchmark(schema, df, settings, tmp_dir, repeat=args.repeat, fixed=not args.table_format))
+	finally:
+		shutil.rmtree(tmp_dir)
@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+
+from chatto_transform.datastores.appendable_datastore import AppendableHdfDataStore
+from chatto_transform.schema.schema_base import Schema, id_, cat
+
+"""Tests of the category files of AppendableHdfDataStore, which are read and written without touching the HDF file."""
+
+schema = Schema('t', [id_('a'), cat('c')])
+
+def make_store(tmpdir):
+    return AppendableHdfDataStore(schema, str(tmpdir.join('t.hdf')))
+
+def encode(store, labels):
+    return store._encode_categories('c', pd.Series(pd.Categorical(labels))).tolist()
+
+def decode(store, codes):
+    return pd.Series(store._decode_categories('c', np.array(codes))).astype('object').where(lambda s: s.notnull(), None).tolist()
+
+def test_codes_are_given_out_in_order(tmpdir):
+    store = make_store(tmpdir)
+    assert store._load_categories('c').tolist() == []
+    assert encode(store, ['b', 'a', None, 'b']) == [1, 0, -1, 1]
+    assert encode(store, ['c', 'a']) == [2, 0]
+    assert store._load_categories('c').tolist() == ['a', 'b', 'c']
+    assert decode(store, [2, -1, 0]) == ['c', None, 'a']
+
+    # a new store reads the same codes back from the file
+    assert make_store(tmpdir)._load_categories('c').tolist() == ['a', 'b', 'c']
+
+def test_only_new_labels_are_read(tmpdir):
+    store = make_store(tmpdir)
+    other = make_store(tmpdir)
+    encode(store, ['a', 'b'])
+    assert encode(other, ['b', 'c']) == [1, 2]
+    _, _, offset = store._category_tables['c']
+    assert encode(store, ['c', 'd']) == [2, 3]
+    _, _, new_offset = store._category_tables['c']
+    assert new_offset > offset
+    assert other._load_categories('c').tolist() == ['a', 'b', 'c', 'd']
+
+def test_rewritten_file_is_read_from_the_start(tmpdir):
+    store = make_store(tmpdir)
+    other = make_store(tmpdir)
+    encode(store, ['a', 'b'])
+    # rewritten with more labels than before, so it is longer than the part store has read
+    other._add_categories('c', ['x', 'y', 'z'], append=False)
+    assert store._load_categories('c').tolist() == ['x', 'y', 'z']
+    assert encode(store, ['y', 'a']) == [1, 3]
+
+def test_interrupted_append_is_overwritten(tmpdir):
+    store = make_store(tmpdir)
+    encode(store, ['a', 'b'])
+    with open(store._get_category_file('c'), 'ab') as f:
+        f.write(b'\x05\x00\x00\x00ab') #a label cut short
+    other = make_store(tmpdir)
+    assert other._load_categories('c').tolist() == ['a', 'b']
+    assert encode(other, ['c']) == [2]
+    assert make_store(tmpdir)._load_categories('c').tolist() == ['a', 'b', 'c']
+
+def test_legacy_csv_categories_are_converted(tmpdir):
+    store = make_store(tmpdir)
+    tmpdir.join('t.hdf_c_categories.csv').write('b\na\n')
+    assert store._load_categories('c').tolist() == ['b', 'a']
+    assert not tmpdir.join('t.hdf_c_categories.csv').exists()
+    assert tmpdir.join('t.hdf_c_categories.bin').exists()
+    assert encode(store, ['a', 'c']) == [1, 2]
+
+def test_delete_removes_category_files(tmpdir):
+    store = make_store(tmpdir)
+    encode(store, ['a'])
+    store.delete()
+    assert tmpdir.listdir() == []
+    assert store._load_categories('c').tolist() == []
@@ -0,0 +1,62 @@
+import datetime
+import time
+
+import numpy as np
+import pytest
+
+from chatto_transform.lib.big_dt_tools import parse_fixed_datetimes, parse_big_dt, datetimes_to_seconds, seconds_to_datetimes
+
+def test_parse_fixed_datetimes():
+    values = np.array(['2015-03-04 05:06:07', '1830-12-31 23:59:59', None, '2015-03-04', '2015-03-04T05:06:07',
+        '2015-03-04 05:06:07.5', '2015-13-01 00:00:00', '2015-03-04 24:00:00'], dtype='object')
+    result, valid = parse_fixed_datetimes(values)
+    assert valid.tolist() == [True, True, False, False, False, False, False, False]
+    assert result[0] == np.datetime64('2015-03-04T05:06:07')
+    assert result[1] == np.datetime64('1830-12-31T23:59:59')
+    assert [str(value) for value in result[~valid]] == ['NaT'] * 6
+
+def test_parse_fixed_datetimes_rejects_days_past_the_end_of_the_month():
+    values = np.array(['2015-02-29 00:00:00', '2016-02-29 00:00:00', '2015-04-31 12:00:00', '2015-04-30 12:00:00',
+        '1900-02-29 00:00:00', '2000-02-29 00:00:00', '2015-01-32 00:00:00'], dtype='object')
+    result, valid = parse_fixed_datetimes(values)
+    # they would otherwise roll over into the first days of the next month
+    assert valid.tolist() == [False, True, False, True, False, True, False]
+    assert result[1] == np.datetime64('2016-02-29T00:00:00')
+    assert result[3] == np.datetime64('2015-04-30T12:00:00')
+    assert result[5] == np.datetime64('2000-02-29T00:00:00')
+
+def test_parse_fixed_datetimes_non_ascii():
+    assert parse_fixed_datetimes(np.array(['2015-03-04 05:06:0é'], dtype='object')) is None
+
+def test_parse_big_dt_falls_back_to_dateutil():
+    result = parse_big_dt(np.array(['2015-03-04 05:06:07', '4 March 2015', None, datetime.datetime(1800, 1, 2)],
+        dtype='object'))
+    assert result[0] == datetime.datetime(2015, 3, 4, 5, 6, 7)
+    assert result[1] == datetime.datetime(2015, 3, 4)
+    assert result[2] != result[2] #nan
+    assert result[3] == datetime.datetime(1800, 1, 2)
+
+@pytest.fixture(params=['UTC', 'America/New_York', 'Australia/Lord_Howe'])
+def local_tz(request, monkeypatch):
+    if not hasattr(time, 'tzset'):
+        pytest.skip('time.tzset is not available')
+    monkeypatch.setenv('TZ', request.param)
+    time.tzset()
+    yield request.param
+    monkeypatch.undo()
+    time.tzset()
+
+def test_seconds_round_trip_in_local_time(local_tz):
+    start = datetime.datetime(2015, 1, 1)
+    # every 20 minutes through the year, so both changes of daylight saving time are crossed
+    values = [start + datetime.timedelta(minutes=20 * i) for i in range(365 * 72)]
+    values += [datetime.datetime(1850, 6, 1, 12), datetime.datetime(2200, 6, 1, 12)]
+    values = np.array(values + [None], dtype='object')
+
+    seconds = datetimes_to_seconds(values)
+    assert np.isnan(seconds[-1])
+    assert seconds[:-1].tolist() == [value.timestamp() for value in values[:-1]]
+
+    result = seconds_to_datetimes(seconds)
+    assert result[-1] != result[-1] #nan
+    assert result[:-1].tolist() == [datetime.datetime.fromtimestamp(s) for s in seconds[:-1]]
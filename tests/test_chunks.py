@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+
+from chatto_transform.lib.chunks import from_chunks, to_group_chunks, group_chunk_bounds, CategoryTable
+
+def test_from_chunks_keeps_dtypes():
+    chunks = [pd.DataFrame({'a': [1, 2], 'b': [0.5, 1.5]}), pd.DataFrame({'a': [3], 'b': [2.5]})]
+    df = from_chunks(iter(chunks))
+    assert df['a'].dtype == 'int64'
+    assert df['b'].dtype == 'float64'
+    assert df['a'].tolist() == [1, 2, 3]
+    assert df.index.tolist() == [0, 1, 2]
+
+def test_from_chunks_promotes_ints_to_float_on_nans():
+    chunks = [pd.DataFrame({'a': [1, 2]}), pd.DataFrame({'a': [np.nan, 4.5]})]
+    df = from_chunks(chunks)
+    assert df['a'].dtype == 'float64'
+    assert df['a'].tolist()[:2] == [1.0, 2.0]
+    assert np.isnan(df['a'][2])
+    assert df['a'][3] == 4.5
+
+def test_from_chunks_promotes_datetimes_mixed_with_numbers_to_object():
+    chunks = [pd.DataFrame({'a': pd.to_datetime(['2015-01-01'])}), pd.DataFrame({'a': [1.0]})]
+    df = from_chunks(chunks)
+    assert df['a'].dtype == 'object'
+    assert df['a'][0] == pd.Timestamp('2015-01-01')
+    assert df['a'][1] == 1.0
+
+def test_from_chunks_merges_categories():
+    chunks = [
+        pd.DataFrame({'c': pd.Categorical(['b', 'a', None])}),
+        pd.DataFrame({'c': pd.Categorical(['c', 'b'])}),
+        pd.DataFrame({'c': ['a', 'd']}) #not categorical, encoded onto the same codes
+    ]
+    df = from_chunks(chunks)
+    assert hasattr(df['c'], 'cat')
+    assert list(df['c'].cat.categories) == ['a', 'b', 'c', 'd']
+    assert df['c'].astype('object').where(df['c'].notnull(), None).tolist() == ['b', 'a', None, 'c', 'b', 'a', 'd']
+
+def test_from_chunks_rejects_mismatched_columns():
+    chunks = [pd.DataFrame({'a': [1]}), pd.DataFrame({'b': [1]})]
+    try:
+        from_chunks(chunks)
+    except TypeError:
+        pass
+    else:
+        raise AssertionError('expected a TypeError')
+
+def test_from_chunks_of_nothing():
+    assert from_chunks(iter([])).empty
+
+def test_category_table_encode():
+    table = CategoryTable()
+    assert table.encode(np.array(['x', 'y', 'x', None], dtype='object')).tolist() == [0, 1, 0, -1]
+    assert table.encode(np.array(['z', 'y'], dtype='object')).tolist() == [2, 1]
+    assert table.labels == ['x', 'y', 'z']
+
+def test_group_chunk_bounds_contiguous_groups():
+    df = pd.DataFrame({'g': [1, 1, 1, 2, 2, 3, 4, 4, 4, 4]})
+    order, bounds = group_chunk_bounds(df, 'g', chunksize=4)
+    assert order is None
+    assert [(int(start), int(stop)) for start, stop in bounds] == [(0, 5), (5, 10)]
+
+def test_group_chunk_bounds_interleaved_groups():
+    df = pd.DataFrame({'g': [2, 1, 2, 1, 3, 2]})
+    order, bounds = group_chunk_bounds(df, 'g', chunksize=2)
+    # rows are stably sorted by group, in order of first appearance
+    assert order.tolist() == [0, 2, 5, 1, 3, 4]
+    assert [(int(start), int(stop)) for start, stop in bounds] == [(0, 3), (3, 5), (5, 6)]
+
+def test_group_chunk_bounds_nulls_make_a_group():
+    df = pd.DataFrame({'g': [1.0, np.nan, 1.0, np.nan]})
+    order, bounds = group_chunk_bounds(df, 'g', chunksize=1)
+    assert order.tolist() == [0, 2, 1, 3]
+    assert [(int(start), int(stop)) for start, stop in bounds] == [(0, 2), (2, 4)]
+
+def test_to_group_chunks_keeps_groups_together():
+    df = pd.DataFrame({'g': [3, 1, 3, 2, 1, 2, 3], 'v': list(range(7))})
+    chunk_sizes = []
+    chunks = list(to_group_chunks(df, 'g', chunksize=2, chunk_sizes=chunk_sizes))
+    assert chunk_sizes == [len(chunk) for chunk in chunks]
+    assert sum(chunk_sizes) == len(df)
+    seen = set()
+    for chunk in chunks:
+        groups = set(chunk['g'])
+        assert not groups & seen
+        seen |= groups
+    assert sorted(pd.concat(chunks)['v'].tolist()) == list(range(7))
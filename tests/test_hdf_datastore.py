@@ -0,0 +1,74 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('tables')
+
+from chatto_transform.datastores.hdf_datastore import HdfDataStore
+from chatto_transform.lib.chunks import to_chunks
+from chatto_transform.schema.schema_base import Schema, id_, num, cat
+
+schema = Schema('t', [id_('a'), num('b'), cat('c')])
+
+def make_df(n, n_labels=3):
+    return pd.DataFrame({
+        'a': np.arange(n, dtype='float64'),
+        'b': np.arange(n, dtype='float64') / 2,
+        'c': pd.Categorical(['label_{}'.format(i % n_labels) for i in range(n)])
+    }, columns=['a', 'b', 'c'])
+
+def as_lists(df):
+    return {col: df[col].astype('object').tolist() for col in df.columns}
+
+def test_chunks_round_trip(tmpdir):
+    ds = HdfDataStore(schema, str(tmpdir.join('t.hdf')))
+    df = make_df(10)
+    ds.store_chunks(to_chunks(df, 4))
+
+    assert os.path.isfile(ds._chunk_container_file())
+    assert not os.path.exists(ds._partial_chunk_container_file())
+    assert ds.chunk_index() == [{'key': 'chunk_0', 'rows': 4}, {'key': 'chunk_1', 'rows': 4}, {'key': 'chunk_2', 'rows': 2}]
+
+    chunks = list(ds.load_chunks())
+    assert [len(chunk) for chunk in chunks] == [4, 4, 2]
+    assert as_lists(pd.concat(chunks, ignore_index=True)) == as_lists(df)
+    assert as_lists(ds.load_chunk(1)) == as_lists(df.iloc[4:8].reset_index(drop=True))
+
+def test_chunk_stores_load_one_chunk_each(tmpdir):
+    ds = HdfDataStore(schema, str(tmpdir.join('t.hdf')))
+    df = make_df(10)
+    ds.store_chunks(to_chunks(df, 4))
+    stores = list(ds.chunk_stores())
+    assert len(stores) == 3
+    assert as_lists(stores[2].load()) == as_lists(df.iloc[8:].reset_index(drop=True))
+
+def test_chunks_with_many_category_labels(tmpdir):
+    # more labels than fit in the 64KB an HDF5 node attribute can hold
+    ds = HdfDataStore(schema, str(tmpdir.join('t.hdf')))
+    df = make_df(20000, n_labels=20000)
+    ds.store_chunks(to_chunks(df, 15000))
+    assert len(ds.load_chunk(0)['c'].cat.categories) == 20000
+    assert as_lists(pd.concat(ds.load_chunks(), ignore_index=True)) == as_lists(df)
+
+def test_failed_store_chunks_leaves_no_partial_file(tmpdir):
+    ds = HdfDataStore(schema, str(tmpdir.join('t.hdf')))
+    ds.store_chunks(to_chunks(make_df(6), 3))
+
+    def failing_chunks():
+        yield make_df(3)
+        raise RuntimeError('chunk failed')
+
+    with pytest.raises(RuntimeError):
+        ds.store_chunks(failing_chunks())
+    assert not os.path.exists(ds._partial_chunk_container_file())
+    # the earlier container is still there, untouched
+    assert [len(chunk) for chunk in ds.load_chunks()] == [3, 3]
+
+def test_delete_chunks(tmpdir):
+    ds = HdfDataStore(schema, str(tmpdir.join('t.hdf')))
+    ds.store_chunks(to_chunks(make_df(6), 3))
+    open(ds._partial_chunk_container_file(), 'w').close() #left by a killed process
+    ds.delete_chunks()
+    assert tmpdir.listdir() == []
@@ -0,0 +1,58 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('psycopg2')
+sqlalchemy = pytest.importorskip('sqlalchemy')
+
+from chatto_transform.datastores.psql_datastore import PSqlDataStore
+from chatto_transform.schema.schema_base import Schema, id_, num, cat
+
+"""These tests need a PostgreSQL database they can create tables in, given by the CHATTO_TEST_PSQL_URL environment
+variable (e.g. postgresql://localhost/chatto_test). They are skipped without it."""
+
+PSQL_URL = os.environ.get('CHATTO_TEST_PSQL_URL')
+pytestmark = pytest.mark.skipif(PSQL_URL is None, reason='CHATTO_TEST_PSQL_URL is not set')
+
+schema = Schema('test_upsert', [id_('k'), num('v'), cat('c')], options={'index': 'k'})
+
+@pytest.fixture
+def store():
+    engine = sqlalchemy.create_engine(PSQL_URL)
+    store = PSqlDataStore(schema, engine)
+    store.delete()
+    yield store
+    store.delete()
+    engine.dispose()
+
+def make_df(k, v, c):
+    return pd.DataFrame({'k': np.array(k, dtype='float64'), 'v': np.array(v, dtype='float64'), 'c': pd.Categorical(c)},
+        columns=['k', 'v', 'c'])
+
+def rows(store):
+    df = store.load().sort_values(['k', 'v'])
+    return list(zip(df['k'].tolist(), df['v'].tolist(), df['c'].astype('object').tolist()))
+
+def has_unique_index(store):
+    return store.engine.execute("SELECT 1 FROM pg_indexes WHERE tablename = %s AND indexname = %s",
+        'test_upsert', 'test_upsert_k_key').first() is not None
+
+def test_update_upserts_rows(store):
+    store.store(make_df([1, 2, 3], [1, 2, 3], ['a', 'b', 'a']))
+    store.update(make_df([2, 4], [20, 40], ['x', 'b']))
+    assert rows(store) == [(1, 1, 'a'), (2, 20, 'x'), (3, 3, 'a'), (4, 40, 'b')]
+    assert has_unique_index(store)
+
+def test_update_repeated_index_values_last_row_wins(store):
+    store.store(make_df([1, 2, 3], [1, 2, 3], ['a', 'b', 'a']))
+    store.update_chunks([make_df([2, 4, 2], [20, 40, 21], ['x', 'b', 'y']), make_df([4], [41], ['z'])])
+    assert rows(store) == [(1, 1, 'a'), (2, 21, 'y'), (3, 3, 'a'), (4, 41, 'z')]
+
+def test_update_falls_back_without_upsert_on_duplicate_index_values(store):
+    # the unique index ON CONFLICT needs can't be created on a table that already has duplicates
+    store.store(make_df([1, 1, 2], [1, 2, 3], ['a', 'b', 'a']))
+    store.update(make_df([2, 5], [30, 50], ['c', 'd']))
+    assert rows(store) == [(1, 1, 'a'), (1, 2, 'b'), (2, 30, 'c'), (5, 50, 'd')]
+    assert not has_unique_index(store)
@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('tables')
+
+from chatto_transform.lib.query_cache import QueryCache, normalise_query, query_key
+from chatto_transform.schema.schema_base import Schema, id_, num
+
+schema = Schema('t', [id_('a'), num('b')])
+
+def make_df(n=8):
+    return pd.DataFrame({'a': np.arange(n, dtype='float64'), 'b': np.arange(n, dtype='float64') * 10})
+
+def test_normalise_query_ignores_predicate_and_column_order():
+    q1 = normalise_query(schema, 'x  =  1', ['b', 'a'], [('a', '>', 1), ('b', 'in', [3, 1])])
+    q2 = normalise_query(schema, 'x = 1', ['a', 'b'], [('b', 'in', [1, 3]), ('a', '>', 1)])
+    assert query_key(q1) == query_key(q2)
+
+def test_exact_hit(tmpdir):
+    cache = QueryCache(str(tmpdir))
+    assert cache.get(schema, where=[('a', '>', 2)]) is None
+    cache.put(schema, None, None, [('a', '>', 2)], make_df()[lambda df: df['a'] > 2])
+    df = cache.get(schema, where=[('a', '>', 2)])
+    assert df['a'].tolist() == [3, 4, 5, 6, 7]
+    stats = cache.stats()
+    assert (stats['hits'], stats['superset_hits'], stats['misses'], stats['entries']) == (1, 0, 1, 1)
+
+def test_superset_hit_filters_and_projects(tmpdir):
+    cache = QueryCache(str(tmpdir))
+    cache.put(schema, None, None, [('a', '>', 2)], make_df()[lambda df: df['a'] > 2])
+    df = cache.get(schema, columns=['b'], where=[('a', '>', 2), ('a', '<', 6)])
+    assert list(df.columns) == ['b']
+    assert df['b'].tolist() == [30, 40, 50]
+    assert cache.stats()['superset_hits'] == 1
+
+def test_no_superset_hit_with_fewer_predicates(tmpdir):
+    cache = QueryCache(str(tmpdir))
+    cache.put(schema, None, None, [('a', '>', 2)], make_df()[lambda df: df['a'] > 2])
+    assert cache.get(schema) is None
+    assert cache.get(schema, where=[('a', '>', 3)]) is None
+
+def test_no_superset_hit_without_needed_columns(tmpdir):
+    cache = QueryCache(str(tmpdir))
+    cache.put(schema, None, ['a'], None, make_df()[['a']])
+    assert cache.get(schema, columns=['a'], where=[('a', '<', 3)])['a'].tolist() == [0, 1, 2]
+    # b is neither cached nor can it be filtered on
+    assert cache.get(schema, columns=['b']) is None
+    assert cache.get(schema, columns=['a'], where=[('b', '<', 30)]) is None
+
+def test_no_superset_hit_across_conditions(tmpdir):
+    cache = QueryCache(str(tmpdir))
+    cache.put(schema, 'a > 0', None, None, make_df())
+    assert cache.get(schema, 'a > 1') is None
+    assert cache.get(schema) is None
+
+def test_evicts_least_recently_used(tmpdir):
+    cache = QueryCache(str(tmpdir))
+    cache.put(schema, None, None, [('a', '==', 0)], make_df())
+    entry_bytes = cache.stats()['bytes']
+
+    cache.max_bytes = 2.5 * entry_bytes
+    cache.put(schema, None, None, [('a', '==', 1)], make_df())
+    cache.get(schema, where=[('a', '==', 0)]) #now used more recently than a == 1
+    cache.put(schema, None, None, [('a', '==', 2)], make_df())
+
+    assert cache.stats()['entries'] == 2
+    assert cache.get(schema, where=[('a', '==', 1)]) is None
+    assert cache.get(schema, where=[('a', '==', 0)]) is not None
+    assert cache.get(schema, where=[('a', '==', 2)]) is not None
+    assert len(tmpdir.listdir(lambda f: f.ext == '.hdf')) == 2
+
+def test_empty_results_are_not_cached(tmpdir):
+    cache = QueryCache(str(tmpdir))
+    cache.put(schema, None, None, None, make_df(0))
+    assert cache.stats()['entries'] == 0